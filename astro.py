@@ -1,95 +1,857 @@
+# aiogram, aiohttp и pymongo загружаются при импорте модуля (около 4 с, почти все — модели
+# aiogram.types): на них объявлены router, middleware, FSM-хранилище и состояния. Это касается
+# и разовых задач командной строки (--migrate, --backfill-birth-dates, --prewarm-horoscopes).
+# Откладывается только motor (см. init_mongodb); без aiogram импортируются horoscope и texts.
+import argparse
 import os
 import logging
-import hashlib
+import json
 import random
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types, F
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.methods import TelegramMethod
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup, ReplyKeyboardRemove
 import asyncio
 import re
-from motor.motor_asyncio import AsyncIOMotorClient
+import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo import monitoring
+from pymongo.errors import BulkWriteError, PyMongoError
 from dotenv import load_dotenv
-from fastapi import Request
-
-from fastapi import FastAPI
 
 # --- ДОБАВЛЕНЫ НОВЫЕ ИМПОРТЫ ДЛЯ WEBHOOK И AIOHTTP ---
 from aiohttp import web
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 # --- КОНЕЦ НОВЫХ ИМПОРТОВ ---
+from horoscope import HoroscopeGenerator, aspect_phrases, prewarm_shard
+from metrics import HandlerMetrics, LatencyHistogram, PrometheusText, UpdateScope, current_scope
+from texts import CATALOG, DEFAULT_LANG, LocalizedProfile
+try:
+    import orjson
+except ImportError: # orjson необязателен: без него используется стандартный json
+    orjson = None
 
 # --- Загрузка переменных окружения для локальной разработки ---
 load_dotenv()
-app = FastAPI()
 
 # Настройки (теперь читаются из переменных окружения для Render)
-TOKEN = os.getenv("BOT_TOKEN")
-TON_WALLET = os.getenv("TON_WALLET_ADDRESS")
-ADSGRAM_API_KEY = os.getenv("ADSGRAM_API_KEY")
-MONGO_URI = os.getenv("MONGO_URI")
-MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "AstroBotDB")
-MONGO_COLLECTION_NAME = os.getenv("MONGO_COLLECTION_NAME", "users")
-WEBHOOK_DOMAIN = "astrox-mfuk.onrender.com"
-WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "astrox-mfuk.onrender.com")
-
-# Проверка наличия обязательных переменных окружения
-if not TOKEN:
-    raise ValueError("Environment variable BOT_TOKEN is not set.")
-if not TON_WALLET:
-    raise ValueError("Environment variable TON_WALLET_ADDRESS is not set.")
-
-# --- НАСТРОЙКИ WEBHOOK ДЛЯ RENDER ---
-# WEBHOOK_HOST - это домен вашего сервиса Render (например, my-astro-bot.onrender.com)
-WEBHOOK_PATH = f"/webhook/{TOKEN}"
-WEBHOOK_URL = f"{WEBHOOK_DOMAIN}{WEBHOOK_PATH}"
-# Render предоставляет порт через переменную окружения PORT
-WEB_SERVER_PORT = os.getenv('PORT', 8080)
-# Полный URL вебхука, который будет установлен в Telegram
-# Исправлена опечатка WEBHOO_PATH на WEBHOOK_PATH
-WEBHOOK_URL = f"https://{WEBHOOK_HOST}/webhook/{TOKEN}" if WEBHOOK_HOST else None
-# Путь, по которому Telegram будет отправлять обновления (часть WEBHOOK_URL)
-WEBHOOK_PATH = f"/webhook/{TOKEN}"
-# --- КОНЕЦ НАСТРОЕК WEBHOOK ---
+# Секреты и адреса развертывания собраны в Config (см. ниже) и проверяются в create_app, а не при импорте
+# Пул соединений MongoDB: размер, сколько ждать свободного соединения и выбора сервера,
+# сжатие трафика (например "zstd,snappy,zlib"; zstd и snappy требуют доп. пакетов)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 5))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 2000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")
+# Сколько соединений открыть заранее при старте (0 — не прогревать)
+MONGO_WARMUP_CONNECTIONS = int(os.getenv("MONGO_WARMUP_CONNECTIONS", MONGO_MIN_POOL_SIZE))
+# Чтение профиля дольше MONGO_READ_TIMEOUT_MS считается сбоем; после MONGO_BREAKER_FAILURES
+# сбоев подряд профили MONGO_BREAKER_RESET секунд берутся только из кэша
+MONGO_READ_TIMEOUT_MS = int(os.getenv("MONGO_READ_TIMEOUT_MS", 1500))
+MONGO_BREAKER_FAILURES = int(os.getenv("MONGO_BREAKER_FAILURES", 5))
+MONGO_BREAKER_RESET = float(os.getenv("MONGO_BREAKER_RESET", 30))
+# Кэш профилей пользователей: максимальное число записей и время жизни записи в секундах
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", 100_000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 600))
+# Кэш готовых гороскопов на текущий день: размер в памяти процесса и (опционально)
+# коллекция MongoDB, через которую кэш разделяют все воркеры
+HOROSCOPE_CACHE_MAX_SIZE = int(os.getenv("HOROSCOPE_CACHE_MAX_SIZE", 50_000))
+HOROSCOPE_CACHE_COLLECTION = os.getenv("HOROSCOPE_CACHE_COLLECTION")
+# Ночной прогрев: гороскопы на завтра считаются в PREWARM_PROCESSES процессах пачками
+# по PREWARM_SHARD_SIZE пользователей (диапазон _id) и пишутся в HOROSCOPE_CACHE_COLLECTION
+PREWARM_PROCESSES = int(os.getenv("PREWARM_PROCESSES", os.cpu_count() or 1))
+PREWARM_SHARD_SIZE = int(os.getenv("PREWARM_SHARD_SIZE", 5000))
+# Ежедневная рассылка: число воркеров, общий лимит сообщений в секунду (у Telegram около 30)
+# и минимальный интервал между сообщениями в один чат
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 20))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", 1.0))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+BROADCAST_PROGRESS_EVERY = int(os.getenv("BROADCAST_PROGRESS_EVERY", 1000))
+# Размер пачки документов, которую курсор рассылки получает из MongoDB за один запрос
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 500))
+# Запуски рассылки и состояние доставки по пользователям хранятся в MongoDB, чтобы
+# прерванную рассылку можно было продолжить без повторной отправки
+BROADCAST_RUNS_COLLECTION = os.getenv("BROADCAST_RUNS_COLLECTION", "broadcast_runs")
+BROADCAST_DELIVERIES_COLLECTION = os.getenv("BROADCAST_DELIVERIES_COLLECTION", "broadcast_deliveries")
+# Сколько пользователей обрабатывается между чекпоинтами и на сколько секунд воркер арендует запуск
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", 200))
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", 120))
+# Статусы доставки пишутся пачками по BROADCAST_STATUS_BATCH сообщений, не дожидаясь чекпоинта:
+# после падения процесса повторно отправляется не больше такой пачки и очереди рассылки
+BROADCAST_STATUS_BATCH = int(os.getenv("BROADCAST_STATUS_BATCH", 50))
+# Идентификатор процесса — владельца аренды запуска рассылки
+INSTANCE_ID = uuid.uuid4().hex
+# Состояния FSM: коллекция, срок жизни брошенного состояния, сколько секунд процесс доверяет
+# своему кэшу и задержка пакетной записи. Апдейты одного пользователя могут попасть в разные
+# процессы, поэтому кэш короткий: за FSM_CACHE_TTL чужое изменение станет видно. Отсутствие
+# состояния кэшируется еще короче (FSM_MISS_CACHE_TTL) — этого хватает, чтобы один апдейт
+# не читал MongoDB несколько раз, и пользователь не застрянет в диалоге, начатом в другом процессе.
+FSM_COLLECTION = os.getenv("FSM_COLLECTION", "fsm_states")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 24 * 3600))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", 5))
+FSM_MISS_CACHE_TTL = float(os.getenv("FSM_MISS_CACHE_TTL", 1))
+FSM_CACHE_MAX_SIZE = int(os.getenv("FSM_CACHE_MAX_SIZE", 100_000))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.05))
+# Регистрации из /start: пакет уходит в MongoDB через REGISTRATION_FLUSH_INTERVAL секунд
+# или как только наберется REGISTRATION_BATCH_SIZE пользователей
+REGISTRATION_BATCH_SIZE = int(os.getenv("REGISTRATION_BATCH_SIZE", 500))
+REGISTRATION_FLUSH_INTERVAL = float(os.getenv("REGISTRATION_FLUSH_INTERVAL", 0.05))
+# Реферальные связи хранятся отдельной коллекцией, а не массивом в документе реферера
+REFERRALS_COLLECTION = os.getenv("REFERRALS_COLLECTION", "referrals")
+REFERRER_CACHE_MAX_SIZE = int(os.getenv("REFERRER_CACHE_MAX_SIZE", 100_000))
+REFERRER_CACHE_TTL = float(os.getenv("REFERRER_CACHE_TTL", 3600))
+# Коллекция с отметками о выполненных миграциях схемы и размер пачки при миграции
+SCHEMA_COLLECTION = os.getenv("SCHEMA_COLLECTION", "schema_migrations")
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", 1000))
+# Очередь апдейтов вебхука: число воркеров (шардов по id чата), общий размер очереди
+# и глубина, начиная с которой пропускается необязательная работа (реклама)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 16))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 2000))
+UPDATE_QUEUE_SHED_DEPTH = int(os.getenv("UPDATE_QUEUE_SHED_DEPTH", 500))
+
+
+class Config:
+    """Настройки развертывания: токен, кошелек, MongoDB, вебхук и секрет cron.
+
+    Тюнинг (кэши, рассылка, пул соединений) задается константами выше — у него есть значения
+    по умолчанию, и при импорте он ничего не проверяет.
+    """
+    __slots__ = ("bot_token", "ton_wallet", "adsgram_api_key", "mongo_uri", "mongo_db_name",
+                 "mongo_collection_name", "webhook_host", "port", "cron_secret_key")
+
+    def __init__(self, bot_token: str | None, ton_wallet: str | None, adsgram_api_key: str | None = None,
+                 mongo_uri: str | None = None, mongo_db_name: str = "AstroBotDB", mongo_collection_name: str = "users",
+                 webhook_host: str | None = None, port: int = 8080, cron_secret_key: str | None = None):
+        self.bot_token = bot_token
+        self.ton_wallet = ton_wallet
+        self.adsgram_api_key = adsgram_api_key
+        self.mongo_uri = mongo_uri
+        self.mongo_db_name = mongo_db_name
+        self.mongo_collection_name = mongo_collection_name
+        # WEBHOOK_HOST - это домен вашего сервиса Render (например, my-astro-bot.onrender.com)
+        self.webhook_host = webhook_host
+        # Render предоставляет порт через переменную окружения PORT
+        self.port = port
+        self.cron_secret_key = cron_secret_key
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        return cls(
+            bot_token=os.getenv("BOT_TOKEN"),
+            ton_wallet=os.getenv("TON_WALLET_ADDRESS"),
+            adsgram_api_key=os.getenv("ADSGRAM_API_KEY"),
+            mongo_uri=os.getenv("MONGO_URI"),
+            mongo_db_name=os.getenv("MONGO_DB_NAME", "AstroBotDB"),
+            mongo_collection_name=os.getenv("MONGO_COLLECTION_NAME", "users"),
+            webhook_host=os.getenv("WEBHOOK_HOST", "astrox-mfuk.onrender.com"),
+            port=int(os.getenv("PORT", 8080)),
+            cron_secret_key=os.getenv("CRON_SECRET_KEY"), # Убедитесь, что эта переменная задана на Render
+        )
+
+    def validate(self):
+        """Проверка наличия обязательных переменных окружения."""
+        if not self.bot_token:
+            raise ValueError("Environment variable BOT_TOKEN is not set.")
+        if not self.ton_wallet:
+            raise ValueError("Environment variable TON_WALLET_ADDRESS is not set.")
+
+    @property
+    def webhook_path(self) -> str:
+        # Путь, по которому Telegram будет отправлять обновления (часть webhook_url)
+        return f"/webhook/{self.bot_token}"
+
+    @property
+    def webhook_url(self) -> str | None:
+        # Полный URL вебхука, который будет установлен в Telegram
+        return f"https://{self.webhook_host}{self.webhook_path}" if self.webhook_host else None
+
+
+# Задается в create_app
+config: Config | None = None
 
 # Инициализация логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s') # Более подробный формат
 logger = logging.getLogger(__name__)
 
+# --- Мониторинг MongoDB ---
+class CommandLatencyListener(monitoring.CommandListener):
+    """Задержки команд MongoDB по имени команды (find, update, insert, ...)."""
+
+    def __init__(self):
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.failures: Dict[str, int] = {}
+
+    def _histogram(self, command_name: str) -> LatencyHistogram:
+        histogram = self.histograms.get(command_name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(command_name, LatencyHistogram())
+        return histogram
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._histogram(event.command_name).observe(event.duration_micros / 1000)
+
+    def failed(self, event):
+        self._histogram(event.command_name).observe(event.duration_micros / 1000)
+        self.failures[event.command_name] = self.failures.get(event.command_name, 0) + 1
+
+    def stats(self) -> dict:
+        return {name: {**histogram.stats(), "failed": self.failures.get(name, 0)} for name, histogram in self.histograms.items()}
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """Занятость пула соединений и время ожидания свободного соединения."""
+
+    def __init__(self):
+        self.checkout_wait = LatencyHistogram()
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.open_connections = 0
+        self.checkout_failures = 0
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        self.max_checked_out = max(self.max_checked_out, self.checked_out)
+        # duration есть в событии начиная с pymongo 4.7
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            self.checkout_wait.observe(duration * 1000)
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def connection_check_out_failed(self, event):
+        # Сюда попадают и таймауты ожидания MONGO_WAIT_QUEUE_TIMEOUT_MS
+        self.checkout_failures += 1
+
+    def connection_created(self, event):
+        self.open_connections += 1
+
+    def connection_closed(self, event):
+        self.open_connections -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+            "open": self.open_connections,
+            "checked_out": self.checked_out,
+            "max_checked_out": self.max_checked_out,
+            "checkout_failures": self.checkout_failures,
+            "checkout_wait": self.checkout_wait.stats(),
+        }
+
+
+class CircuitBreaker:
+    """Размыкатель для запросов к MongoDB.
+
+    После failure_threshold сбоев подряд размыкается на reset_timeout секунд: запросы не
+    отправляются, вызывающий сразу берет запасной вариант. Затем пропускает один пробный
+    запрос и замыкается обратно, если тот прошел.
+    """
+
+    def __init__(self, failure_threshold: int = MONGO_BREAKER_FAILURES, reset_timeout: float = MONGO_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trips = 0
+        self.short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.reset_timeout else "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "open":
+            self.short_circuited += 1
+            return False
+        if state == "half-open":
+            # Пробный запрос один: остальные ждут его результата как при разомкнутой цепи
+            self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None:
+            # Пробный запрос не прошел — размыкаемся заново
+            self.opened_at = time.monotonic()
+        elif self.failures >= self.failure_threshold:
+            self.trips += 1
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "trips": self.trips, "short_circuited": self.short_circuited}
+
+
+command_listener = CommandLatencyListener()
+pool_listener = PoolListener()
+mongo_breaker = CircuitBreaker()
+
+
+def mongo_stats() -> dict:
+    return {"commands": command_listener.stats(), "pool": pool_listener.stats(), "breaker": mongo_breaker.stats()}
+
+
+# Операции коллекции, которые считаются запросами к MongoDB
+DB_OPERATIONS = frozenset({
+    "find", "find_one", "find_one_and_update", "insert_one", "insert_many", "update_one", "update_many",
+    "replace_one", "delete_one", "delete_many", "bulk_write", "aggregate", "count_documents",
+})
+# Число запросов по (коллекция, операция)
+db_calls: Counter = Counter()
+
+
+class InstrumentedCollection:
+    """Обертка коллекции motor, считающая запросы по операциям и по текущему обработчику.
+
+    Задержки команд уже меряет command_listener, поэтому здесь только счетчики: обертка
+    добавляет к запросу один поиск атрибута и не замедляет горячий путь.
+    """
+    __slots__ = ("_collection",)
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._collection, name)
+        if name not in DB_OPERATIONS:
+            return attr
+        key = (self._collection.name, name)
+
+        def counted(*args, **kwargs):
+            db_calls[key] += 1
+            scope = current_scope.get()
+            if scope is not None:
+                scope.db_calls += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
 # --- Инициализация MongoDB ---
-# Клиент MongoDB
-mongo_client: AsyncIOMotorClient = None
+# Клиент MongoDB (AsyncIOMotorClient; motor импортируется только при подключении)
+mongo_client = None
 # База данных и коллекция
 db = None
 users_collection = None
+horoscopes_collection = None
+broadcast_runs_collection = None
+deliveries_collection = None
+referrals_collection = None
 
 async def init_mongodb():
     """Инициализация клиента MongoDB и коллекций."""
-    global mongo_client, db, users_collection
-    if MONGO_URI: # Проверяем, что URI задан, прежде чем пытаться подключиться
+    global mongo_client, db, users_collection, horoscopes_collection, broadcast_runs_collection, deliveries_collection, referrals_collection
+    if config.mongo_uri: # Проверяем, что URI задан, прежде чем пытаться подключиться
+        client = None
         try:
-            mongo_client = AsyncIOMotorClient(MONGO_URI)
-            db = mongo_client[MONGO_DB_NAME]
-            users_collection = db[MONGO_COLLECTION_NAME]
-            logger.info(f"MongoDB успешно подключен к базе данных '{MONGO_DB_NAME}'")
+            from motor.motor_asyncio import AsyncIOMotorClient
+
+            client_options = {
+                "maxPoolSize": MONGO_MAX_POOL_SIZE,
+                "minPoolSize": MONGO_MIN_POOL_SIZE,
+                "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                "event_listeners": [command_listener, pool_listener],
+            }
+            if MONGO_COMPRESSORS:
+                client_options["compressors"] = MONGO_COMPRESSORS
+            client = AsyncIOMotorClient(config.mongo_uri, **client_options)
+            database = client[config.mongo_db_name]
+            # Коллекции и индексы готовятся в локальных переменных, а глобальные переменные
+            # присваиваются только после успеха: если MongoDB недоступна при старте, модуль
+            # остается целиком без БД, а не наполовину подключенным
+            users = InstrumentedCollection(database[config.mongo_collection_name])
+            fsm_collection = InstrumentedCollection(database[FSM_COLLECTION])
+            # Брошенные посреди диалога состояния удаляются после FSM_STATE_TTL
+            await fsm_collection.create_index("updated_at", expireAfterSeconds=FSM_STATE_TTL)
+            broadcast_runs = InstrumentedCollection(database[BROADCAST_RUNS_COLLECTION])
+            deliveries = InstrumentedCollection(database[BROADCAST_DELIVERIES_COLLECTION])
+            # Состояние доставки нужно только несколько дней — дальше MongoDB удаляет его сама
+            await deliveries.create_index("created_at", expireAfterSeconds=7 * 24 * 3600)
+            await broadcast_runs.create_index("status")
+            # Поиск недоставленных прошлой попыткой запуска (_stale_user_ids)
+            await deliveries.create_index([("run_id", 1), ("status", 1)])
+            # _id реферальной связи — id приглашенного пользователя, поэтому пригласить его можно только один раз
+            referrals = InstrumentedCollection(database[REFERRALS_COLLECTION])
+            await referrals.create_index("referrer_id")
+            horoscopes = None
+            if HOROSCOPE_CACHE_COLLECTION:
+                horoscopes = InstrumentedCollection(database[HOROSCOPE_CACHE_COLLECTION])
+                # Записи удаляются самой MongoDB после наступления expires_at (конец дня)
+                await horoscopes.create_index("expires_at", expireAfterSeconds=0)
+                await horoscopes.create_index("user_id")
         except Exception as e:
             logger.error(f"Ошибка подключения к MongoDB: {e}", exc_info=True)
             # Не поднимаем исключение, чтобы бот мог запуститься без БД для пользователей
             logger.warning("Бот будет работать без сохранения пользовательских данных в MongoDB.")
+            if client is not None:
+                client.close()
+            return
+        mongo_client, db = client, database
+        users_collection, referrals_collection = users, referrals
+        broadcast_runs_collection, deliveries_collection = broadcast_runs, deliveries
+        horoscopes_collection = horoscopes
+        storage.bind(fsm_collection)
+        logger.info(f"MongoDB успешно подключен к базе данных '{config.mongo_db_name}'")
+        if horoscopes is not None:
+            logger.info(f"Общий кэш гороскопов: коллекция '{HOROSCOPE_CACHE_COLLECTION}'")
+        if MONGO_WARMUP_CONNECTIONS:
+            try:
+                await warm_up_mongodb(MONGO_WARMUP_CONNECTIONS)
+            except Exception as e:
+                # Пул все равно откроет соединения по требованию
+                logger.warning(f"Не удалось прогреть пул MongoDB: {e}")
     else:
         logger.warning("MONGO_URI не установлен. Бот будет работать без сохранения пользовательских данных в MongoDB.")
 
 
+async def warm_up_mongodb(connections: int):
+    """Открывает соединения пула заранее, чтобы первые апдейты не ждали TCP/TLS-рукопожатий."""
+    started = time.monotonic()
+    # Одновременные ping не могут выполниться на одном соединении, поэтому пул откроет несколько
+    await asyncio.gather(*(db.command("ping") for _ in range(connections)))
+    logger.info(f"Пул MongoDB прогрет: {pool_listener.open_connections} соединений за {time.monotonic() - started:.2f} с")
+
+
+# --- Схема коллекции пользователей ---
+# Индексы под запросы к users: сегменты рассылки по знаку и языку, дата последней доставки, рефералы
+USER_INDEXES = ("sign", "lang", "last_delivered", "referrer_id")
+
+
+async def _migrate_string_ids() -> dict:
+    """Переносит профили со строковым _id на числовой id пользователя Telegram.
+
+    Раньше update_user_data и /start писали id строкой, а get_user_data читал числом и
+    промахивался. Миграция идет в фоне, когда бот уже принимает апдейты, и числовой профиль
+    мог появиться или измениться за это время, поэтому поля строкового профиля лишь дополняют
+    числовой: при совпадении выигрывает числовой. Чекпоинты рассылки и referrer_id в профилях
+    переводятся на числа так же.
+    """
+    moved = 0
+    while True:
+        docs = await users_collection.find({"_id": {"$regex": r"^\d+$"}}).limit(MIGRATION_BATCH_SIZE).to_list(None)
+        if not docs:
+            break
+        operations = []
+        for doc in docs:
+            old_id = doc.pop("_id")
+            new_id = int(old_id)
+            # Числового профиля нет — он создается из строкового целиком; есть — получает только
+            # недостающие поля. Сначала слияние, потом удаление: ordered=True не удалит строку,
+            # если слияние не прошло
+            operations.append(UpdateOne({"_id": new_id}, {"$setOnInsert": doc}, upsert=True))
+            operations.extend(UpdateOne({"_id": new_id, field: {"$exists": False}}, {"$set": {field: value}})
+                              for field, value in doc.items())
+            operations.append(DeleteOne({"_id": old_id}))
+        await users_collection.bulk_write(operations, ordered=True)
+        moved += len(docs)
+    runs = 0
+    async for run in broadcast_runs_collection.find({"last_user_id": {"$regex": r"^\d+$"}}, {"last_user_id": 1}):
+        await broadcast_runs_collection.update_one({"_id": run["_id"]}, {"$set": {"last_user_id": int(run["last_user_id"])}})
+        runs += 1
+    referrers = await _migrate_string_referrer_ids()
+    return {"users": moved, "runs": runs, **referrers}
+
+
+async def _migrate_string_referrer_ids() -> dict:
+    """Переводит строковые referrer_id в профилях на числа: start и referrer_exists сравнивают числа.
+
+    Отдельная миграция — для баз, где users_int_ids уже выполнена без этого шага.
+    """
+    converted = 0
+    operations = []
+    cursor = users_collection.find({"referrer_id": {"$regex": r"^\d+$"}}, {"referrer_id": 1}, batch_size=MIGRATION_BATCH_SIZE)
+    async for doc in cursor:
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"referrer_id": int(doc["referrer_id"])}}))
+        if len(operations) >= MIGRATION_BATCH_SIZE:
+            await users_collection.bulk_write(operations, ordered=False)
+            converted += len(operations)
+            operations = []
+    if operations:
+        await users_collection.bulk_write(operations, ordered=False)
+        converted += len(operations)
+    return {"referrer_ids": converted}
+
+
+async def _migrate_embedded_referrals() -> dict:
+    """Переносит массивы referrals из документов рефереров в коллекцию referrals."""
+    links = 0
+    now = datetime.now()
+    async for doc in users_collection.find({"referrals.0": {"$exists": True}}, {"referrals": 1}):
+        docs = [
+            {"_id": int(user_id), "referrer_id": doc["_id"], "created_at": now}
+            for user_id in doc["referrals"] if str(user_id).isdigit()
+        ]
+        # Массив без числовых id: insert_many([]) падает не BulkWriteError, а InvalidOperation
+        if not docs:
+            continue
+        try:
+            await referrals_collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        links += len(docs)
+    await users_collection.update_many({"referrals": {"$exists": True}}, {"$unset": {"referrals": ""}})
+    return {"links": links}
+
+
+async def backfill_birth_dates() -> dict:
+    """Записывает birth_ymd (и sign, если его нет) во все профили, где их не хватает.
+
+    Профили читаются одним курсором в порядке _id и обновляются пачками bulk_write по
+    MIGRATION_BATCH_SIZE. birth_ymd = 0 помечает дату в неверном формате, чтобы ее не
+    пытались разобрать снова. Профиль без знака получает знак по дате рождения (или aries,
+    как и раньше без даты) — гороскоп таких профилей при этом может измениться.
+    Можно запускать и вручную: python astro.py --backfill-birth-dates
+    """
+    query = {"$or": [
+        {"birth_date": {"$nin": [None, ""]}, "birth_ymd": {"$exists": False}},
+        {"sign": {"$exists": False}},
+    ]}
+    cursor = users_collection.find(
+        query, projection={"birth_date": 1, "birth_ymd": 1, "sign": 1},
+        batch_size=MIGRATION_BATCH_SIZE, sort=[("_id", 1)]
+    )
+    updated = invalid = 0
+    operations = []
+    async for doc in cursor:
+        fields = {}
+        birth_ymd = HoroscopeGenerator.birth_ymd(doc)
+        if birth_ymd is not None and "birth_ymd" not in doc:
+            fields["birth_ymd"] = birth_ymd
+            invalid += birth_ymd == 0
+        if "sign" not in doc:
+            fields["sign"] = HoroscopeGenerator.sign_from_ymd(birth_ymd) if birth_ymd else "aries"
+        if fields:
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+        if len(operations) >= MIGRATION_BATCH_SIZE:
+            await users_collection.bulk_write(operations, ordered=False)
+            updated += len(operations)
+            operations = []
+    if operations:
+        await users_collection.bulk_write(operations, ordered=False)
+        updated += len(operations)
+    return {"users": updated, "invalid_birth_dates": invalid}
+
+
+# Миграции выполняются по порядку и один раз; каждая идемпотентна, так что
+# одновременный запуск на двух воркерах ничего не портит
+MIGRATIONS = (
+    ("users_int_ids", _migrate_string_ids),
+    ("users_int_referrer_ids", _migrate_string_referrer_ids),
+    ("referrals_collection", _migrate_embedded_referrals),
+    ("users_birth_ymd", backfill_birth_dates),
+)
+
+
+async def pending_migrations() -> list[str]:
+    """Миграции из MIGRATIONS, которые еще не записаны в SCHEMA_COLLECTION."""
+    applied = {doc["_id"] async for doc in db[SCHEMA_COLLECTION].find({}, {"_id": 1})}
+    return [name for name, _ in MIGRATIONS if name not in applied]
+
+
+async def check_schema() -> list[str]:
+    """Проверка схемы при старте: только читает список выполненных миграций, коллекции не сканирует."""
+    if users_collection is None:
+        return []
+    pending = await pending_migrations()
+    if pending:
+        logger.warning(f"Схема MongoDB отстает, миграции {pending} выполнятся в фоне после старта "
+                       f"(или вручную: python astro.py --migrate)")
+    return pending
+
+
+async def migrate_schema() -> dict:
+    """Выполняет недостающие миграции, создает индексы users и пишет в лог статистику индексов.
+
+    Миграции проходят по всей коллекции users, поэтому при старте бота они идут в фоне после
+    установки вебхука (бот тем временем работает на старой схеме), а вручную — python astro.py --migrate.
+    """
+    if users_collection is None:
+        return {}
+    migrations_collection = db[SCHEMA_COLLECTION]
+    results = {}
+    pending = await pending_migrations()
+    for name, migrate in MIGRATIONS:
+        if name not in pending:
+            continue
+        logger.info(f"Выполняю миграцию схемы {name}...")
+        started = time.monotonic()
+        results[name] = result = await migrate()
+        await migrations_collection.update_one(
+            {"_id": name}, {"$set": {"applied_at": datetime.now(), "result": result}}, upsert=True
+        )
+        logger.info(f"Миграция {name} выполнена за {time.monotonic() - started:.1f} с: {result}")
+    for field in USER_INDEXES:
+        await users_collection.create_index(field)
+
+    try:
+        usage = await index_usage()
+    except Exception as e:
+        # $indexStats доступен не на всех тарифах хостинга MongoDB
+        logger.warning(f"Не удалось получить статистику индексов: {e}")
+        return results
+    for collection_name, indexes in usage.items():
+        unused = [name for name, ops in indexes.items() if ops == 0]
+        logger.info(f"Индексы {collection_name}: {indexes}" + (f", не используются: {unused}" if unused else ""))
+    return results
+
+
+async def migrate_schema_in_background():
+    try:
+        await migrate_schema()
+    except Exception as e:
+        # Бот продолжит работу на старой схеме; миграция повторится при следующем старте
+        logger.error(f"Ошибка миграции схемы MongoDB: {e}", exc_info=True)
+
+
+async def index_usage() -> Dict[str, Dict[str, int]]:
+    """Число обращений к каждому индексу с момента запуска сервера MongoDB ($indexStats)."""
+    report = {}
+    collections = (users_collection, referrals_collection, deliveries_collection, broadcast_runs_collection, horoscopes_collection)
+    for collection in collections:
+        if collection is None:
+            continue
+        stats = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        report[collection.name] = {index["name"]: index["accesses"]["ops"] for index in stats}
+    return report
+
+# --- Отложенная пакетная запись ---
+class DeferredFlush:
+    """Вызывает flush владельца через interval секунд после первого изменения.
+
+    Изменения, пришедшие, пока flush ждет MongoDB, в текущий пакет уже не попадут: если после
+    записи pending() все еще True, запись планируется снова, а не ждет следующего изменения.
+    """
+    __slots__ = ("flush", "pending", "interval", "_task")
+
+    def __init__(self, flush: Callable[[], Awaitable[None]], pending: Callable[[], bool], interval: float):
+        self.flush = flush
+        self.pending = pending
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    def schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        # Задача унаследовала контекст апдейта, который ее запустил: пакетная запись
+        # не должна попадать в его счетчики запросов к БД
+        current_scope.set(None)
+        await asyncio.sleep(self.interval)
+        try:
+            await self.flush()
+        finally:
+            self._task = None
+        if self.pending():
+            self.schedule()
+
+    async def wait(self):
+        """Дожидается запланированных записей (при закрытии)."""
+        while self._task is not None and not self._task.done():
+            await self._task
+
+
+# --- Хранилище состояний FSM в MongoDB ---
+class MongoStorage(BaseStorage):
+    """FSM-хранилище в MongoDB с кэшем в памяти процесса и пакетной записью.
+
+    Состояния переживают передеплой и видны всем воркерам за вебхуком. Найденные состояния
+    кэшируются на cache_ttl секунд, отсутствие состояния — на miss_ttl: у большинства апдейтов
+    состояния нет, и aiogram спрашивает его несколько раз за апдейт. Свои записи процесс читает
+    из кэша сразу; чужие изменения он увидит не позже чем через cache_ttl секунд.
+    Записи копятся flush_interval секунд и уходят в MongoDB одним bulk_write, поэтому
+    set_state и set_data в одном обработчике превращаются в одну запись. Пока коллекция
+    не привязана (MongoDB не подключена), хранилище работает только в памяти.
+    """
+
+    def __init__(self, cache_ttl: float = FSM_CACHE_TTL, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 max_cache_size: int = FSM_CACHE_MAX_SIZE, miss_ttl: float = FSM_MISS_CACHE_TTL):
+        self.cache_ttl = cache_ttl
+        self.miss_ttl = miss_ttl
+        self.flush_interval = flush_interval
+        self.max_cache_size = max_cache_size
+        self.collection = None
+        # ключ -> (время загрузки, состояние, данные)
+        self._cache: OrderedDict[str, tuple[float, str | None, dict]] = OrderedDict()
+        self._dirty: set[str] = set()
+        self._flusher = DeferredFlush(self.flush, lambda: bool(self._dirty), flush_interval)
+
+    def bind(self, collection):
+        self.collection = collection
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+    def _remember(self, key: str, state: str | None, data: dict):
+        self._cache[key] = (time.monotonic(), state, data)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cache_size:
+            oldest = next(iter(self._cache))
+            if oldest in self._dirty:
+                break
+            del self._cache[oldest]
+
+    async def _load(self, key: str) -> tuple[str | None, dict]:
+        entry = self._cache.get(key)
+        if entry is not None and (
+            self.collection is None or key in self._dirty
+            or time.monotonic() - entry[0] < (self.cache_ttl if entry[1] is not None or entry[2] else self.miss_ttl)
+        ):
+            return entry[1], entry[2]
+        if self.collection is None:
+            return None, {}
+        doc = await self.collection.find_one({"_id": key})
+        state, data = (doc.get("state"), doc.get("data") or {}) if doc else (None, {})
+        self._remember(key, state, data)
+        return state, data
+
+    def _write(self, key: str, state: str | None, data: dict):
+        entry = self._cache.get(key)
+        if entry is not None and entry[1] == state and entry[2] == data:
+            # Повторный set_state в то же состояние (например, в start) не требует записи
+            self._cache.move_to_end(key)
+            return
+        self._remember(key, state, data)
+        if self.collection is None:
+            return
+        self._dirty.add(key)
+        self._flusher.schedule()
+
+    async def flush(self):
+        """Записывает в MongoDB все накопленные изменения одним bulk_write."""
+        if not self._dirty or self.collection is None:
+            return
+        keys, self._dirty = self._dirty, set()
+        now = datetime.now()
+        operations = []
+        for key in keys:
+            _, state, data = self._cache[key]
+            if state is None and not data:
+                operations.append(DeleteOne({"_id": key}))
+            else:
+                operations.append(ReplaceOne({"_id": key}, {"state": state, "data": data, "updated_at": now}, upsert=True))
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Ошибка записи состояний FSM в MongoDB: {e}", exc_info=True)
+            # Ключи снова грязные: DeferredFlush повторит запись следующим пакетом
+            self._dirty |= keys
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        _, data = await self._load(storage_key)
+        self._write(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        state, _ = await self._load(storage_key)
+        self._write(storage_key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return data.copy()
+
+    async def close(self) -> None:
+        await self._flusher.wait()
+        await self.flush()
+
+
 # Инициализация бота и диспетчера
-# Используем MemoryStorage для хранения состояний FSM
-storage = MemoryStorage()
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=storage)
+# Состояния FSM хранятся в MongoDB (см. MongoStorage), коллекция привязывается в init_mongodb
+storage = MongoStorage()
+# Обработчики регистрируются на роутере; бот и диспетчер создаются в create_app
+router = Router()
+bot: Bot | None = None
+dp: Dispatcher | None = None
+
+
+def _orjson_dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+
+def make_bot_session() -> AiohttpSession:
+    """HTTP-сессия бота. С orjson быстрее разбираются апдейты вебхука и ответы Bot API."""
+    if orjson is None:
+        return AiohttpSession()
+    return AiohttpSession(json_loads=orjson.loads, json_dumps=_orjson_dumps)
+
+
+def create_app(app_config: Config, session: BaseSession | None = None) -> tuple[Bot, Dispatcher]:
+    """Проверяет конфиг и создает бота и диспетчер (глобальные config, bot и dp).
+
+    При импорте модуля ничего из этого не происходит, поэтому astro можно импортировать
+    без секретов — например, в бенчмарке.
+    """
+    global config, bot, dp
+    app_config.validate()
+    config = app_config
+    bot = Bot(token=config.bot_token, session=session or make_bot_session())
+    bot.session.middleware(api_metrics)
+    dp = Dispatcher(storage=storage)
+    # Метрики снаружи, чтобы в замер попали загрузка и сохранение профиля
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.update.outer_middleware(UserDataMiddleware())
+    previous = router.parent_router
+    if previous is not None:
+        # Обработчики объявлены на общем router, а aiogram не дает подключить его ко второму
+        # диспетчеру: отцепляем его от диспетчера прошлого вызова create_app
+        previous.sub_routers.remove(router)
+        router._parent_router = None
+    dp.include_router(router)
+    return bot, dp
+
 
 # Состояния для FSM (Finite State Machine)
 class Form(StatesGroup):
@@ -98,446 +860,717 @@ class Form(StatesGroup):
     select_language = State() # Это состояние не используется напрямую, но пусть будет
     magic_ball_answer = State()
 
-# --- Тексты для разных языков (теперь только русский) ---
-TEXTS = {
-    "ru": {
-        "welcome": "✨ Добро пожаловать в <b>Cosmic Insight</b> - ваш личный астрологический компаньон!\n\n"
-                   "Получайте свой ежедневный гороскоп и небесное руководство.",
-        "main_menu_horoscope": "🌟 Получить гороскоп",
-        "main_menu_settings": "⚙️ Настройки",
-        "main_menu_support": "❤️ Поддержать нас",
-        "main_menu_entertainment": "🎲 Развлечения",
-        "support_us_prompt": "💎 Поддержите наш проект!\n\n"
-                             "Пожалуйста, отправьте <b>любую сумму TON</b> на адрес:\n"
-                             "<code>{wallet}</code>\n\n"
-                             "Для этого:\n"
-                             "1. Нажмите кнопку 'Открыть @wallet'.\n"
-                             "2. В боте @wallet выберите 'Отправить'.\n"
-                             "3. Вставьте указанный выше адрес.\n"
-                             "4. Введите желаемую сумму.",
-        "settings_menu_choose": "Выберите, что хотите настроить:",
-        "settings_change_sign": "Изменить знак зодиака",
-        "settings_set_birth_date": "Указать дату рождения",
-        "settings_change_language": "Изменить язык",
-        "choose_sign": "Выберите ваш знак зодиака:",
-        "sign_set_success": "✅ Ваш знак зодиака установлен как <b>{sign}</b>.",
-        "sign_changed_answer": "Знак зодиака изменен!",
-        "donate_open_wallet": "Открыть @wallet",
-        "donate_closed": "Окно доната закрыто.",
-        "birth_date_prompt": "Пожалуйста, введите вашу дату рождения в формате ДД.ММ.ГГГГ:",
-        "birth_date_invalid_format": "Неверный формат даты. Пожалуйста, введите в формате ДД.ММ.ГГГГ (например, 01.01.2000).",
-        "birth_date_future_error": "Дата рождения не может быть в будущем. Пожалуйста, введите корректную дату.",
-        "birth_date_success": "✅ Ваша дата рождения <b>{birth_date}</b> успешно сохранена!",
-        "birth_date_changed_answer": "Дата рождения сохранена!",
-        "choose_language_prompt": "Выберите язык:",
-        "language_set_success": "✅ Язык успешно изменен на <b>{lang_name}</b>.",
-        "language_changed_answer": "Язык изменен!",
-        "ad_text": "✨ <b>Специальное предложение от нашего партнера</b> ✨\n\n"
-                   "Ознакомьтесь с этим удивительным продуктом!",
-        "ad_button": "Посетить спонсора",
-        "horoscope_title": "{emoji} <b>Ваш ежедневный гороскоп</b>",
-        "horoscope_sign": "🔮 Знак Зодиака: {sign} ({element})",
-        "horoscope_date": "📅 Дата: {date}",
-        "horoscope_age": "🎂 Вам {age} {years}!",
-        "horoscope_mood": "🌈 Настроение дня: <b>{mood}</b>",
-        "horoscope_lucky_color": "🍀 Счастливый цвет: <b>{color}</b>",
-        "horoscope_lucky_number": "🔢 Число удачи: <b>{number}</b>",
-        "horoscope_ruling_planet": "🪐 Планета-покровитель: <b>{planet}</b>",
-        "horoscope_lucky_stone": "💎 Камень удачи: <b>{stone}</b>",
-        "horoscope_compatibility": "💞 Совместимость: <b>{compatible_signs}</b>",
-        "horoscope_tip": "💡 <b>Совет дня:</b> {tip}",
-        "horoscope_love": "💖 Любовь",
-        "horoscope_career": "💼 Карьера",
-        "horoscope_finance": "💰 Финансы",
-        "horoscope_health": "🏥 Здоровье",
-        "horoscope_closing_message": "Помните, звезды лишь намекают, а выбор всегда за вами! Желаем вам волшебного дня! ✨",
-        "years_singular": "год",
-        "years_plural_2_4": "года",
-        "years_plural_5_plus": "лет",
-        "compatibility_not_defined": "Не определена",
-        "horoscope_tips": [
-            "Доверьтесь своей интуиции; она приведет вас к правильному решению.",
-            "Сегодня отличный день для новых начинаний и смелых идей.",
-            "Обратите внимание на детали — в них кроется ключ к успеху.",
-            "Постарайтесь провести время с близкими; это принесет вам радость.",
-            "Не бойтесь рисковать, но делайте это мудро и осознанно.",
-            "Сосредоточьтесь на своих целях, и вы достигнете желаемого.",
-            "Практикуйте благодарность – это привлечет больше позитива в вашу жизнь.",
-            "Найдите время для отдыха и восстановления, это важно для вашего благополучия."
-        ],
-        # Переводы для знаков зодиака, элементов, планет, камней
-        "sign_aries": "Овен", "sign_taurus": "Телец", "sign_gemini": "Близнецы", "sign_cancer": "Рак",
-        "sign_leo": "Лев", "sign_virgo": "Дева", "sign_libra": "Весы", "sign_scorpio": "Скорпион",
-        "sign_sagittarius": "Стрелец", "sign_capricorn": "Козерог", "sign_aquarius": "Водолей", "sign_pisces": "Рыбы",
-        
-        "element_fire": "Огонь", "element_earth": "Земля", "element_air": "Воздух", "element_water": "Вода",
+# --- Кэш профилей пользователей ---
+class UserCache:
+    """Ограниченный LRU-кэш профилей пользователей с TTL для каждой записи.
 
-        "planet_mars": "Марс", "planet_venus": "Венера", "planet_mercury": "Меркурий", "planet_moon": "Луна",
-        "planet_sun": "Солнце", "planet_pluto": "Плутон", "planet_jupiter": "Юпитер", "planet_saturn": "Сатурн",
-        "planet_uranus": "Уран", "planet_neptune": "Нептун", "planet_crystal": "Кристалл (по умолчанию)", # для камня
-        
-        "stone_diamond": "Алмаз", "stone_emerald": "Изумруд", "stone_agate": "Агат", "stone_pearl": "Жемчуг",
-        "stone_ruby": "Рубин", "stone_sapphire": "Сапфир", "stone_opal": "Опал", "stone_topaz": "Топаз",
-        "stone_turquoise": "Бирюза", "stone_garnet": "Гранат", "stone_amethyst": "Аметист", "stone_aquamarine": "Аквамарин",
-
-        # Развлекательные функции
-        "entertainment_menu_choose": "Выберите развлечение:",
-        "cookie_button": "🍪 Печенье с предсказанием",
-        "magic_ball_button": "🔮 Шар с ответами",
-        "cookie_fortune_message": "🍪 Ваше предсказание: <b>{fortune}</b>",
-        "magic_ball_question_prompt": "🔮 Задайте свой вопрос Шару (он ответит 'да' или 'нет'):",
-        "magic_ball_answer_message": "🔮 Ответ Шара: <b>{answer}</b>",
-        "magic_ball_not_a_question": "Пожалуйста, задайте вопрос."
-    }
-}
+    Ключ всегда приводится к int (id пользователя Telegram), независимо от того,
+    передан ли id строкой или числом. Закрепленные записи (pinned) не истекают
+    и не вытесняются: без MongoDB кэш — единственное хранилище профиля.
+    """
+
+    # Срок жизни закрепленной записи
+    PINNED = float("inf")
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+        self._pinned = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
-# Текст для кнопки "Поделиться ботом"
-SHARE_MESSAGE_RU = "🔮 Хочешь узнать, что ждет тебя сегодня по звездам? Получай свой личный гороскоп каждый день с Cosmic Insight! Это не просто общие фразы, а глубокий взгляд в твою судьбу. Присоединяйся и исследуй свой космический путь! ✨\n\n[Ссылка на бота]"
+    @staticmethod
+    def key(user_id) -> int:
+        return int(user_id)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id) -> dict | None:
+        key = self.key(user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, data = entry
+        if expires_at < time.monotonic():
+            # Истекшая запись остается до вытеснения: она пригодится get_stale, если MongoDB недоступна
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def get_stale(self, user_id) -> dict | None:
+        """Возвращает запись без учета TTL (запасной вариант, когда MongoDB недоступна)."""
+        entry = self._entries.get(self.key(user_id))
+        return entry[1] if entry is not None else None
+
+    def set(self, user_id, data: dict, pinned: bool = False):
+        key = self.key(user_id)
+        self._forget(key)
+        if pinned:
+            self._pinned += 1
+        self._entries[key] = (self.PINNED if pinned else time.monotonic() + self.ttl, data)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _forget(self, key: int):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[0] == self.PINNED:
+            self._pinned -= 1
+
+    def _evict(self):
+        """Вытесняет самые старые незакрепленные записи сверх max_size."""
+        excess = len(self._entries) - self.max_size
+        if excess <= 0 or self._pinned >= len(self._entries):
+            return
+        victims = []
+        for key, (expires_at, _) in self._entries.items():
+            if expires_at != self.PINNED:
+                victims.append(key)
+                if len(victims) == excess:
+                    break
+        for key in victims:
+            del self._entries[key]
+            self.evictions += 1
+
+    def update(self, user_id, fields: dict) -> bool:
+        """Обновляет поля закэшированного профиля. Возвращает False, если профиля нет в кэше."""
+        entry = self._entries.get(self.key(user_id))
+        if entry is None:
+            return False
+        entry[1].update(fields)
+        return True
+
+    def invalidate(self, user_id):
+        self._forget(self.key(user_id))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "pinned": self._pinned,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+user_cache = UserCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL)
 
 
-# --- Вспомогательная функция для получения текста на нужном языке ---
-# Теперь она должна получать данные пользователя из БД
-# Если MongoDB не подключена, используем In-memory хранилище для пользователей
-_user_data_cache = {} # Простой in-memory кэш для пользовательских данных
+def default_user_data(user_id: int) -> dict:
+    return {"_id": user_id, "sign": "aries", "lang": "ru", "birth_date": None}
+
+
+async def find_user_data(user_id: int) -> dict | None:
+    """Ищет профиль в кэше, а при промахе — в MongoDB. None, если профиля нет.
+
+    Если MongoDB недоступна или отвечает дольше MONGO_READ_TIMEOUT_MS, отдает устаревшую
+    запись кэша (если есть), а mongo_breaker на время перестает обращаться к базе.
+    """
+    user_data = user_cache.get(user_id)
+    if user_data is not None:
+        return user_data
+    if users_collection is None:
+        return None
+    if not mongo_breaker.allow():
+        return user_cache.get_stale(user_id)
+    try:
+        user_data = await asyncio.wait_for(users_collection.find_one({"_id": user_id}), MONGO_READ_TIMEOUT_MS / 1000)
+    except (asyncio.TimeoutError, PyMongoError) as e:
+        mongo_breaker.record_failure()
+        logger.warning(f"Не удалось прочитать профиль {user_id} из MongoDB ({type(e).__name__}), беру данные из кэша.")
+        return user_cache.get_stale(user_id)
+    mongo_breaker.record_success()
+    if user_data:
+        user_cache.set(user_id, user_data)
+    return user_data or None
+
 
 async def get_user_data(user_id: int):
-    """Получает данные пользователя из MongoDB или из кэша."""
-    if users_collection is not None: # Corrected line
-        user_data = await users_collection.find_one({"_id": user_id})
-        if user_data:
-            _user_data_cache[user_id] = user_data # Обновляем кэш из БД
-            return user_data
-    # Если MongoDB не подключена или пользователь не найден в БД, ищем в кэше
-    return _user_data_cache.get(user_id, {"_id": user_id, "sign": "aries", "lang": "ru", "birth_date": None})
+    """Получает данные пользователя из кэша, а при промахе — из MongoDB."""
+    user_data = await find_user_data(user_id)
+    # MongoDB не подключена или пользователь не найден в БД
+    return user_data if user_data is not None else default_user_data(user_id)
 
-async def update_user_data(user_id: int, key: str, value):
-    """Обновляет данные пользователя в MongoDB и в кэше."""
-    user_id_str = str(user_id)
-    # Обновляем кэш
-    current_data = _user_data_cache.get(user_id_str, {"_id": user_id_str, "sign": "aries", "lang": "ru", "birth_date": None})
-    current_data[key] = value
-    _user_data_cache[user_id_str] = current_data
+
+async def update_user_fields(user_id: int, fields: dict):
+    """Записывает несколько полей профиля одним update_one и обновляет кэш (write-through)."""
+    if not fields:
+        return
 
     if users_collection is not None:
-        await users_collection.update_one(
-            {"_id": user_id_str},
-            {"$set": {key: value}},
-            upsert=True
-        )
+        await users_collection.update_one({"_id": user_id}, {"$set": fields}, upsert=True)
+        # Неполный профиль в кэш не кладем: его дочитает следующий get_user_data
+        user_cache.update(user_id, fields)
     else:
-        logger.warning(f"MongoDB коллекция не инициализирована, данные пользователя {user_id_str} будут сохранены только в памяти.")
+        # Без MongoDB профиль живет только в кэше, поэтому запись закрепляется и не истекает
+        user_data = user_cache.get_stale(user_id) or default_user_data(user_id)
+        user_cache.set(user_id, {**user_data, **fields}, pinned=True)
+        logger.warning(f"MongoDB коллекция не инициализирована, данные пользователя {user_id} будут сохранены только в памяти.")
+
+
+async def update_user_data(user_id: int, key: str, value):
+    """Обновляет одно поле профиля. Для нескольких полей используйте update_user_fields."""
+    await update_user_fields(user_id, {key: value})
+
+
+# --- Регистрация пользователей из /start ---
+# Кэш проверок существования реферера: {"_id": id} для найденного, {} для отсутствующего
+referrer_cache = UserCache(REFERRER_CACHE_MAX_SIZE, REFERRER_CACHE_TTL)
+
+
+async def referrer_exists(referrer_id: str) -> bool:
+    """Проверяет, что реферер зарегистрирован. Ответ кэшируется в referrer_cache."""
+    if not referrer_id.isdigit():
+        return False
+    cached = referrer_cache.get(referrer_id)
+    if cached is None:
+        cached = await users_collection.find_one({"_id": int(referrer_id)}, {"_id": 1}) or {}
+        referrer_cache.set(referrer_id, cached)
+    return bool(cached)
+
+
+class RegistrationBatcher:
+    """Микропакеты регистраций для всплесков /start.
+
+    Профили новых пользователей ($setOnInsert) и реферальные связи копятся до flush_interval
+    секунд или max_batch пользователей и уходят в MongoDB двумя bulk-запросами с ordered=False.
+    register() возвращает управление, когда пакет с этой регистрацией записан.
+    """
+
+    def __init__(self, max_batch: int = REGISTRATION_BATCH_SIZE, flush_interval: float = REGISTRATION_FLUSH_INTERVAL):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._profiles: dict[int, dict] = {}
+        self._referrals: dict[int, dict] = {}
+        self._waiters: list[asyncio.Future] = []
+        self._flusher = DeferredFlush(self.flush, lambda: bool(self._waiters), flush_interval)
+        self.batches = 0
+        self.registrations = 0
+
+    async def register(self, user_id: int, profile: dict, referrer_id: int | None = None):
+        """Ставит в очередь создание профиля (если его еще нет) и реферальную связь."""
+        # Как и $setOnInsert, при повторе в одном пакете выигрывает первая запись
+        self._profiles.setdefault(user_id, profile)
+        if referrer_id is not None:
+            self._referrals.setdefault(user_id, {"_id": user_id, "referrer_id": referrer_id, "created_at": datetime.now()})
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if len(self._profiles) >= self.max_batch:
+            await self.flush()
+        else:
+            self._flusher.schedule()
+        await waiter
+
+    async def flush(self):
+        """Записывает накопленный пакет и будит всех, кто его ждет."""
+        if not self._waiters:
+            return
+        profiles, self._profiles = self._profiles, {}
+        referrals, self._referrals = self._referrals, {}
+        waiters, self._waiters = self._waiters, []
+        try:
+            if profiles:
+                await users_collection.bulk_write(
+                    [UpdateOne({"_id": key}, {"$setOnInsert": profile}, upsert=True) for key, profile in profiles.items()],
+                    ordered=False
+                )
+            if referrals:
+                try:
+                    await referrals_collection.insert_many(list(referrals.values()), ordered=False)
+                except BulkWriteError as e:
+                    # Дубликат — пользователя уже кто-то пригласил; остальные связи записаны
+                    if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                        raise
+        except Exception as e:
+            logger.error(f"Ошибка записи пакета регистраций ({len(profiles)} польз.): {e}", exc_info=True)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+        self.batches += 1
+        self.registrations += len(profiles)
+        for key in profiles:
+            # Только что зарегистрированный пользователь сразу может приглашать других
+            referrer_cache.set(key, {"_id": key})
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def close(self):
+        await self._flusher.wait()
+        await self.flush()
 
 
-# Функция get_text теперь должна быть асинхронной, чтобы получить язык пользователя
+registrations = RegistrationBatcher()
+
+
+# Для обработчиков есть UserContext.text; эта функция нужна там, где контекста нет
 async def get_text_async(user_id: int, key: str) -> str:
     user_data = await get_user_data(user_id)
-    lang = user_data.get("lang", "ru")
-    return TEXTS.get(lang, TEXTS["ru"]).get(key, f"_{key}_")
-
-# Генератор гороскопов
-class HoroscopeGenerator:
-    SIGNS = {
-        "aries": {"emoji": "♈️", "element_key": "element_fire", "character": ["энергичный", "смелый", "импульсивный"], "planet_key": "planet_mars", "lucky_number": [9], "lucky_stone_key": "stone_diamond"},
-        "taurus": {"emoji": "♉️", "element_key": "element_earth", "character": ["стабильный", "терпеливый", "упрямый"], "planet_key": "planet_venus", "lucky_number": [6], "lucky_stone_key": "stone_emerald"},
-        "gemini": {"emoji": "♊️", "element_key": "element_air", "character": ["адаптивный", "любопытный", "нерешительный"], "planet_key": "planet_mercury", "lucky_number": [5], "lucky_stone_key": "stone_agate"},
-        "cancer": {"emoji": "♋️", "element_key": "element_water", "character": ["заботливый", "эмоциональный", "защитник"], "planet_key": "planet_moon", "lucky_number": [2], "lucky_stone_key": "stone_pearl"},
-        "leo": {"emoji": "♌️", "element_key": "element_fire", "character": ["уверенный", "щедрый", "властный"], "planet_key": "planet_sun", "lucky_number": [1], "lucky_stone_key": "stone_ruby"},
-        "virgo": {"emoji": "♍️", "element_key": "element_earth", "character": ["аналитический", "практичный", "критичный"], "planet_key": "planet_mercury", "lucky_number": [5], "lucky_stone_key": "stone_sapphire"},
-        "libra": {"emoji": "♎️", "element_key": "element_air", "character": ["гармоничный", "дипломатичный", "нерешительный"], "planet_key": "planet_venus", "lucky_number": [6], "lucky_stone_key": "stone_opal"},
-        "scorpio": {"emoji": "♏️", "element_key": "element_water", "character": ["интенсивный", "страстный", "скрытный"], "planet_key": "planet_pluto", "lucky_number": [8], "lucky_stone_key": "stone_topaz"},
-        "sagittarius": {"emoji": "♐️", "element_key": "element_fire", "character": ["авантюрный", "оптимистичный", "беспокойный"], "planet_key": "planet_jupiter", "lucky_number": [3], "lucky_stone_key": "stone_turquoise"},
-        "capricorn": {"emoji": "♑️", "element_key": "element_earth", "character": ["дисциплинированный", "ответственный", "пессимистичный"], "planet_key": "planet_saturn", "lucky_number": [8], "lucky_stone_key": "stone_garnet"},
-        "aquarius": {"emoji": "♒️", "element_key": "element_air", "character": ["инновационный", "независимый", "безэмоциональный"], "planet_key": "planet_uranus", "lucky_number": [4], "lucky_stone_key": "stone_amethyst"},
-        "pisces": {"emoji": "♓️", "element_key": "element_water", "character": ["сострадательный", "артистичный", "склонный к эскапизму"], "planet_key": "planet_neptune", "lucky_number": [7], "lucky_stone_key": "stone_aquamarine"},
-    }
+    return CATALOG.get(user_data.get("lang", DEFAULT_LANG), key)
+
+
+# --- Контекст пользователя на время обработки одного апдейта ---
+class UserContext(LocalizedProfile):
+    """Данные пользователя, загруженные из БД один раз на апдейт.
+
+    Все локализованные строки берутся из памяти, без повторных запросов к MongoDB.
+    Изменения копятся через set() и записываются одним update_one
+    в flush(), который вызывает UserDataMiddleware после обработчика.
+    """
+    __slots__ = ("persisted", "_dirty")
+
+    def __init__(self, user_id: int, data: dict, persisted: bool = True):
+        super().__init__(user_id, data)
+        # False — профиль еще не сохранен в БД и data содержит значения по умолчанию
+        self.persisted = persisted
+        self._dirty = {}
+
+    @classmethod
+    async def load(cls, user_id: int) -> "UserContext":
+        user_data = await find_user_data(user_id)
+        if user_data is None:
+            return cls(user_id, default_user_data(user_id), persisted=False)
+        # Копия: set() не должен менять запись user_cache до успешной записи в БД,
+        # кэш обновит update_user_fields после update_one
+        return cls(user_id, dict(user_data))
+
+    def set(self, key: str, value) -> bool:
+        """Меняет поле локально и помечает его для записи. Возвращает False, если значение не изменилось."""
+        if self.persisted and key not in self._dirty and key in self.data and self.data[key] == value:
+            return False
+        self.data[key] = value
+        self._dirty[key] = value
+        return True
+
+    async def flush(self):
+        """Записывает накопленные изменения одним запросом."""
+        if not self._dirty:
+            return
+        fields, self._dirty = self._dirty, {}
+        await update_user_fields(self.user_id, fields)
+        self.persisted = True
+
+
+class UserDataMiddleware(BaseMiddleware):
+    """Загружает UserContext для каждого апдейта и передает его в обработчики как `user_ctx`."""
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        user_ctx = data["user_ctx"] = await UserContext.load(user.id)
+        try:
+            return await handler(event, data)
+        finally:
+            await user_ctx.flush()
 
-    MOODS = {
-        "ru": ["Оптимистичное", "Задумчивое", "Энергичное", "Спокойное", "Осторожное", "Радостное", "Вдохновленное", "Гармоничное", "Надежное"],
-    }
-    LUCKY_COLORS = {
-        "ru": ["Синий", "Зеленый", "Золотой", "Серебряный", "Красный", "Фиолетовый", "Розовый", "Желтый", "Бирюзовый", "Лавандовый"],
-    }
-    COMPATIBILITY = {
-        "aries": ["leo", "sagittarius", "gemini", "aquarius"], "taurus": ["virgo", "capricorn", "cancer", "pisces"],
-        "gemini": ["libra", "aquarius", "aries", "leo"], "cancer": ["scorpio", "pisces", "taurus", "virgo"],
-        "leo": ["aries", "sagittarius", "gemini", "libra"], "virgo": ["taurus", "capricorn", "cancer", "scorpio"],
-        "libra": ["gemini", "aquarius", "leo", "sagittarius"], "scorpio": ["cancer", "pisces", "virgo", "capricorn"],
-        "sagittarius": ["aries", "leo", "libra", "aquarius"], "capricorn": ["taurus", "virgo", "scorpio", "pisces"],
-        "aquarius": ["gemini", "libra", "aries", "sagittarius"], "pisces": ["cancer", "scorpio", "taurus", "capricorn"],
-    }
 
-    # Предсказания для "Печенья с предсказаниями"
-    COOKIE_FORTUNES = [
-        "Вас ждет неожиданная удача.",
-        "Прислушайтесь к своему внутреннему голосу.",
-        "Сегодня идеальный день для новых начинаний.",
-        "Ваша доброта будет вознаграждена.",
-        "Не бойтесь перемен, они к лучшему.",
-        "Вас ждет приятная встреча.",
-        "Сосредоточьтесь на своих мечтах.",
-        "Ваше упорство принесет плоды.",
-        "Найдите радость в мелочах.",
-        "Впереди вас ждет увлекательное приключение.",
-        "День принесет новые возможности.",
-        "Будьте открыты для новых идей."
-    ]
+# --- Метрики обработчиков и Bot API ---
+handler_metrics = HandlerMetrics()
 
-    # Ответы для "Шара с ответами"
-    MAGIC_BALL_ANSWERS = {
-        "positive": [
-            "Безусловно!", "Да.", "Весьма вероятно.", "Можете быть уверены в этом.", "Да, определенно.",
-            "Без сомнения.", "Как я вижу, да."
-        ],
-        "negative": [
-            "Мои источники говорят нет.", "Очень сомнительно.", "Не рассчитывайте на это.", "Нет.", "Перспективы не очень хорошие."
-        ],
-        "neutral": [
-            "Сконцентрируйся и спроси снова.", "Ответ неясен, попробуй еще раз.", "Лучше не говорить тебе сейчас.",
-            "Не могу предсказать сейчас."
-        ]
-    }
 
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware: время обработки апдейта целиком, включая загрузку и сохранение профиля.
 
-    @staticmethod
-    async def _generate_aspect_description(aspect: str, score: int, rng: random.Random, lang: str) -> str:
-        descriptions = {
-            TEXTS[lang]["horoscope_love"]: {
-                (8, 10): {
-                    "ru": ["✨ Сегодня ваша харизма на пике! Отличный день для романтических приключений и углубления связей. Откройтесь новым чувствам, и пусть ваша душа расцветет!",
-                           "💖 Сердце наполнено теплом и гармонией. Возможны приятные сюрпризы от близких или новые вдохновляющие знакомства. Позвольте себе быть счастливой!"]
-                },
-                (5, 7): {
-                    "ru": ["🌟 В любви ожидается стабильность. Не бойтесь проявлять инициативу, даже небольшие жесты внимания принесут радость и укрепят ваши отношения.",
-                           "❤️ Отношения требуют вашего нежного внимания. Проведите время с теми, кто вам дорог, и вы почувствуете прилив позитивной энергии и взаимопонимания."]
-                },
-                (3, 4): {
-                    "ru": ["⚠️ Будьте осторожны в словах, чтобы ненароком не ранить чувства близких. Небольшие недопонимания могут возникнуть, но их легко преодолеть искренним разговором и нежностью.",
-                           "💔 Возможны эмоциональные качели. Постарайтесь найти время для себя, чтобы восстановить внутренний баланс и обрести спокойствие."]
-                },
-                (1, 2): {
-                    "ru": ["🚨 Сегодня лучше избегать серьезных выяснений отношений. Сосредоточьтесь на саморазвитии и дайте себе время для глубоких размышлений и восстановления.",
-                           "😔 Могут возникнуть трудности в общении. Важно помнить, что каждый имеет право на свое мнение. Не принимайте все слишком близко к сердцу, сохраняйте внутренний покой."]
-                }
-            },
-            TEXTS[lang]["horoscope_career"]: {
-                (8, 10): {
-                    "ru": ["🚀 Ваша энергия и целеустремленность принесут невероятные плоды! Отличный день для новых проектов, важных переговоров и стремительного карьерного роста. Вселенная на вашей стороне!",
-                           "📈 Смело беритесь за самые сложные задачи — успех гарантирован. Ваша продуктивность сегодня поражает, и ваши усилия будут щедро вознаграждены!"]
-                },
-                (5, 7): {
-                    "ru": ["💼 Рабочие вопросы решаются без особых затруднений. Возможно, появятся новые, очень интересные предложения, которые стоит рассмотреть внимательнее.",
-                           "📚 Благоприятный период для обучения и повышения квалификации. Новые знания, полученные сегодня, обязательно пригодятся вам в будущем, открывая новые горизонны."]
-                },
-                (3, 4): {
-                    "ru": ["📉 Могут возникнуть небольшие препятствия или задержки. Сохраняйте спокойствие, доверяйте своему внутреннему голосу и тщательно планируйте свои действия, чтобы преодолеть их.",
-                           "⏳ Сегодня лучше сосредоточиться на рутинных задачах и не начинать ничего слишком амбициозного. Терпение и методичность принесут лучшие результаты."]
-                },
-                (1, 2): {
-                    "ru": ["🚧 Возможны разногласия с коллегами или начальством. Постарайтесь быть максимально дипломатичной и избегать конфликтов, чтобы сохранить гармонию.",
-                           "🙅‍♀️ День не подходит для принятия важных карьерных решений. Лучше отложить их на потом, когда звезды будут более благосклонны."]
-                }
-            },
-            TEXTS[lang]["horoscope_finance"]: {
-                (8, 10): {
-                    "ru": ["💰 Вас ждет финансовый успех! Возможно неожиданное поступление денег, очень выгодные инвестиции или удачные сделки. Доверьтесь своей интуиции!",
-                           "💸 Отличный день для планирования бюджета и крупных, давно желанных покупок. Ваше финансовое чутье сегодня обострено, используйте его мудро."]
-                },
-                (5, 7): {
-                    "ru": ["💳 Финансовая ситуация стабильна. Небольшие траты не повлияют на ваш бюджет. Возможно, стоит рассмотреть новые источники дохода, чтобы приумножить свои накопления.",
-                           "📈 Есть шанс найти очень выгодное предложение. Будьте внимательны к деталям и не упустите свою возможность."]
-                },
-                (3, 4): {
-                    "ru": ["📉 Сегодня стоит быть экономнее и внимательнее к расходам. Избегайте необдуманных трат и крупных покупок. Возможны непредвиденные, но управляемые расходы.",
-                           "🧐 Пересмотрите свои финансовые планы. Возможно, есть слабые места, требующие вашего пристального внимания и коррекции."]
-                }
-            },
-            TEXTS[lang]["horoscope_health"]: {
-                (8, 10): {
-                    "ru": ["🌸 Чувствуете себя полной энергии и жизненных сил! Отличный день для активного отдыха, спорта и начала новых здоровых привычек. Ваше тело благодарит вас!",
-                           "💪 Ваше самочувствие прекрасно. Это идеальный день для занятий, которые приносят вам физическое и ментальное удовольствие и наполняют вас радостью."]
-                },
-                (5, 7): {
-                    "ru": ["🌿 Здоровье в норме. Уделите внимание правильному питанию и умеренным физическим нагрузкам. Не забывайте о полноценном сне, он — ваш лучший помощник.",
-                           "💧 Пейте больше чистой воды и прислушивайтесь к сигналам своего тела. Оно всегда подскажет, что ему нужно."]
-                },
-                (3, 4): {
-                    "ru": ["😴 Возможна легкая усталость или снижение тонуса. Позвольте себе отдохнуть и избегайте переутомления. Возможно, стоит пересмотреть режим дня и добавить больше релаксации.",
-                           "🤒 Незначительные недомогания могут напомнить о себе. Дайте своему организму время на восстановление и не игнорируйте его потребности."]
-                }
-            }
-        }
-        for (min_score, max_score), desc_dict in descriptions[aspect].items():
-            if min_score <= score <= max_score:
-                return rng.choice(desc_dict["ru"])
-        return ""
+    Имя обработчика ставит HandlerNameMiddleware, запросы к MongoDB и Bot API считают
+    InstrumentedCollection и TelegramApiMetrics — все через UpdateScope текущего апдейта.
+    """
 
-    @staticmethod
-    def calculate_age(birth_date: datetime) -> int:
-        today = datetime.now()
-        age = today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
-        return age
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        scope = UpdateScope()
+        token = current_scope.set(scope)
+        started = time.monotonic()
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            current_scope.reset(token)
+            handler_metrics.observe(scope, (time.monotonic() - started) * 1000, failed)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренний middleware: записывает в UpdateScope имя выбранного обработчика."""
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        scope = current_scope.get()
+        if scope is not None:
+            scope.handler = data["handler"].callback.__name__
+        return await handler(event, data)
+
+
+router.message.middleware(HandlerNameMiddleware())
+router.callback_query.middleware(HandlerNameMiddleware())
+
+
+class TelegramApiMetrics(BaseRequestMiddleware):
+    """Middleware сессии бота: задержки и ошибки вызовов Bot API по методам."""
+
+    def __init__(self):
+        self.latency: Dict[str, LatencyHistogram] = {}
+        self.errors = Counter()
+
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        name = type(method).__name__
+        scope = current_scope.get()
+        if scope is not None:
+            scope.api_calls += 1
+        started = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self.errors[name] += 1
+            raise
+        finally:
+            histogram = self.latency.get(name)
+            if histogram is None:
+                histogram = self.latency.setdefault(name, LatencyHistogram())
+            histogram.observe((time.monotonic() - started) * 1000)
+
+    def write(self, out: PrometheusText):
+        for name, histogram in self.latency.items():
+            out.histogram("astrox_telegram_api_duration_seconds", "Задержка вызовов Bot API по методам",
+                          histogram, method=name)
+            out.counter("astrox_telegram_api_errors_total", "Вызовы Bot API, завершившиеся ошибкой",
+                        self.errors[name], method=name)
+
+
+api_metrics = TelegramApiMetrics()
+
+
+
+# --- Кэш готовых гороскопов ---
+class HoroscopeCache:
+    """Гороскопы на текущий день с ключом (user_id, YYYYMMDD, знак, язык).
+
+    В памяти хранится не больше одной записи на пользователя (LRU, ограничено max_size);
+    при смене дня кэш сбрасывается. Если задан HOROSCOPE_CACHE_COLLECTION, записи также
+    сохраняются в MongoDB с TTL до конца дня, чтобы их видели все воркеры. Туда же
+    prewarm_horoscopes заранее пишет гороскопы на завтра, сжатые zlib (поле z); гороскоп,
+    сгенерированный по запросу, пишется несжатым (поле text) — сжатие 2 КБ текста дороже
+    самой генерации, а делать его в цикле событий незачем.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[int, tuple[str, str, str]] = OrderedDict()
+        self._day = None
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
     @staticmethod
-    def get_zodiac_sign(birth_date: datetime) -> str:
-        month = birth_date.month
-        day = birth_date.day
-
-        if (month == 3 and day >= 21) or (month == 4 and day <= 19): return "aries"
-        if (month == 4 and day >= 20) or (month == 5 and day <= 20): return "taurus"
-        if (month == 5 and day >= 21) or (month == 6 and day <= 20): return "gemini"
-        if (month == 6 and day >= 21) or (month == 7 and day <= 22): return "cancer"
-        if (month == 7 and day >= 23) or (month == 8 and day <= 22): return "leo"
-        if (month == 8 and day >= 23) or (month == 9 and day <= 22): return "virgo"
-        if (month == 9 and day >= 23) or (month == 10 and day <= 22): return "libra"
-        if (month == 10 and day >= 23) or (month == 11 and day <= 21): return "scorpio"
-        if (month == 11 and day >= 22) or (month == 12 and day <= 21): return "sagittarius"
-        if (month == 12 and day >= 22) or (month == 1 and day <= 19): return "capricorn"
-        if (month == 1 and day >= 20) or (month == 2 and day <= 18): return "aquarius"
-        if (month == 2 and day >= 19) or (month == 3 and day <= 20): return "pisces"
-        return "aries" # Возврат по умолчанию
+    def _doc_id(user_id: int, day: str, sign: str, lang: str) -> str:
+        return f"{user_id}:{day}:{sign}:{lang}"
 
-    @staticmethod
-    def get_year_ending(age: int, lang: str) -> str:
-        if age % 10 == 1 and age % 100 != 11:
-            return TEXTS["ru"]["years_singular"]
-        elif age % 10 >= 2 and age % 10 <= 4 and (age % 100 < 10 or age % 100 >= 20):
-            return TEXTS["ru"]["years_plural_2_4"]
-        else:
-            return TEXTS["ru"]["years_plural_5_plus"]
+    def _roll_day(self, day: str):
+        if day != self._day:
+            self._entries.clear()
+            self._day = day
 
     @staticmethod
-    async def generate(user_id: int) -> str:
-        user_data = await get_user_data(user_id)
-        lang = user_data.get("lang", "ru")
-        
-        sign_key = user_data.get('sign', HoroscopeGenerator.get_zodiac_sign(datetime.now()) if user_data.get('birth_date') else "aries")
-        today = datetime.now()
-
-        # Уникальный seed для дня и пользователя
-        seed_str = f"{user_id}_{today.strftime('%Y%m%d')}_{sign_key}".encode()
-        seed = int(hashlib.md5(seed_str).hexdigest()[:8], 16)
-        rng = random.Random(seed)
-
-        # Генерация аспектов
-        aspects = {
-            await get_text_async(user_id, "horoscope_love"): rng.randint(1, 10),
-            await get_text_async(user_id, "horoscope_career"): rng.randint(1, 10),
-            await get_text_async(user_id, "horoscope_finance"): rng.randint(1, 10),
-            await get_text_async(user_id, "horoscope_health"): rng.randint(1, 10)
-        }
+    def _text(doc: dict) -> str:
+        return zlib.decompress(doc["z"]).decode() if "z" in doc else doc["text"]
 
-        # Дополнительные элементы прогноза
-        sign_info = HoroscopeGenerator.SIGNS.get(sign_key, {})
-        mood = rng.choice(HoroscopeGenerator.MOODS[lang])
-        lucky_color = rng.choice(HoroscopeGenerator.LUCKY_COLORS[lang])
-        lucky_number = rng.choice(sign_info.get("lucky_number", [rng.randint(1, 9)]))
-        
-        # Используем get_text_async для локализованных значений
-        ruling_planet = await get_text_async(user_id, sign_info.get("planet_key", "planet_crystal"))
-        lucky_stone = await get_text_async(user_id, sign_info.get("lucky_stone_key", "stone_crystal"))
+    @staticmethod
+    def _shared_update(user_id: int, day: str, sign: str, lang: str, fields: dict) -> tuple[dict, dict]:
+        """Фильтр и изменение записи в коллекции; запись живет до конца дня day."""
+        expires_at = datetime.strptime(day, "%Y%m%d") + timedelta(days=1)
+        return (
+            {"_id": HoroscopeCache._doc_id(user_id, day, sign, lang)},
+            {"$set": {"user_id": user_id, **fields, "expires_at": expires_at}},
+        )
 
-        available_compatible_signs = HoroscopeGenerator.COMPATIBILITY.get(sign_key, [])
-        compatible_signs_keys = rng.sample(available_compatible_signs, k=min(2, len(available_compatible_signs)))
-        # Переводим названия знаков для совместимости
-        compatible_signs = [await get_text_async(user_id, f"sign_{s}") for s in compatible_signs_keys]
+    def _remember(self, user_id: int, sign: str, lang: str, text: str):
+        self._entries[user_id] = (sign, lang, text)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, user_id: int, day: str, sign: str, lang: str) -> str | None:
+        self._roll_day(day)
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] == sign and entry[1] == lang:
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[2]
+        if horoscopes_collection is not None:
+            doc = await horoscopes_collection.find_one({"_id": self._doc_id(user_id, day, sign, lang)})
+            if doc:
+                text = self._text(doc)
+                self._remember(user_id, sign, lang, text)
+                self.shared_hits += 1
+                return text
+        self.misses += 1
+        return None
+
+    async def get_many(self, day: str, keys: list[tuple[int, str, str]]) -> list[str | None]:
+        """Гороскопы по списку (user_id, знак, язык): промахи памяти читаются из MongoDB одним запросом."""
+        self._roll_day(day)
+        texts = []
+        for user_id, sign, lang in keys:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] == sign and entry[1] == lang:
+                self._entries.move_to_end(user_id)
+                texts.append(entry[2])
+            else:
+                texts.append(None)
+        self.hits += len(keys) - texts.count(None)
+        missing = [i for i, text in enumerate(texts) if text is None]
+        if missing and horoscopes_collection is not None:
+            doc_ids = {self._doc_id(keys[i][0], day, keys[i][1], keys[i][2]): i for i in missing}
+            async for doc in horoscopes_collection.find({"_id": {"$in": list(doc_ids)}}):
+                i = doc_ids[doc["_id"]]
+                texts[i] = self._text(doc)
+                self._remember(*keys[i], texts[i])
+                self.shared_hits += 1
+        self.misses += texts.count(None)
+        return texts
+
+    async def set(self, user_id: int, day: str, sign: str, lang: str, text: str):
+        self._roll_day(day)
+        self._remember(user_id, sign, lang, text)
+        if horoscopes_collection is not None:
+            await horoscopes_collection.update_one(
+                *self._shared_update(user_id, day, sign, lang, {"text": text}), upsert=True
+            )
 
-        if not compatible_signs:
-            compatible_signs.append(await get_text_async(user_id, "compatibility_not_defined"))
+    async def set_many(self, day: str, rows: list[tuple[int, str, str, str]]):
+        """Запоминает гороскопы (user_id, знак, язык, текст) и пишет их в MongoDB одним bulk_write."""
+        self._roll_day(day)
+        for user_id, sign, lang, text in rows:
+            self._remember(user_id, sign, lang, text)
+        if rows and horoscopes_collection is not None:
+            await horoscopes_collection.bulk_write(
+                [UpdateOne(*self._shared_update(user_id, day, sign, lang, {"text": text}), upsert=True)
+                 for user_id, sign, lang, text in rows],
+                ordered=False
+            )
 
-        tips = TEXTS[lang].get("horoscope_tips", [])
-        if not tips:
-            tips = ["Сегодня отличный день!", "Будьте внимательны к деталям!"]
-        
-        # Форматирование
-        horoscope_text = (await get_text_async(user_id, "horoscope_title")).format(emoji=sign_info.get('emoji', '✨')) + "\n\n"
-        # Используем get_text_async для названия знака и элемента
-        horoscope_text += (await get_text_async(user_id, "horoscope_sign")).format(sign=await get_text_async(user_id, f"sign_{sign_key}"), element=await get_text_async(user_id, sign_info.get('element_key', ''))) + "\n"
-        horoscope_text += (await get_text_async(user_id, "horoscope_date")).format(date=today.strftime('%d %b %Y')) + "\n"
-
-        birth_date_str = user_data.get("birth_date")
-        if birth_date_str:
-            try:
-                birth_date_obj = datetime.strptime(birth_date_str, "%d.%m.%Y")
-                age = HoroscopeGenerator.calculate_age(birth_date_obj)
-                years_ending = HoroscopeGenerator.get_year_ending(age, lang)
-                horoscope_text += (await get_text_async(user_id, "horoscope_age")).format(age=age, years=years_ending) + "\n"
-            except ValueError:
-                logger.error(f"Неверный формат даты рождения для пользователя {user_id}: {birth_date_str}")
-        
-        horoscope_text += "\n"
-
-        for aspect_name, score in aspects.items():
-            rating_emoji = ""
-            if score >= 8: rating_emoji = "🌟"
-            elif score >= 5: rating_emoji = "✨"
-            elif score >= 3: rating_emoji = "⚠️"
-            else: rating_emoji = "🚨"
-
-            description = await HoroscopeGenerator._generate_aspect_description(
-                aspect_name,
-                score,
-                rng,
-                lang
+    @staticmethod
+    async def store_shared(day: str, rows: list[tuple[int, str, str, bytes]]):
+        """Пишет в MongoDB готовые сжатые гороскопы (user_id, знак, язык, zlib) на день day одним bulk_write."""
+        if rows:
+            await horoscopes_collection.bulk_write(
+                [UpdateOne(*HoroscopeCache._shared_update(user_id, day, sign, lang, {"z": compressed}), upsert=True)
+                 for user_id, sign, lang, compressed in rows],
+                ordered=False
             )
-            horoscope_text += f"{aspect_name}: {rating_emoji} {score}/10\n<i>\" {description} \"</i>\n\n"
-
-        horoscope_text += (
-            (await get_text_async(user_id, "horoscope_mood")).format(mood=mood) + "\n"
-            f"{(await get_text_async(user_id, 'horoscope_lucky_color')).format(color=lucky_color)}\n"
-            f"{(await get_text_async(user_id, 'horoscope_lucky_number')).format(number=lucky_number)}\n"
-            f"{(await get_text_async(user_id, 'horoscope_ruling_planet')).format(planet=ruling_planet)}\n"
-            f"{(await get_text_async(user_id, 'horoscope_lucky_stone')).format(stone=lucky_stone)}\n"
-            f"{(await get_text_async(user_id, 'horoscope_compatibility')).format(compatible_signs=', '.join(compatible_signs))}\n\n"
-            f"{(await get_text_async(user_id, 'horoscope_tip')).format(tip=rng.choice(tips))}\n\n"
-            f"<i>{(await get_text_async(user_id, 'horoscope_closing_message'))}</i>"
-        )
-        return horoscope_text
+
+    async def invalidate(self, user_id: int):
+        """Сбрасывает гороскоп пользователя после изменения его знака, даты рождения или языка."""
+        self._entries.pop(user_id, None)
+        if horoscopes_collection is not None:
+            await horoscopes_collection.delete_many({"user_id": user_id})
+
+
+horoscope_cache = HoroscopeCache(HOROSCOPE_CACHE_MAX_SIZE)
+
+
+async def get_daily_horoscope(user_ctx: UserContext) -> str:
+    """Гороскоп пользователя на сегодня: из кэша, а при промахе — через HoroscopeGenerator."""
+    user_id = user_ctx.user_id
+    day = datetime.now().strftime('%Y%m%d')
+    sign = HoroscopeGenerator.resolve_sign(user_ctx.data)
+    lang = user_ctx.lang
+    horoscope = await horoscope_cache.get(user_id, day, sign, lang)
+    if horoscope is None:
+        horoscope = await HoroscopeGenerator.generate(user_ctx)
+        await horoscope_cache.set(user_id, day, sign, lang, horoscope)
+    return horoscope
+
+
+async def get_daily_horoscopes(user_ctxs: list[UserContext]) -> list[str]:
+    """Гороскопы пачки пользователей на сегодня: из кэша (и прогретых prewarm_horoscopes), а промахи — одним вызовом generate_many."""
+    day = datetime.now().strftime('%Y%m%d')
+    keys = [(user_ctx.user_id, HoroscopeGenerator.resolve_sign(user_ctx.data), user_ctx.lang) for user_ctx in user_ctxs]
+    horoscopes = await horoscope_cache.get_many(day, keys)
+    missing = [i for i, horoscope in enumerate(horoscopes) if horoscope is None]
+    if missing:
+        generated = await HoroscopeGenerator.generate_many([user_ctxs[i] for i in missing])
+        for i, horoscope in zip(missing, generated):
+            horoscopes[i] = horoscope
+        await horoscope_cache.set_many(day, [(*keys[i], horoscopes[i]) for i in missing])
+    return horoscopes
+
+
+# --- Данные о самом боте ---
+# Username бота запрашивается у Telegram один раз (в on_startup), а не для каждого сообщения
+bot_username: str | None = None
+
+async def load_bot_identity(passed_bot: Bot) -> str:
+    global bot_username
+    me = await passed_bot.get_me()
+    bot_username = me.username
+    # Ссылки в кнопках под гороскопом зависят от username
+    for key in [key for key in _markup_cache if key[0] == "horoscope_actions"]:
+        del _markup_cache[key]
+    logger.info(f"Бот: @{bot_username}")
+    return bot_username
+
+async def get_bot_username() -> str:
+    if bot_username is None:
+        return await load_bot_identity(bot)
+    return bot_username
+
 
 # Клавиатуры
+# Разметка меню зависит только от языка (а кнопки под гороскопом — еще и от username бота),
+# поэтому каждое меню собирается один раз на язык и дальше отдается из кэша по ключу (меню, язык)
+_markup_cache: Dict[tuple[str, str], Any] = {}
+
 class Keyboard:
     @staticmethod
-    async def main_menu(user_id: int) -> ReplyKeyboardMarkup:
+    def _cached(menu: str, lang: str):
+        lang = lang if lang in CATALOG.languages else DEFAULT_LANG
+        markup = _markup_cache.get((menu, lang))
+        if markup is None:
+            markup = _markup_cache[(menu, lang)] = getattr(Keyboard, f"_build_{menu}")(lang)
+        return markup
+
+    @staticmethod
+    def warm_up():
+        """Собирает все меню для всех языков заранее (вызывается в on_startup)."""
+        menus = ["main_menu", "settings_menu", "sign_selection_menu", "language_selection_menu",
+                 "entertainment_menu", "donate_menu"]
+        if bot_username is not None:
+            menus.append("horoscope_actions")
+        for menu in menus:
+            for lang in CATALOG.languages:
+                Keyboard._cached(menu, lang)
+        logger.info(f"Клавиатуры собраны: {len(_markup_cache)} шт.")
+
+    @staticmethod
+    async def horoscope_actions(user_ctx: UserContext) -> InlineKeyboardMarkup:
+        """Кнопки "Поддержать" и "Поделиться ботом" под гороскопом."""
+        markup = _markup_cache.get(("horoscope_actions", user_ctx.lang))
+        if markup is None:
+            await get_bot_username()
+            markup = Keyboard._cached("horoscope_actions", user_ctx.lang)
+        return markup
+
+    @staticmethod
+    def _build_horoscope_actions(lang: str) -> InlineKeyboardMarkup:
+        bot_link = f"https://t.me/{bot_username}"
+        share_text = quote(CATALOG.get(lang, "share_message"), safe="")
+        builder = InlineKeyboardBuilder()
+        builder.button(text=CATALOG.get(lang, "main_menu_support"), callback_data="show_donate_from_horoscope")
+        builder.button(
+            text=CATALOG.get(lang, "share_bot_button"),
+            url=f"https://t.me/share/url?url={quote(bot_link, safe='')}&text={share_text}"
+        )
+        builder.adjust(2)
+        return builder.as_markup()
+
+    @staticmethod
+    def main_menu(user_ctx: UserContext) -> ReplyKeyboardMarkup:
+        return Keyboard._cached("main_menu", user_ctx.lang)
+
+    @staticmethod
+    def _build_main_menu(lang: str) -> ReplyKeyboardMarkup:
         builder = ReplyKeyboardBuilder()
-        builder.button(text=await get_text_async(user_id, "main_menu_horoscope"))
-        builder.button(text=await get_text_async(user_id, "main_menu_settings"))
-        builder.button(text=await get_text_async(user_id, "main_menu_support"))
-        builder.button(text=await get_text_async(user_id, "main_menu_entertainment"))
+        builder.button(text=CATALOG.get(lang, "main_menu_horoscope"))
+        builder.button(text=CATALOG.get(lang, "main_menu_settings"))
+        builder.button(text=CATALOG.get(lang, "main_menu_support"))
+        builder.button(text=CATALOG.get(lang, "main_menu_entertainment"))
         builder.adjust(2)
         return builder.as_markup(resize_keyboard=True)
 
     @staticmethod
-    async def settings_menu(user_id: int) -> InlineKeyboardMarkup:
+    def settings_menu(user_ctx: UserContext) -> InlineKeyboardMarkup:
+        return Keyboard._cached("settings_menu", user_ctx.lang)
+
+    @staticmethod
+    def _build_settings_menu(lang: str) -> InlineKeyboardMarkup:
         builder = InlineKeyboardBuilder()
-        builder.button(text=await get_text_async(user_id, "settings_change_sign"), callback_data="change_sign")
-        builder.button(text=await get_text_async(user_id, "settings_set_birth_date"), callback_data="set_birth_date")
-        builder.button(text=await get_text_async(user_id, "settings_change_language"), callback_data="change_language")
+        builder.button(text=CATALOG.get(lang, "settings_change_sign"), callback_data="change_sign")
+        builder.button(text=CATALOG.get(lang, "settings_set_birth_date"), callback_data="set_birth_date")
+        builder.button(text=CATALOG.get(lang, "settings_change_language"), callback_data="change_language")
         builder.adjust(1)
         return builder.as_markup()
 
     @staticmethod
-    async def sign_selection_menu(user_id: int) -> InlineKeyboardMarkup:
+    def sign_selection_menu(user_ctx: UserContext) -> InlineKeyboardMarkup:
+        return Keyboard._cached("sign_selection_menu", user_ctx.lang)
+
+    @staticmethod
+    def _build_sign_selection_menu(lang: str) -> InlineKeyboardMarkup:
         builder = InlineKeyboardBuilder()
         signs_list = list(HoroscopeGenerator.SIGNS.keys())
         for i in range(0, len(signs_list), 3):
             row_buttons = []
             for sign_key in signs_list[i:i+3]:
                 sign_info = HoroscopeGenerator.SIGNS[sign_key]
-                row_buttons.append(types.InlineKeyboardButton(text=f"{sign_info['emoji']} {await get_text_async(user_id, f'sign_{sign_key}')}", callback_data=f"set_sign_{sign_key}"))
+                row_buttons.append(types.InlineKeyboardButton(text=f"{sign_info['emoji']} {CATALOG.get(lang, f'sign_{sign_key}')}", callback_data=f"set_sign_{sign_key}"))
             builder.row(*row_buttons)
         return builder.as_markup()
 
     @staticmethod
-    async def language_selection_menu(user_id: int) -> InlineKeyboardMarkup:
+    def language_selection_menu(user_ctx: UserContext) -> InlineKeyboardMarkup:
+        return Keyboard._cached("language_selection_menu", user_ctx.lang)
+
+    @staticmethod
+    def _build_language_selection_menu(lang: str) -> InlineKeyboardMarkup:
+        builder = InlineKeyboardBuilder()
+        for option in CATALOG.languages:
+            builder.button(text=CATALOG.get(option, "language_button"), callback_data=f"set_lang_{option}")
+        builder.adjust(1)
+        return builder.as_markup()
+
+    @staticmethod
+    def entertainment_menu(user_ctx: UserContext) -> InlineKeyboardMarkup:
+        return Keyboard._cached("entertainment_menu", user_ctx.lang)
+
+    @staticmethod
+    def _build_entertainment_menu(lang: str) -> InlineKeyboardMarkup:
         builder = InlineKeyboardBuilder()
-        builder.button(text="🇷🇺 Русский", callback_data="set_lang_ru")
+        builder.button(text=CATALOG.get(lang, "cookie_button"), callback_data="get_cookie_fortune")
+        builder.button(text=CATALOG.get(lang, "magic_ball_button"), callback_data="ask_magic_ball")
         builder.adjust(1)
         return builder.as_markup()
 
     @staticmethod
-    async def entertainment_menu(user_id: int) -> InlineKeyboardMarkup:
+    def donate_menu(user_ctx: UserContext) -> InlineKeyboardMarkup:
+        return Keyboard._cached("donate_menu", user_ctx.lang)
+
+    @staticmethod
+    def _build_donate_menu(lang: str) -> InlineKeyboardMarkup:
         builder = InlineKeyboardBuilder()
-        builder.button(text=await get_text_async(user_id, "cookie_button"), callback_data="get_cookie_fortune")
-        builder.button(text=await get_text_async(user_id, "magic_ball_button"), callback_data="ask_magic_ball")
+        builder.button(text=CATALOG.get(lang, "donate_open_wallet"), url="https://t.me/wallet")
+        builder.button(text=CATALOG.get(lang, "copy_ton_button"), callback_data="copy_ton_wallet")
+        builder.button(text=CATALOG.get(lang, "donate_closed"), callback_data="close_donate_message")
         builder.adjust(1)
         return builder.as_markup()
 
@@ -546,15 +1579,17 @@ def get_user_initial_language_code(message: types.Message) -> str:
     return "ru"
 
 # Обработчики
-@dp.message(Command("start"))
-async def start(message: Message, state: FSMContext):  # Добавлен параметр state
+@router.message(Command("start"))
+async def start(message: types.Message, state: FSMContext, user_ctx: UserContext):
+    user_id = message.from_user.id
+    user_data = user_ctx.data
     await message.answer("Добро пожаловать! Я бот-астролог. Для начала, введите свою дату рождения в формате ДД.ММ.ГГГГ:")
     await state.set_state(Form.set_birth_date)
 
     # Если это новый пользователь или данные неполны, инициализируем
     if not user_data.get("sign") or not user_data.get("lang") or not user_data.get("birth_date"):
         initial_lang = get_user_initial_language_code(message)
-        # Убедимся, что user_id хранится как строка, если это новый пользователь для MongoDB
+        # Аргумент /start — строка, для сравнения с ним нужен id в том же виде
         user_id_str = str(user_id)
         
         # Создаем или обновляем запись пользователя
@@ -564,345 +1599,956 @@ async def start(message: Message, state: FSMContext):  # Добавлен пар
             if message.text and len(message.text.split()) > 1:
                 potential_referrer_id = message.text.split()[1]
                 if potential_referrer_id != user_id_str: # Чтобы пользователь не мог быть своим рефералом
-                    referrer_exists = await users_collection.find_one({"_id": potential_referrer_id})
-                    if referrer_exists:
-                        referrer_id = potential_referrer_id
-                        # Добавляем нового пользователя как реферала к рефереру
-                        await users_collection.update_one(
-                            {"_id": referrer_id},
-                            {"$addToSet": {"referrals": user_id_str}}
-                        )
+                    if await referrer_exists(potential_referrer_id):
+                        referrer_id = int(potential_referrer_id)
                         logger.info(f"Пользователь {user_id_str} пришел по реферальной ссылке {referrer_id}")
                     else:
                         logger.warning(f"Реферер {potential_referrer_id} не найден.")
                 else:
                     logger.warning(f"Пользователь {user_id_str} попытался быть своим собственным рефералом.")
 
-            await users_collection.update_one(
-                {"_id": user_id_str},
-                {"$setOnInsert": { # Устанавливаем только при первой вставке
-                    "username": message.from_user.username,
-                    "first_name": message.from_user.first_name,
-                    "last_name": message.from_user.last_name,
-                    "registration_date": datetime.now(),
-                    "balance": 0,
-                    "referrals": [],
-                    "referrer_id": referrer_id, # Устанавливаем реферера
-                    "sign": user_data.get("sign", "aries"), # Берем из кэша, если уже есть
-                    "lang": initial_lang,
-                    "birth_date": user_data.get("birth_date", None)
-                }},
-                upsert=True # Вставить, если не существует
-            )
+            # Профиль и реферальная связь пишутся пакетом вместе с другими /start (см. RegistrationBatcher)
+            await registrations.register(user_id, {
+                "username": message.from_user.username,
+                "first_name": message.from_user.first_name,
+                "last_name": message.from_user.last_name,
+                "registration_date": datetime.now(),
+                "balance": 0,
+                "referrer_id": referrer_id, # Устанавливаем реферера
+                "sign": user_data.get("sign", "aries"), # Берем из кэша, если уже есть
+                "lang": initial_lang,
+                "birth_date": user_data.get("birth_date", None),
+                "birth_ymd": user_data.get("birth_ymd"),
+            }, referrer_id)
             # Если это новый пользователь, попросим дату рождения
             if not user_data.get("birth_date"):
                 await message.answer(
                     "Привет! Я Астро-бот. Отправь мне свою дату рождения в формате ДД.ММ.ГГГГ для получения гороскопа.",
-                    reply_markup=await Keyboard.main_menu(user_id)
+                    reply_markup=Keyboard.main_menu(user_ctx)
                 )
                 await message.answer("Для удобства, пожалуйста, укажите вашу дату рождения. Введите ее в формате ДД.ММ.ГГГГ (например, 01.01.2000).")
                 await state.set_state(Form.set_birth_date)
             else:
                 await message.answer(
-                    await get_text_async(user_id, "welcome"),
-                    reply_markup=await Keyboard.main_menu(user_id),
+                    user_ctx.text("welcome"),
+                    reply_markup=Keyboard.main_menu(user_ctx),
                     parse_mode="HTML"
                 )
         else:
             # Если MongoDB не подключена, просто отвечаем
             await message.answer(
-                await get_text_async(user_id, "welcome"),
-                reply_markup=await Keyboard.main_menu(user_id),
+                user_ctx.text("welcome"),
+                reply_markup=Keyboard.main_menu(user_ctx),
                 parse_mode="HTML"
             )
             logger.warning(f"MongoDB не подключен. Функционал для пользователя {user_id} ограничен. Данные не сохраняются.")
     else:
         # Существующий пользователь
         await message.answer(
-            await get_text_async(user_id, "welcome"),
-            reply_markup=await Keyboard.main_menu(user_id),
+            user_ctx.text("welcome"),
+            reply_markup=Keyboard.main_menu(user_ctx),
             parse_mode="HTML"
         )
 
 
-@dp.message(F.text.in_({TEXTS["ru"]["main_menu_horoscope"]}))
-async def send_horoscope(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    user_data = await get_user_data(user_id)
-    if not user_data.get("birth_date"):
+@router.message(F.text.in_(CATALOG.variants("main_menu_horoscope")))
+async def send_horoscope(message: types.Message, state: FSMContext, user_ctx: UserContext):
+    if not user_ctx.data.get("birth_date"):
         await message.answer("Для получения гороскопа, пожалуйста, сначала укажите вашу дату рождения в формате ДД.ММ.ГГГГ.")
         await state.set_state(Form.set_birth_date)
         return
 
-    horoscope = await HoroscopeGenerator.generate(user_id)
-
-    bottom_buttons_builder = InlineKeyboardBuilder()
-    bottom_buttons_builder.button(text=await get_text_async(user_id, "main_menu_support"), callback_data="show_donate_from_horoscope")
-    
-    me = await bot.get_me()
-    bot_username = me.username
-    share_text_encoded = SHARE_MESSAGE_RU.format(url=f"https://t.me/{bot_username}").replace(" ", "%20").replace("\n", "%0A")
-
-    bottom_buttons_builder.button(
-        text="💌 Поделиться ботом", 
-        url=f"https://t.me/share/url?url=https://t.me/{bot_username}&text={share_text_encoded}"
-    )
-    
-    bottom_buttons_builder.adjust(2)
+    horoscope = await get_daily_horoscope(user_ctx)
 
     await message.answer(
         horoscope,
         parse_mode="HTML",
-        reply_markup=bottom_buttons_builder.as_markup()
+        reply_markup=await Keyboard.horoscope_actions(user_ctx)
     )
 
 
-@dp.message(F.text.in_({TEXTS["ru"]["main_menu_settings"]}))
-async def settings_menu(message: types.Message):
-    user_id = message.from_user.id
+@router.message(F.text.in_(CATALOG.variants("main_menu_settings")))
+async def settings_menu(message: types.Message, user_ctx: UserContext):
     await message.answer(
-        await get_text_async(user_id, "settings_menu_choose"),
-        reply_markup=await Keyboard.settings_menu(user_id)
+        user_ctx.text("settings_menu_choose"),
+        reply_markup=Keyboard.settings_menu(user_ctx)
     )
 
-@dp.callback_query(F.data == "change_sign")
-async def request_sign_change(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
+@router.callback_query(F.data == "change_sign")
+async def request_sign_change(callback: types.CallbackQuery, user_ctx: UserContext):
     await callback.message.edit_text(
-        await get_text_async(user_id, "choose_sign"),
-        reply_markup=await Keyboard.sign_selection_menu(user_id)
+        user_ctx.text("choose_sign"),
+        reply_markup=Keyboard.sign_selection_menu(user_ctx)
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("set_sign_"))
-async def set_user_sign(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
+@router.callback_query(F.data.startswith("set_sign_"))
+async def set_user_sign(callback: types.CallbackQuery, user_ctx: UserContext):
     new_sign = callback.data.split("_")[2]
     
-    await update_user_data(user_id, "sign", new_sign)
+    if user_ctx.set("sign", new_sign):
+        await horoscope_cache.invalidate(user_ctx.user_id)
 
     await callback.message.edit_text(
-        (await get_text_async(user_id, "sign_set_success")).format(sign=await get_text_async(user_id, f"sign_{new_sign}")),
+        user_ctx.render("sign_set_success", sign=user_ctx.text(f"sign_{new_sign}")),
         parse_mode="HTML"
     )
-    await callback.answer(await get_text_async(user_id, "sign_changed_answer"))
+    await callback.answer(user_ctx.text("sign_changed_answer"))
 
-@dp.callback_query(F.data == "set_birth_date")
-async def request_birth_date(callback: types.CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
+@router.callback_query(F.data == "set_birth_date")
+async def request_birth_date(callback: types.CallbackQuery, state: FSMContext, user_ctx: UserContext):
     await callback.message.edit_text(
-        await get_text_async(user_id, "birth_date_prompt")
+        user_ctx.text("birth_date_prompt")
     )
     await state.set_state(Form.set_birth_date)
     await callback.answer()
 
-@dp.message(Form.set_birth_date)
-async def process_birth_date(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
+@router.message(Form.set_birth_date)
+async def process_birth_date(message: types.Message, state: FSMContext, user_ctx: UserContext):
     birth_date_str = message.text
 
     if not re.match(r"^\d{2}\.\d{2}\.\d{4}$", birth_date_str):
-        await message.answer(await get_text_async(user_id, "birth_date_invalid_format"))
+        await message.answer(user_ctx.text("birth_date_invalid_format"))
         return
 
     try:
         birth_date_obj = datetime.strptime(birth_date_str, "%d.%m.%Y")
         if birth_date_obj > datetime.now():
-            await message.answer(await get_text_async(user_id, "birth_date_future_error"))
+            await message.answer(user_ctx.text("birth_date_future_error"))
             return
         
-        await update_user_data(user_id, "birth_date", birth_date_str)
         calculated_sign = HoroscopeGenerator.get_zodiac_sign(birth_date_obj)
-        await update_user_data(user_id, "sign", calculated_sign)
+        changed = user_ctx.set("birth_date", birth_date_str)
+        # Разобранная дата хранится рядом со строкой, чтобы generate не разбирал ее заново
+        user_ctx.set("birth_ymd", HoroscopeGenerator.to_ymd(birth_date_obj))
+        if user_ctx.set("sign", calculated_sign) or changed:
+            await horoscope_cache.invalidate(user_ctx.user_id)
 
         await message.answer(
-            (await get_text_async(user_id, "birth_date_success")).format(birth_date=birth_date_str),
+            user_ctx.render("birth_date_success", birth_date=birth_date_str),
             parse_mode="HTML",
-            reply_markup=await Keyboard.main_menu(user_id)
+            reply_markup=Keyboard.main_menu(user_ctx)
         )
         await state.clear()
     except ValueError:
-        await message.answer(await get_text_async(user_id, "birth_date_invalid_format"))
+        await message.answer(user_ctx.text("birth_date_invalid_format"))
 
-@dp.callback_query(F.data == "change_language")
-async def request_language_change(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
+@router.callback_query(F.data == "change_language")
+async def request_language_change(callback: types.CallbackQuery, user_ctx: UserContext):
     await callback.message.edit_text(
-        await get_text_async(user_id, "choose_language_prompt"),
-        reply_markup=await Keyboard.language_selection_menu(user_id)
+        user_ctx.text("choose_language_prompt"),
+        reply_markup=Keyboard.language_selection_menu(user_ctx)
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("set_lang_"))
-async def set_user_language(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
+@router.callback_query(F.data.startswith("set_lang_"))
+async def set_user_language(callback: types.CallbackQuery, user_ctx: UserContext):
     new_lang = callback.data.split("_")[2]
+    if new_lang not in CATALOG.languages:
+        new_lang = DEFAULT_LANG
     
-    await update_user_data(user_id, "lang", new_lang)
-    
-    lang_name = "Русский" # Так как только RU
+    if user_ctx.set("lang", new_lang):
+        await horoscope_cache.invalidate(user_ctx.user_id)
 
     await callback.message.edit_text(
-        (await get_text_async(user_id, "language_set_success")).format(lang_name=lang_name),
+        user_ctx.render("language_set_success", lang_name=user_ctx.text("language_name")),
         parse_mode="HTML"
     )
     # Отправляем новое сообщение с основным меню после изменения языка
     await callback.message.answer(
-        await get_text_async(user_id, "welcome"),
-        reply_markup=await Keyboard.main_menu(user_id),
+        user_ctx.text("welcome"),
+        reply_markup=Keyboard.main_menu(user_ctx),
         parse_mode="HTML"
     )
-    await callback.answer(await get_text_async(user_id, "language_changed_answer"))
+    await callback.answer(user_ctx.text("language_changed_answer"))
 
 # Обработчик для кнопки "Поддержать нас" в главном меню
-@dp.message(F.text.in_({TEXTS["ru"]["main_menu_support"]}))
-@dp.callback_query(F.data == "show_donate_from_horoscope")
-async def support_us_menu(update: types.Message | types.CallbackQuery):
-    user_id = update.from_user.id
-    
+@router.message(F.text.in_(CATALOG.variants("main_menu_support")))
+@router.callback_query(F.data == "show_donate_from_horoscope")
+async def support_us_menu(update: types.Message | types.CallbackQuery, user_ctx: UserContext):
     message_to_edit = None
     if isinstance(update, types.CallbackQuery):
         message_to_edit = update.message
         await update.answer() # Отвечаем на колбэк
 
-    builder = InlineKeyboardBuilder()
-    builder.button(text=await get_text_async(user_id, "donate_open_wallet"), url="https://t.me/wallet")
-    builder.button(text="📋 Копировать адрес TON", callback_data="copy_ton_wallet") 
-    builder.button(text=await get_text_async(user_id, "donate_closed"), callback_data="close_donate_message")
-    builder.adjust(1)
-
-    text = (await get_text_async(user_id, "support_us_prompt")).format(wallet=TON_WALLET)
+    text = user_ctx.render("support_us_prompt", wallet=config.ton_wallet)
 
     if message_to_edit:
         await message_to_edit.edit_text(
             text,
             parse_mode="HTML",
-            reply_markup=builder.as_markup()
+            reply_markup=Keyboard.donate_menu(user_ctx)
         )
     else:
         await update.answer(
             text,
             parse_mode="HTML",
-            reply_markup=builder.as_markup()
+            reply_markup=Keyboard.donate_menu(user_ctx)
         )
 
-@dp.callback_query(F.data == "copy_ton_wallet")
+@router.callback_query(F.data == "copy_ton_wallet")
 async def copy_ton_wallet(callback: types.CallbackQuery):
-    await callback.answer(f"Адрес кошелька TON:\n{TON_WALLET}\n\n(Нажмите на этот текст, чтобы скопировать)", show_alert=True)
+    await callback.answer(f"Адрес кошелька TON:\n{config.ton_wallet}\n\n(Нажмите на этот текст, чтобы скопировать)", show_alert=True)
 
-@dp.callback_query(F.data == "close_donate_message")
-async def close_donate_message(callback: types.CallbackQuery):
+@router.callback_query(F.data == "close_donate_message")
+async def close_donate_message(callback: types.CallbackQuery, user_ctx: UserContext):
     user_id = callback.from_user.id
     try:
         await callback.message.delete() # Удаляем сообщение с донатом
     except Exception as e:
         logger.warning(f"Не удалось удалить сообщение доната для {user_id}: {e}")
-    await callback.answer(await get_text_async(user_id, "donate_closed"))
+    await callback.answer(user_ctx.text("donate_closed"))
 
 
 # --- Обработчики для развлекательных функций ---
-@dp.message(F.text.in_({TEXTS["ru"]["main_menu_entertainment"]}))
-async def entertainment_menu(message: types.Message):
-    user_id = message.from_user.id
+@router.message(F.text.in_(CATALOG.variants("main_menu_entertainment")))
+async def entertainment_menu(message: types.Message, user_ctx: UserContext):
     await message.answer(
-        await get_text_async(user_id, "entertainment_menu_choose"),
-        reply_markup=await Keyboard.entertainment_menu(user_id)
+        user_ctx.text("entertainment_menu_choose"),
+        reply_markup=Keyboard.entertainment_menu(user_ctx)
     )
 
-@dp.callback_query(F.data == "get_cookie_fortune")
-async def get_cookie_fortune(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
+@router.callback_query(F.data == "get_cookie_fortune")
+async def get_cookie_fortune(callback: types.CallbackQuery, user_ctx: UserContext):
     fortune = random.choice(HoroscopeGenerator.COOKIE_FORTUNES)
     await callback.message.edit_text(
-        (await get_text_async(user_id, "cookie_fortune_message")).format(fortune=fortune),
+        user_ctx.render("cookie_fortune_message", fortune=fortune),
         parse_mode="HTML",
         reply_markup=None # Убираем кнопки, чтобы не загромождать
     )
     await callback.answer("Ваше предсказание готово!")
 
-@dp.callback_query(F.data == "ask_magic_ball")
-async def ask_magic_ball(callback: types.CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
+@router.callback_query(F.data == "ask_magic_ball")
+async def ask_magic_ball(callback: types.CallbackQuery, state: FSMContext, user_ctx: UserContext):
     await callback.message.edit_text(
-        await get_text_async(user_id, "magic_ball_question_prompt"),
+        user_ctx.text("magic_ball_question_prompt"),
         reply_markup=None # Убираем кнопки
     )
     await state.set_state(Form.magic_ball_answer)
     await callback.answer("Шар готов ответить!")
 
-@dp.message(Form.magic_ball_answer)
-async def process_magic_ball_question(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
+@router.message(Form.magic_ball_answer)
+async def process_magic_ball_question(message: types.Message, state: FSMContext, user_ctx: UserContext):
     question = message.text
     if not question.strip().endswith("?"):
-        await message.answer(await get_text_async(user_id, "magic_ball_not_a_question"))
+        await message.answer(user_ctx.text("magic_ball_not_a_question"))
         return
 
     answer_type = random.choices(["positive", "negative", "neutral"], weights=[0.5, 0.3, 0.2], k=1)[0]
     answer = random.choice(HoroscopeGenerator.MAGIC_BALL_ANSWERS[answer_type])
 
     await message.answer(
-        (await get_text_async(user_id, "magic_ball_answer_message")).format(answer=answer),
+        user_ctx.render("magic_ball_answer_message", answer=answer),
         parse_mode="HTML",
-        reply_markup=await Keyboard.main_menu(user_id) # Возвращаем основное меню
+        reply_markup=Keyboard.main_menu(user_ctx) # Возвращаем основное меню
     )
     await state.clear()
 
 
 # Реклама
-async def show_ads(user_id: int):
+def build_ad(user_ctx: UserContext) -> tuple[str, InlineKeyboardMarkup] | None:
+    """Решает, показывать ли пользователю рекламу, и собирает сообщение с кнопкой."""
+    if not config.adsgram_api_key:
+        logger.debug("ADSGRAM_API_KEY не установлен, реклама не показывается.")
+        return None
+    if random.randint(1, 5) != 1:
+        return None
+    builder = InlineKeyboardBuilder()
+    builder.button(text=user_ctx.text("ad_button"), url="https://example.com") # Замените на реальную ссылку
+    return user_ctx.text("ad_text"), builder.as_markup()
+
+async def show_ads(user_ctx: UserContext, broadcaster: "Broadcaster | None" = None):
+    """Показывает рекламу сразу или ставит ее в очередь рассылки, если передан broadcaster.
+
+    Когда очередь апдейтов перегружена, реклама пропускается, чтобы не отнимать лимит
+    Bot API и воркеров у ответов пользователям.
+    """
+    user_id = user_ctx.user_id
+    if update_queue.shedding:
+        update_queue.shed += 1
+        return
     try:
-        if ADSGRAM_API_KEY and random.randint(1, 5) == 1:
-            builder = InlineKeyboardBuilder()
-            builder.button(text=await get_text_async(user_id, "ad_button"), url="https://example.com") # Замените на реальную ссылку
-
-            await bot.send_message(
-                user_id,
-                await get_text_async(user_id, "ad_text"),
-                parse_mode="HTML",
-                reply_markup=builder.as_markup()
-            )
-        elif not ADSGRAM_API_KEY:
-            logger.debug("ADSGRAM_API_KEY не установлен, реклама не показывается.")
+        ad = build_ad(user_ctx)
+        if ad is None:
+            return
+        text, markup = ad
+        if broadcaster is not None:
+            await broadcaster.submit(user_id, text, parse_mode="HTML", reply_markup=markup)
+        else:
+            await bot.send_message(user_id, text, parse_mode="HTML", reply_markup=markup)
     except Exception as e:
         logger.error(f"Ошибка при показе рекламы пользователю {user_id}: {e}")
 
+
+# --- Движок массовой рассылки ---
+class TokenBucket:
+    """Ограничитель скорости: не больше rate операций в секунду, всплеск до capacity."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcaster:
+    """Пул воркеров, отправляющих сообщения из ограниченной очереди.
+
+    Соблюдает общий лимит Telegram (TokenBucket), минимальный интервал между сообщениями
+    в один чат и TelegramRetryAfter: при флуд-контроле все воркеры ждут указанное время,
+    после чего сообщение отправляется повторно.
+    """
+
+    def __init__(self, bot: Bot, workers: int = BROADCAST_WORKERS, rate: float = BROADCAST_RATE,
+                 per_chat_interval: float = BROADCAST_PER_CHAT_INTERVAL, status_batch: int = BROADCAST_STATUS_BATCH):
+        self.bot = bot
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self._bucket = TokenBucket(rate)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 4)
+        self._tasks: list[asyncio.Task] = []
+        # Время последней отправки в чат, упорядочено по времени — старые записи удаляются с начала
+        self._chat_sent_at: OrderedDict[int, float] = OrderedDict()
+        self._paused_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+        # Пользователей, прочитанных из курсора рассылки (включая уже получивших гороскоп)
+        self.processed = 0
+        self.started_at = None
+        # Метки (tag) доставленных и недоставленных сообщений — для учета доставки по пользователям.
+        # statuses_ready взводится, когда их набралось status_batch
+        self.delivered: list = []
+        self.undelivered: list = []
+        self.status_batch = status_batch
+        self.statuses_ready = asyncio.Event()
+        # True после discard(): новые и оставшиеся в очереди сообщения не отправляются
+        self.discarding = False
+
+    async def start(self):
+        self.started_at = time.monotonic()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, chat_id: int, text: str, tag=None, **kwargs):
+        """Ставит сообщение в очередь; ждет, если очередь заполнена.
+
+        Если передан tag, после отправки он попадет в delivered или undelivered.
+        """
+        if self.discarding:
+            return
+        await self._queue.put((chat_id, text, kwargs, tag))
+
+    def discard(self):
+        """Выбрасывает еще не отправленные сообщения; уже начатые отправки завершаются."""
+        self.discarding = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            self._queue.task_done()
+
+    async def close(self) -> dict:
+        """Дожидается отправки всех сообщений из очереди и останавливает воркеров."""
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        stats = self.stats()
+        logger.info(f"Рассылка завершена: {stats}")
+        return stats
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {
+            "processed": self.processed,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "retried": self.retried,
+            "queued": self._queue.qsize(),
+            "elapsed": round(elapsed, 1),
+            "per_second": round(self.sent / elapsed, 2) if elapsed else 0.0,
+        }
+
+    async def _wait_for_chat(self, chat_id: int):
+        now = time.monotonic()
+        while self._chat_sent_at:
+            oldest_chat, sent_at = next(iter(self._chat_sent_at.items()))
+            if now - sent_at < self.per_chat_interval:
+                break
+            del self._chat_sent_at[oldest_chat]
+        sent_at = self._chat_sent_at.get(chat_id)
+        if sent_at is not None:
+            await asyncio.sleep(self.per_chat_interval - (now - sent_at))
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, tag = await self._queue.get()
+            try:
+                if self.discarding:
+                    continue
+                delivered = await self._deliver(chat_id, text, kwargs)
+                if tag is not None:
+                    (self.delivered if delivered else self.undelivered).append(tag)
+                    if len(self.delivered) + len(self.undelivered) >= self.status_batch:
+                        self.statuses_ready.set()
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, chat_id: int, text: str, kwargs: dict) -> bool:
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._wait_for_chat(chat_id)
+            await self._bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning(f"Флуд-контроль Telegram: пауза {e.retry_after} с (попытка {attempt + 1})")
+                continue
+            except TelegramForbiddenError:
+                self.blocked += 1
+                logger.info(f"Пользователь {chat_id} заблокировал бота, сообщение пропущено.")
+                return False
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка при отправке сообщения пользователю {chat_id}: {e}", exc_info=True)
+                return False
+            self._chat_sent_at[chat_id] = time.monotonic()
+            self._chat_sent_at.move_to_end(chat_id)
+            self.sent += 1
+            if self.sent % BROADCAST_PROGRESS_EVERY == 0:
+                logger.info(f"Рассылка: {self.stats()}")
+            return True
+        self.failed += 1
+        logger.error(f"Сообщение пользователю {chat_id} не отправлено после {BROADCAST_MAX_RETRIES} повторов.")
+        return False
+
+
+# Поля профиля, которые нужны для генерации гороскопа; остальное (например, referrals) не загружаем
+BROADCAST_PROJECTION = {"sign": 1, "lang": 1, "birth_date": 1, "birth_ymd": 1}
+
+# --- Запуски рассылки с чекпоинтами ---
+# Запуск рассылки — документ в broadcast_runs с _id "daily-YYYYMMDD". Перед отправкой каждый
+# пользователь «забирается» вставкой документа "<user_id>:<YYYYMMDD>" в broadcast_deliveries:
+# повторная вставка падает с duplicate key, поэтому один пользователь не получит гороскоп
+# дважды за день, даже если рассылку перезапустили. После каждой пачки пользователей в запуск
+# записывается чекпоинт (последний _id и счетчики), с которого продолжит перезапущенный воркер.
+# Забранные, но не отправленные (status "claimed" или "failed") до того, как воркер арендовал
+# запуск, остались от упавшей попытки: их забирают заново, пропускаются только "sent".
+# Статусы "sent" пишет _save_statuses небольшими пачками прямо во время отправки, поэтому
+# после падения повторно получат гороскоп только пользователи из последней незаписанной пачки.
+# Потерявший аренду воркер выбрасывает свою очередь: эти пользователи достанутся новому владельцу.
+_background_tasks: set = set()
+# Рассылки, которые выполняет этот процесс, по id запуска — для /metrics
+active_broadcasts: Dict[str, Broadcaster] = {}
+
+def spawn_background(coro) -> asyncio.Task:
+    """Запускает корутину в фоне, сохраняя ссылку на задачу до ее завершения."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _acquire_run(run_id: str) -> dict | None:
+    """Арендует незавершенный запуск для этого процесса, если его не держит другой воркер."""
+    now = datetime.now()
+    return await broadcast_runs_collection.find_one_and_update(
+        {
+            "_id": run_id,
+            "status": {"$in": ["pending", "running"]},
+            "$or": [{"owner": INSTANCE_ID}, {"lease_until": None}, {"lease_until": {"$lt": now}}],
+        },
+        {"$set": {
+            "status": "running",
+            "owner": INSTANCE_ID,
+            "lease_until": now + timedelta(seconds=BROADCAST_LEASE_SECONDS),
+            "updated_at": now,
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _claim_deliveries(run_id: str, day: str, user_ids: list, stale_before: datetime) -> set:
+    """Отмечает пользователей как получающих гороскоп за day. Возвращает тех, кого удалось забрать.
+
+    Уже забранные раньше stale_before, но не отправленные, забираются заново (см. _reclaim_deliveries).
+    """
+    now = datetime.now()
+    docs = [
+        {"_id": f"{user_id}:{day}", "user_id": user_id, "date": day, "run_id": run_id, "status": "claimed", "created_at": now}
+        for user_id in user_ids
+    ]
+    try:
+        await deliveries_collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in errors):
+            raise
+        already_claimed = {docs[error["index"]]["user_id"] for error in errors}
+        return (set(user_ids) - already_claimed) | await _reclaim_deliveries(run_id, day, already_claimed, stale_before)
+    return set(user_ids)
+
+
+async def _reclaim_deliveries(run_id: str, day: str, user_ids: set, stale_before: datetime) -> set:
+    """Забирает заново пользователей, которых прошлая попытка запуска забрала, но не отправила им гороскоп.
+
+    Условие на status и created_at проверяется в самом update_many, поэтому забрать удается только
+    записи, не тронутые с тех пор другим воркером; какие именно — видно по метке claim.
+    """
+    claim = uuid.uuid4().hex
+    doc_ids = [f"{user_id}:{day}" for user_id in user_ids]
+    result = await deliveries_collection.update_many(
+        {"_id": {"$in": doc_ids}, "status": {"$in": ["claimed", "failed"]}, "created_at": {"$lt": stale_before}},
+        {"$set": {"run_id": run_id, "status": "claimed", "created_at": datetime.now(), "claim": claim}}
+    )
+    if not result.matched_count:
+        return set()
+    reclaimed = {doc["user_id"] async for doc in deliveries_collection.find({"_id": {"$in": doc_ids}, "claim": claim}, projection={"user_id": 1})}
+    logger.info(f"Рассылка {run_id}: {len(reclaimed)} пользователей не получили гороскоп в прошлой попытке, отправляю снова.")
+    return reclaimed
+
+
+async def _stale_user_ids(run_id: str, stale_before: datetime) -> list:
+    """Пользователи, забранные прошлыми попытками запуска и не получившие гороскоп.
+
+    Нужны отдельно от курсора: они могли стоять в очереди рассылки, когда чекпоинт уже сдвинул
+    last_user_id за них, и курсор к ним не вернется.
+    """
+    stale = deliveries_collection.find(
+        {"run_id": run_id, "status": {"$in": ["claimed", "failed"]}, "created_at": {"$lt": stale_before}},
+        projection={"user_id": 1}
+    )
+    return sorted([doc["user_id"] async for doc in stale])
+
+
+async def _checkpoint(run_id: str, day: str, broadcaster: Broadcaster, last_user_id=None, **counters) -> bool:
+    """Сохраняет статусы доставленных сообщений, счетчики и продлевает аренду запуска.
+
+    Возвращает False, если запуск перехватил другой воркер.
+    """
+    delivered, broadcaster.delivered = broadcaster.delivered, []
+    undelivered, broadcaster.undelivered = broadcaster.undelivered, []
+    now = datetime.now()
+    if delivered:
+        await deliveries_collection.update_many(
+            {"_id": {"$in": [f"{user_id}:{day}" for user_id in delivered]}},
+            {"$set": {"status": "sent", "sent_at": now}}
+        )
+        # По индексу last_delivered можно выбрать тех, кому сегодня еще ничего не ушло
+        await users_collection.update_many({"_id": {"$in": delivered}}, {"$set": {"last_delivered": day}})
+    if undelivered:
+        await deliveries_collection.update_many(
+            {"_id": {"$in": [f"{user_id}:{day}" for user_id in undelivered]}},
+            {"$set": {"status": "failed"}}
+        )
+    update = {
+        "$set": {"lease_until": now + timedelta(seconds=BROADCAST_LEASE_SECONDS), "updated_at": now},
+        "$inc": {"sent": len(delivered), "failed": len(undelivered), **counters},
+    }
+    if last_user_id is not None:
+        update["$set"]["last_user_id"] = last_user_id
+    result = await broadcast_runs_collection.update_one({"_id": run_id, "owner": INSTANCE_ID}, update)
+    return result.matched_count == 1
+
+
+async def _save_statuses(run_id: str, day: str, broadcaster: Broadcaster, lease_lost: asyncio.Event, stop: asyncio.Event):
+    """Пишет статусы доставки, пока идет рассылка, и продлевает аренду запуска.
+
+    Чекпоинт без сдвига last_user_id записывается, как только воркеры доставили status_batch
+    сообщений, и не реже чем раз в четверть аренды — так аренда не истекает, даже пока
+    Broadcaster стоит на паузе флуд-контроля. Потеряв аренду, выбрасывает очередь рассылки.
+    Останавливается по stop (последний чекпоинт пишет execute_broadcast_run).
+    """
+    current_scope.set(None)
+    while True:
+        try:
+            await asyncio.wait_for(broadcaster.statuses_ready.wait(), BROADCAST_LEASE_SECONDS / 4)
+        except asyncio.TimeoutError:
+            pass
+        broadcaster.statuses_ready.clear()
+        if stop.is_set():
+            return
+        try:
+            owned = await _checkpoint(run_id, day, broadcaster)
+        except Exception as e:
+            logger.error(f"Ошибка записи статусов доставки рассылки {run_id}: {e}", exc_info=True)
+            continue
+        if not owned:
+            logger.warning(f"Рассылку {run_id} перехватил другой воркер, выбрасываю очередь отправки.")
+            broadcaster.discard()
+            lease_lost.set()
+            return
+
+
+async def _broadcast_chunk(run_id: str, day: str, chunk: list, broadcaster: Broadcaster,
+                           stale_before: datetime, advance: bool = True) -> bool:
+    """Отправляет гороскопы пачке пользователей и пишет чекпоинт; advance=False — не сдвигать last_user_id."""
+    user_ids = [int(user_doc["_id"]) for user_doc in chunk] # Конвертируем в int для aiogram
+    claimed = await _claim_deliveries(run_id, day, user_ids, stale_before)
+    broadcaster.processed += len(chunk)
+    # Документы уже загружены курсором — повторно читать пользователей из БД не нужно
+    user_ctxs = [UserContext(user_id, user_doc) for user_id, user_doc in zip(user_ids, chunk) if user_id in claimed]
+    try:
+        horoscopes = await get_daily_horoscopes(user_ctxs)
+    except Exception as e:
+        # Например, профиль с неизвестным языком: тогда гороскопы генерируются по одному,
+        # и ошибка затронет только этого пользователя
+        logger.error(f"Ошибка пакетной генерации гороскопов, генерирую по одному: {e}", exc_info=True)
+        horoscopes = [None] * len(user_ctxs)
+    for user_ctx, horoscope in zip(user_ctxs, horoscopes):
+        user_id = user_ctx.user_id
+        try:
+            if horoscope is None:
+                horoscope = await get_daily_horoscope(user_ctx)
+            markup = await Keyboard.horoscope_actions(user_ctx)
+            await broadcaster.submit(user_id, horoscope, tag=user_id, parse_mode="HTML", reply_markup=markup)
+            await show_ads(user_ctx, broadcaster)
+        except Exception as e:
+            broadcaster.undelivered.append(user_id)
+            logger.error(f"Ошибка при подготовке гороскопа пользователю {user_id}: {e}", exc_info=True)
+    return await _checkpoint(
+        run_id, day, broadcaster, last_user_id=chunk[-1]["_id"] if advance else None,
+        processed=len(chunk), skipped=len(chunk) - len(claimed)
+    )
+
+
+async def execute_broadcast_run(run_id: str):
+    """Выполняет (или продолжает с последнего чекпоинта) запуск рассылки."""
+    run = await _acquire_run(run_id)
+    if run is None:
+        logger.info(f"Рассылка {run_id} уже завершена или выполняется другим воркером.")
+        return
+    day = run["date"]
+    # Все, что забрано до этой аренды и не отправлено, осталось от упавших попыток
+    stale_before = run["updated_at"]
+    query = {}
+    if run.get("last_user_id") is not None:
+        query["_id"] = {"$gt": run["last_user_id"]}
+        logger.info(f"Продолжаю рассылку {run_id} после пользователя {run['last_user_id']}.")
+    else:
+        logger.info(f"Начинаю рассылку {run_id}.")
+
+    # Пользователи читаются потоком, пачками по BROADCAST_BATCH_SIZE, в порядке _id — так чекпоинт
+    # однозначно задает место продолжения. Очередь рассылки ограничена, поэтому курсор
+    # не убегает вперед отправки и память не растет с размером коллекции.
+    users_cursor = users_collection.find(
+        query, projection=BROADCAST_PROJECTION, batch_size=BROADCAST_BATCH_SIZE, sort=[("_id", 1)]
+    )
+    broadcaster = Broadcaster(bot)
+    await broadcaster.start()
+    active_broadcasts[run_id] = broadcaster
+    lease_lost, stop = asyncio.Event(), asyncio.Event()
+    status_task = asyncio.create_task(_save_statuses(run_id, day, broadcaster, lease_lost, stop))
+    status = "done"
+    try:
+        stale_ids = await _stale_user_ids(run_id, stale_before)
+        for i in range(0, len(stale_ids), BROADCAST_CHECKPOINT_EVERY):
+            batch = stale_ids[i:i + BROADCAST_CHECKPOINT_EVERY]
+            chunk = await users_collection.find({"_id": {"$in": batch}}, projection=BROADCAST_PROJECTION).to_list(None)
+            if chunk and (lease_lost.is_set() or not await _broadcast_chunk(run_id, day, chunk, broadcaster, stale_before, advance=False)):
+                lease_lost.set()
+                return
+        chunk = []
+        async for user_doc in users_cursor:
+            chunk.append(user_doc)
+            if len(chunk) >= BROADCAST_CHECKPOINT_EVERY:
+                if lease_lost.is_set() or not await _broadcast_chunk(run_id, day, chunk, broadcaster, stale_before):
+                    lease_lost.set()
+                    return
+                chunk = []
+        if chunk and (lease_lost.is_set() or not await _broadcast_chunk(run_id, day, chunk, broadcaster, stale_before)):
+            lease_lost.set()
+    except Exception as e:
+        status = "failed"
+        logger.error(f"Ошибка выполнения рассылки {run_id}: {e}", exc_info=True)
+    finally:
+        active_broadcasts.pop(run_id, None)
+        if lease_lost.is_set():
+            # Очередь достанется новому владельцу запуска: он заберет этих пользователей заново
+            logger.warning(f"Рассылку {run_id} перехватил другой воркер, останавливаюсь.")
+            broadcaster.discard()
+        stats = await broadcaster.close()
+        # Не отменяем задачу посреди записи: она сама выйдет, дописав начатый чекпоинт
+        stop.set()
+        broadcaster.statuses_ready.set()
+        await asyncio.gather(status_task, return_exceptions=True)
+        if await _checkpoint(run_id, day, broadcaster):
+            await broadcast_runs_collection.update_one(
+                {"_id": run_id, "owner": INSTANCE_ID},
+                {"$set": {"status": status, "lease_until": None, "finished_at": datetime.now(), "throughput": stats["per_second"]}}
+            )
+    logger.info(f"Рассылка {run_id} завершена со статусом {status}.")
+
+
+async def start_broadcast_run(background: bool = True) -> dict:
+    """Создает запуск рассылки на сегодня (или возвращает уже созданный) и выполняет его.
+
+    Повторный вызов в тот же день не создает второй запуск; упавший запуск продолжается с чекпоинта.
+    """
+    now = datetime.now()
+    day = now.strftime('%Y%m%d')
+    run_id = f"daily-{day}"
+    run = await broadcast_runs_collection.find_one_and_update(
+        {"_id": run_id},
+        {"$setOnInsert": {
+            "date": day, "status": "pending", "created_at": now, "last_user_id": None,
+            "processed": 0, "skipped": 0, "sent": 0, "failed": 0,
+        }},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if run["status"] == "failed":
+        run = await broadcast_runs_collection.find_one_and_update(
+            {"_id": run_id}, {"$set": {"status": "pending"}}, return_document=ReturnDocument.AFTER
+        )
+    if run["status"] != "done":
+        if background:
+            spawn_background(execute_broadcast_run(run_id))
+        else:
+            await execute_broadcast_run(run_id)
+    return run
+
+
+async def resume_broadcast_runs():
+    """Продолжает запуски рассылки, прерванные перезапуском или падением воркера."""
+    if broadcast_runs_collection is None:
+        return
+    async for run in broadcast_runs_collection.find({"status": {"$in": ["pending", "running"]}}):
+        lease_until = run.get("lease_until")
+        delay = max(0.0, (lease_until - datetime.now()).total_seconds()) if lease_until else 0.0
+        logger.info(f"Найдена незавершенная рассылка {run['_id']}, продолжу через {delay:.0f} с.")
+        spawn_background(_resume_later(run["_id"], delay))
+
+
+async def _resume_later(run_id: str, delay: float):
+    await asyncio.sleep(delay)
+    await execute_broadcast_run(run_id)
+
+
 # Ежедневная рассылка гороскопов (логика)
 async def scheduled_tasks():
+    """Запускает рассылку на сегодня и дожидается ее завершения."""
     logger.info("Запускаю запланированные задачи: отправка ежедневных гороскопов.")
     # Этот блок будет работать только если MONGO_URI задан и MongoDB подключена
     if users_collection is not None:
-        users_cursor = users_collection.find({})
-        users_list = await users_cursor.to_list(length=None) # Получаем всех пользователей
-        
-        for user_doc in users_list:
-            user_id = int(user_doc["_id"]) # Конвертируем обратно в int для aiogram
-            try:
-                horoscope = await HoroscopeGenerator.generate(user_id)
-                
-                bottom_buttons_builder = InlineKeyboardBuilder()
-                bottom_buttons_builder.button(text=await get_text_async(user_id, "main_menu_support"), callback_data="show_donate_from_horoscope")
-                
-                me = await bot.get_me()
-                bot_username = me.username
-                share_text_encoded = SHARE_MESSAGE_RU.format(url=f"https://t.me/{bot_username}").replace(" ", "%20").replace("\n", "%0A")
-                bottom_buttons_builder.button(
-                    text="💌 Поделиться ботом", 
-                    url=f"https://t.me/share/url?url=https://t.me/{bot_username}&text={share_text_encoded}"
-                )
-                bottom_buttons_builder.adjust(2)
-
-                await bot.send_message(user_id, horoscope, parse_mode="HTML", reply_markup=bottom_buttons_builder.as_markup())
-                await show_ads(user_id)
-                await asyncio.sleep(0.1) # Небольшая задержка, чтобы не превышать лимиты Telegram API
-            except Exception as e:
-                logger.error(f"Ошибка при отправке гороскопа пользователю {user_id}: {e}", exc_info=True)
+        await start_broadcast_run(background=False)
     else:
         logger.warning("MongoDB users_collection не инициализирована. Ежедневная рассылка гороскопов не будет работать.")
 
+
+# --- Прогрев гороскопов на завтра ---
+# Генерация гороскопа — чистый Python в цикле событий, а сразу после рассылки почти все
+# пользователи запрашивают гороскоп еще раз. prewarm_horoscopes ночью считает завтрашние
+# гороскопы тех же пользователей, что получают рассылку, в пуле процессов, и утром рассылка
+# и send_horoscope берут готовый текст из HOROSCOPE_CACHE_COLLECTION.
+_prewarm_task: asyncio.Task | None = None
+
+
+async def prewarm_horoscopes(day: datetime | None = None) -> dict:
+    """Считает гороскопы на day (по умолчанию на завтра) и сохраняет их в общий кэш гороскопов.
+
+    Пользователи читаются курсором по возрастанию _id и режутся на пачки по PREWARM_SHARD_SIZE:
+    каждая пачка — свой диапазон id, ее считает prewarm_shard в отдельном процессе. В работе
+    не больше двух пачек на процесс, так что память не растет с числом пользователей.
+    """
+    if horoscopes_collection is None:
+        logger.warning("HOROSCOPE_CACHE_COLLECTION не задан, прогревать гороскопы некуда.")
+        return {"users": 0, "stored": 0, "failed_shards": 0}
+    day = day or datetime.now() + timedelta(days=1)
+    day_key = day.strftime('%Y%m%d')
+    loop = asyncio.get_running_loop()
+    stats = {"date": day_key, "users": 0, "stored": 0, "failed_shards": 0}
+    pending: Dict[asyncio.Future, tuple] = {}  # пачка в работе -> (первый _id, последний _id)
+
+    async def collect(done):
+        for future in done:
+            first_id, last_id = pending.pop(future)
+            try:
+                rows = future.result()
+                await HoroscopeCache.store_shared(day_key, rows)
+                stats["stored"] += len(rows)
+            except Exception as e:
+                stats["failed_shards"] += 1
+                logger.error(f"Не удалось прогреть гороскопы пользователей {first_id}..{last_id}: {e}", exc_info=True)
+
+    async def submit(shard: list):
+        if len(pending) >= 2 * PREWARM_PROCESSES:
+            done, _ = await asyncio.wait(set(pending), return_when=asyncio.FIRST_COMPLETED)
+            await collect(done)
+        pending[loop.run_in_executor(pool, prewarm_shard, shard, day)] = (shard[0]["_id"], shard[-1]["_id"])
+        stats["users"] += len(shard)
+
+    logger.info(f"Прогреваю гороскопы на {day_key}: {PREWARM_PROCESSES} процессов, пачки по {PREWARM_SHARD_SIZE}.")
+    started = time.monotonic()
+    # spawn, а не fork: дочерние процессы не наследуют потоки motor и открытые сокеты
+    pool = ProcessPoolExecutor(max_workers=PREWARM_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        users_cursor = users_collection.find(
+            {}, projection=BROADCAST_PROJECTION, batch_size=BROADCAST_BATCH_SIZE, sort=[("_id", 1)]
+        )
+        shard = []
+        async for user_doc in users_cursor:
+            shard.append(user_doc)
+            if len(shard) >= PREWARM_SHARD_SIZE:
+                await submit(shard)
+                shard = []
+        if shard:
+            await submit(shard)
+        if pending:
+            done, _ = await asyncio.wait(set(pending))
+            await collect(done)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    stats["seconds"] = round(time.monotonic() - started, 1)
+    logger.info(f"Прогрев гороскопов завершен: {stats}")
+    return stats
+
+# --- Очередь апдейтов вебхука ---
+class UpdateQueue:
+    """Очередь между вебхуком и диспетчером с ограниченным числом воркеров.
+
+    Апдейты раскладываются по workers шардам по id чата: апдейты одного чата обрабатываются
+    строго по порядку, разные чаты — параллельно. Шарды ограничены по размеру; если шард
+    заполнен, вебхук отвечает 503 и Telegram повторит доставку позже. Пока в очереди не меньше
+    shed_depth апдейтов, необязательная работа (реклама) пропускается.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS, max_size: int = UPDATE_QUEUE_SIZE,
+                 shed_depth: int = UPDATE_QUEUE_SHED_DEPTH):
+        self.dispatcher: Dispatcher | None = None
+        self.workers = workers
+        self.shard_size = max(1, max_size // workers)
+        self.shed_depth = shed_depth
+        self._shards: list[asyncio.Queue] = []
+        self._tasks: list[asyncio.Task] = []
+        # Время от приема апдейта вебхуком до конца его обработки
+        self.latency = LatencyHistogram()
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.shed = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(shard.qsize() for shard in self._shards)
+
+    @property
+    def shedding(self) -> bool:
+        return bool(self._shards) and self.depth >= self.shed_depth
+
+    def start(self, dispatcher: Dispatcher):
+        self.dispatcher = dispatcher
+        self._shards = [asyncio.Queue(self.shard_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(shard)) for shard in self._shards]
+
+    def put(self, passed_bot: Bot, update: types.Update) -> bool:
+        """Ставит апдейт в очередь его чата. Возвращает False, если очередь заполнена."""
+        context = UserContextMiddleware.resolve_event_context(update)
+        if context.chat is not None:
+            shard_key = context.chat.id
+        elif context.user is not None:
+            shard_key = context.user.id
+        else:
+            shard_key = update.update_id
+        try:
+            self._shards[shard_key % self.workers].put_nowait((time.monotonic(), passed_bot, update))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        return True
+
+    async def _worker(self, shard: asyncio.Queue):
+        while True:
+            received_at, passed_bot, update = await shard.get()
+            try:
+                result = await self.dispatcher.feed_update(passed_bot, update)
+                if isinstance(result, TelegramMethod):
+                    await self.dispatcher.silent_call_request(passed_bot, result)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}", exc_info=True)
+            finally:
+                self.latency.observe((time.monotonic() - received_at) * 1000)
+                shard.task_done()
+
+    async def close(self, timeout: float = 10.0):
+        """Дожидается обработки принятых апдейтов (не дольше timeout секунд) и останавливает воркеров."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(shard.join() for shard in self._shards)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Очередь апдейтов не разобрана за {timeout} с, осталось {self.depth}.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "capacity": self.shard_size * self.workers,
+            "shedding": self.shedding,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "shed": self.shed,
+            "latency": self.latency.stats(),
+        }
+
+
+update_queue = UpdateQueue()
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука: разбирает апдейт, кладет его в UpdateQueue и сразу отвечает Telegram."""
+
+    def __init__(self, queue: UpdateQueue, dispatcher: Dispatcher, bot: Bot, **kwargs):
+        super().__init__(dispatcher=dispatcher, bot=bot, **kwargs)
+        self.queue = queue
+
+    async def handle(self, request: web.Request) -> web.Response:
+        passed_bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), passed_bot):
+            return web.Response(body="Unauthorized", status=401)
+        raw_update = await request.json(loads=passed_bot.session.json_loads)
+        update = types.Update.model_validate(raw_update, context={"bot": passed_bot})
+        if not self.queue.put(passed_bot, update):
+            return web.Response(status=503, text="Service Unavailable: update queue is full.")
+        return web.json_response({}, dumps=passed_bot.session.json_dumps)
+
+    async def close(self) -> None:
+        # Сначала дорабатываем принятые апдейты, потом закрываем сессию бота
+        await self.queue.close()
+        await super().close()
+
+
 # --- HTTP-эндпоинт для cron-задачи ---
-async def cron_job_handler(request: web.Request):
-    CRON_SECRET_KEY = os.getenv("CRON_SECRET_KEY") # Убедитесь, что эта переменная задана на Render
+def check_cron_auth(request: web.Request) -> web.Response | None:
+    """Проверяет Bearer-токен CRON_SECRET_KEY. Возвращает ответ с ошибкой или None, если доступ разрешен."""
+    CRON_SECRET_KEY = config.cron_secret_key
     if not CRON_SECRET_KEY:
         logger.error("CRON_SECRET_KEY не установлен. Доступ к cron_job_handler запрещен.")
         return web.Response(status=403, text="Forbidden: CRON_SECRET_KEY not set.")
@@ -916,93 +2562,254 @@ async def cron_job_handler(request: web.Request):
     if provided_key != CRON_SECRET_KEY:
         logger.warning(f"Неверный CRON_SECRET_KEY. Предоставлено: {provided_key[:5]}... Ожидалось: {CRON_SECRET_KEY[:5]}...")
         return web.Response(status=403, text="Forbidden: Invalid secret key.")
+    return None
+
+
+async def prewarm_handler(request: web.Request):
+    """Запускает прогрев гороскопов на завтра в фоне (если он еще не идет)."""
+    global _prewarm_task
+    denied = check_cron_auth(request)
+    if denied is not None:
+        return denied
+    if horoscopes_collection is None:
+        return web.Response(status=503, text="Service Unavailable: HOROSCOPE_CACHE_COLLECTION is not configured.")
+    status = "running"
+    if _prewarm_task is None or _prewarm_task.done():
+        _prewarm_task = spawn_background(prewarm_horoscopes())
+        status = "started"
+    return web.json_response({"status": status}, status=202)
+
+
+def _run_response(run: dict, status: int = 200) -> web.Response:
+    return web.json_response(run, status=status, dumps=lambda data: json.dumps(data, default=str))
+
+
+async def cron_job_handler(request: web.Request):
+    denied = check_cron_auth(request)
+    if denied is not None:
+        return denied
 
     logger.info("Cron job handler triggered!")
-    # Вызываем вашу функцию рассылки гороскопов
+    if broadcast_runs_collection is None:
+        return web.Response(status=503, text="Service Unavailable: MongoDB is not connected.")
+    # Рассылка выполняется в фоне, ответ с id запуска возвращается сразу
     try:
-        await scheduled_tasks()
-        return web.Response(text="Cron job executed successfully!")
+        run = await start_broadcast_run()
+        return _run_response({"run_id": run["_id"], "status": run["status"]}, status=202)
     except Exception as e:
-        logger.error(f"Ошибка выполнения запланированных задач: {e}", exc_info=True)
+        logger.error(f"Ошибка запуска рассылки: {e}", exc_info=True)
         return web.Response(status=500, text=f"Internal Server Error: {e}")
 
 
+async def broadcast_status_handler(request: web.Request):
+    denied = check_cron_auth(request)
+    if denied is not None:
+        return denied
+    if broadcast_runs_collection is None:
+        return web.Response(status=503, text="Service Unavailable: MongoDB is not connected.")
+    run = await broadcast_runs_collection.find_one({"_id": request.match_info["run_id"]})
+    if run is None:
+        return web.Response(status=404, text="Not Found: unknown run id.")
+    return _run_response(run)
+
+
+async def mongo_stats_handler(request: web.Request):
+    """Задержки команд, загрузка пула и состояние размыкателя MongoDB."""
+    denied = check_cron_auth(request)
+    if denied is not None:
+        return denied
+    return web.json_response(mongo_stats())
+
+
+async def queue_stats_handler(request: web.Request):
+    """Глубина очереди апдейтов, счетчики и задержка обработки."""
+    denied = check_cron_auth(request)
+    if denied is not None:
+        return denied
+    return web.json_response(update_queue.stats())
+
+
+def render_metrics() -> str:
+    """Все метрики процесса в текстовом формате Prometheus."""
+    out = PrometheusText()
+    handler_metrics.write(out)
+    api_metrics.write(out)
+
+    for (collection, operation), count in db_calls.items():
+        out.counter("astrox_db_calls_total", "Запросы к MongoDB по коллекциям и операциям",
+                    count, collection=collection, operation=operation)
+    for command, histogram in command_listener.histograms.items():
+        out.histogram("astrox_mongo_command_duration_seconds", "Задержка команд MongoDB", histogram, command=command)
+        out.counter("astrox_mongo_command_failures_total", "Команды MongoDB, завершившиеся ошибкой",
+                    command_listener.failures.get(command, 0), command=command)
+    out.gauge("astrox_mongo_pool_open_connections", "Открытые соединения пула MongoDB", pool_listener.open_connections)
+    out.gauge("astrox_mongo_pool_checked_out", "Занятые соединения пула MongoDB", pool_listener.checked_out)
+    out.counter("astrox_mongo_pool_checkout_failures_total", "Неудачные попытки взять соединение из пула",
+                pool_listener.checkout_failures)
+    out.histogram("astrox_mongo_pool_checkout_wait_seconds", "Ожидание свободного соединения пула",
+                  pool_listener.checkout_wait)
+    out.gauge("astrox_mongo_breaker_open", "Размыкатель MongoDB разомкнут (1) или замкнут (0)",
+              int(mongo_breaker.state != "closed"))
+    out.counter("astrox_mongo_breaker_trips_total", "Срабатывания размыкателя MongoDB", mongo_breaker.trips)
+
+    caches = {
+        "users": (user_cache.hits, user_cache.misses, len(user_cache)),
+        "referrers": (referrer_cache.hits, referrer_cache.misses, len(referrer_cache)),
+        "horoscopes": (horoscope_cache.hits + horoscope_cache.shared_hits, horoscope_cache.misses,
+                       len(horoscope_cache)),
+    }
+    for cache, (hits, misses, size) in caches.items():
+        out.counter("astrox_cache_hits_total", "Попадания в кэш", hits, cache=cache)
+        out.counter("astrox_cache_misses_total", "Промахи кэша", misses, cache=cache)
+        out.gauge("astrox_cache_hit_ratio", "Доля попаданий в кэш с момента запуска",
+                  hits / (hits + misses) if hits + misses else 0.0, cache=cache)
+        out.gauge("astrox_cache_size", "Записей в кэше", size, cache=cache)
+
+    out.gauge("astrox_update_queue_depth", "Апдейтов в очереди", update_queue.depth)
+    out.gauge("astrox_update_queue_shedding", "Необязательная работа пропускается (1) или нет (0)",
+              int(update_queue.shedding))
+    for name in ("accepted", "rejected", "processed", "failed", "shed"):
+        out.counter(f"astrox_update_queue_{name}_total", f"Счетчик {name} очереди апдейтов", getattr(update_queue, name))
+    out.histogram("astrox_update_queue_latency_seconds", "Время от приема апдейта до конца обработки",
+                  update_queue.latency)
+    out.counter("astrox_registrations_total", "Зарегистрированные пользователи", registrations.registrations)
+    out.counter("astrox_registration_batches_total", "Пачки регистраций, записанные в MongoDB", registrations.batches)
+
+    out.gauge("astrox_broadcast_active", "Рассылки, выполняемые этим процессом", len(active_broadcasts))
+    for run_id, broadcaster in active_broadcasts.items():
+        stats = broadcaster.stats()
+        for name in ("processed", "sent", "failed", "blocked", "retried"):
+            out.counter(f"astrox_broadcast_{name}_total", f"Счетчик {name} текущей рассылки", stats[name], run_id=run_id)
+        out.gauge("astrox_broadcast_queued", "Сообщений в очереди рассылки", stats["queued"], run_id=run_id)
+        out.gauge("astrox_broadcast_messages_per_second", "Средняя скорость рассылки", stats["per_second"], run_id=run_id)
+    return out.render()
+
+
+async def metrics_handler(request: web.Request):
+    """Метрики в формате Prometheus (защищены тем же CRON_SECRET_KEY, что и остальные служебные маршруты)."""
+    denied = check_cron_auth(request)
+    if denied is not None:
+        return denied
+    return web.Response(body=render_metrics().encode(), headers={"Content-Type": PrometheusText.CONTENT_TYPE})
+
+
+async def index_stats_handler(request: web.Request):
+    """Статистика использования индексов MongoDB (защищена тем же CRON_SECRET_KEY)."""
+    denied = check_cron_auth(request)
+    if denied is not None:
+        return denied
+    if users_collection is None:
+        return web.Response(status=503, text="Service Unavailable: MongoDB is not connected.")
+    return web.json_response(await index_usage())
+
+
 # Функция для установки вебхука и инициализации БД (будет вызвана при деплое на Render)
 async def on_startup(passed_bot: Bot) -> None:
     logger.info("Инициализация...")
+    # Файл фраз читается лениво; проверяем его до приема апдейтов, а не на первом гороскопе
+    aspect_phrases()
     await init_mongodb() # Инициализируем MongoDB при старте
+    try:
+        await check_schema()
+    except Exception as e:
+        logger.error(f"Ошибка проверки схемы MongoDB: {e}", exc_info=True)
+    try:
+        await load_bot_identity(passed_bot)
+    except Exception as e:
+        # Не фатально: username будет запрошен при первой отправке гороскопа
+        logger.error(f"Не удалось получить данные бота: {e}", exc_info=True)
+    Keyboard.warm_up()
+    await resume_broadcast_runs() # Продолжаем рассылку, прерванную перезапуском
     logger.info("Установка вебхука...")
-    if WEBHOOK_URL:
+    if config.webhook_url:
         try:
-            await passed_bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
-            logger.info(f"Вебхук установлен на: {WEBHOOK_URL}")
+            await passed_bot.set_webhook(config.webhook_url, drop_pending_updates=True)
+            logger.info(f"Вебхук установлен на: {config.webhook_url}")
         except Exception as e:
             logger.error(f"Ошибка при установке вебхука: {e}", exc_info=True)
             # Не фатально, если вебхук уже установлен или есть временные проблемы
     else:
         logger.error("WEBHOOK_HOST не установлен. Вебхук не будет настроен. Убедитесь, что переменная окружения WEBHOOK_HOST задана на Render.")
+    # Миграции и индексы — после вебхука, чтобы полный проход по users не задерживал старт
+    if users_collection is not None:
+        spawn_background(migrate_schema_in_background())
 
-@app.post(WEBHOOK_PATH)
-async def bot_webhook(request: Request):
-    telegram_update = types.Update(**await request.json())
-    await dp.feed_update(bot=bot, update=telegram_update)
-    return {'ok': True}
 
-@app.get("/")
-async def root():
-    return {"message": "AstroX API is running"}
+async def root_handler(request: web.Request):
+    return web.json_response({"message": "AstroX API is running"})
 
 
 # Закрытие соединения с БД при завершении работы бота
 async def on_shutdown(passed_bot: Bot) -> None:
     logger.info("Завершение работы бота...")
+    await registrations.close()
     if mongo_client:
         mongo_client.close()
         logger.info("MongoDB соединение закрыто.")
 
 
 # --- ГЛАВНАЯ ТОЧКА ВХОДА ДЛЯ RENDER (WEBHOOK/AIOHTTP) И ЛОКАЛЬНОЙ РАЗРАБОТКИ (LONG-POLLING) ---
+def create_web_app() -> web.Application:
+    """aiohttp-приложение: вебхук через update_queue и служебные маршруты."""
+    web_app = web.Application()
+
+    # --- НАСТРОЙКА WEBHOOK ДЛЯ AIOGRAM 3.X С AIOHTTP ---
+    # Единственный путь приема апдейтов. Тело разбирается json_loads сессии бота (orjson,
+    # если установлен) и Update.model_validate, апдейт уходит в update_queue, а Telegram
+    # сразу получает 200 — медленный обработчик не вызывает повторную доставку.
+    update_queue.start(dp)
+    webhook_requests_handler = QueuedRequestHandler(
+        update_queue,
+        dispatcher=dp,
+        bot=bot,
+        handle_http_errors=True, # Рекомендуется для обработки ошибок
+    )
+    # Регистрируем обработчик вебхука по config.webhook_path
+    webhook_requests_handler.register(web_app, path=config.webhook_path)
+    # --- КОНЕЦ НАСТРОЙКИ WEBHOOK ---
+
+    # Добавляем маршрут для cron-задачи
+    web_app.add_routes([
+        web.get('/', root_handler),
+        web.get('/run_daily_horoscopes', cron_job_handler),
+        web.get('/broadcast_runs/{run_id}', broadcast_status_handler),
+        web.get('/prewarm_horoscopes', prewarm_handler),
+        web.get('/index_stats', index_stats_handler),
+        web.get('/mongo_stats', mongo_stats_handler),
+        web.get('/queue_stats', queue_stats_handler),
+        web.get('/metrics', metrics_handler),
+    ])
+
+    # Дополнительная настройка приложения aiohttp (например, graceful shutdown)
+    setup_application(web_app, dp, bot=bot)
+    return web_app
+
+
 async def main():
+    create_app(Config.from_env()) # Проверяем настройки и создаем бота и диспетчер
     await on_startup(bot) # Выполняем инициализацию и устанавливаем вебхук
 
     # Регистрируем on_shutdown для корректного закрытия соединений
     dp.shutdown.register(on_shutdown)
 
-    # Запускаем в режиме вебхука, если WEBHOOK_HOST и WEB_SERVER_PORT установлены
-    if WEBHOOK_HOST and WEB_SERVER_PORT:
-        logger.info(f"Запуск бота в режиме вебхука на порту {WEB_SERVER_PORT} (для Render).")
-
-        web_app = web.Application()
-
-        # --- НАСТРОЙКА WEBHOOK ДЛЯ AIOGRAM 3.X С AIOHTTP ---
-        webhook_requests_handler = SimpleRequestHandler(
-            dispatcher=dp,
-            bot=bot,
-            handle_http_errors=True, # Рекомендуется для обработки ошибок
-        )
-        # Регистрируем обработчик вебхука по WEBHOOK_PATH
-        webhook_requests_handler.register(web_app, path=WEBHOOK_PATH)
-        # --- КОНЕЦ НАСТРОЙКИ WEBHOOK ---
-
-        # Добавляем маршрут для cron-задачи
-        web_app.add_routes([web.get('/run_daily_horoscopes', cron_job_handler)])
-        
-        # Дополнительная настройка приложения aiohttp (например, graceful shutdown)
-        setup_application(web_app, dp, bot=bot) 
+    # Запускаем в режиме вебхука, если WEBHOOK_HOST и PORT установлены
+    if config.webhook_host and config.port:
+        logger.info(f"Запуск бота в режиме вебхука на порту {config.port} (для Render).")
 
+        web_app = create_web_app()
         runner = web.AppRunner(web_app)
         await runner.setup()
         
         # Запуск веб-сервера на всех доступных интерфейсах (0.0.0.0) и порту от Render
-        site = web.TCPSite(runner, host='0.0.0.0', port=int(WEB_SERVER_PORT))
+        site = web.TCPSite(runner, host='0.0.0.0', port=config.port)
         await site.start()
 
-        logger.info(f"Веб-сервер запущен на порту {WEB_SERVER_PORT}")
+        logger.info(f"Веб-сервер запущен на порту {config.port}")
         # Держим сервер запущенным, предотвращая завершение
         await asyncio.Event().wait()
     else:
         logger.warning("Переменные окружения WEBHOOK_HOST или PORT не установлены. Запуск в режиме long-polling.")
-        # Если WEBHOOK_HOST или WEB_SERVER_PORT не установлены (например, при локальном запуске),
+        # Если WEBHOOK_HOST или PORT не установлены (например, при локальном запуске),
         # запускаем long-polling
         try:
             await dp.start_polling(bot, drop_pending_updates=True)
@@ -1010,10 +2817,42 @@ async def main():
             logger.error(f"Ошибка при запуске long-polling: {e}", exc_info=True)
 
 
+async def run_job(name: str, job: Callable[[], Awaitable[dict]]):
+    """Разовая задача из командной строки (бэкфилл, прогрев): нужен только MONGO_URI, токен бота не нужен."""
+    global config
+    config = Config.from_env()
+    await init_mongodb()
+    if users_collection is None:
+        logger.error(f"MongoDB не подключена, задача «{name}» не выполнена.")
+        return
+    try:
+        started = time.monotonic()
+        result = await job()
+        logger.info(f"{name}: выполнено за {time.monotonic() - started:.1f} с: {result}")
+    finally:
+        mongo_client.close()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AstroX — бот с ежедневными гороскопами")
+    parser.add_argument("--backfill-birth-dates", action="store_true",
+                        help="записать birth_ymd и sign во все профили MongoDB и выйти")
+    parser.add_argument("--migrate", action="store_true",
+                        help="выполнить недостающие миграции схемы MongoDB и выйти")
+    parser.add_argument("--prewarm-horoscopes", action="store_true",
+                        help="посчитать гороскопы на завтра в HOROSCOPE_CACHE_COLLECTION и выйти")
+    args = parser.parse_args()
+    if args.migrate:
+        entry = run_job("Миграция схемы", migrate_schema)
+    elif args.backfill_birth_dates:
+        entry = run_job("Бэкфилл дат рождения", backfill_birth_dates)
+    elif args.prewarm_horoscopes:
+        entry = run_job("Прогрев гороскопов", prewarm_horoscopes)
+    else:
+        entry = main()
     # Эта часть должна быть в самом конце файла для запуска main()
     try:
-        asyncio.run(main())
+        asyncio.run(entry)
     except KeyboardInterrupt:
         logger.info("Бот остановлен вручную.")
     except Exception as e:
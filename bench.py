@@ -0,0 +1,810 @@
+"""Офлайн-бенчмарки бота: генерация гороскопов, клавиатуры, обработчики и рассылка.
+
+Все прогоны идут без сети и без настоящей БД: вместо коллекций motor используется
+фейковая коллекция в памяти, вместо сессии aiogram — сессия, которая только считает
+вызовы Bot API. Скрипт измеряет:
+
+* задержку и выделения памяти на один гороскоп (`HoroscopeGenerator.generate`);
+* `HoroscopeGenerator.generate_many` пачками и его побайтное совпадение с `generate`
+  для обоих ГСЧ, md5 и счетного (при расхождении скрипт завершается с ненулевым кодом);
+* отдельно рендер по шаблону знака (`horoscope_skeleton`) на заранее сделанных выборах,
+  компиляцию шаблонов и тот же рендер склейкой строк каталога, как было до шаблонов
+  (результаты должны совпадать побайтно);
+* время сборки и выдачи клавиатур `Keyboard.*`;
+* число запросов к MongoDB и к Bot API на каждый обработчик — если обработчик
+  превышает свой бюджет запросов к MongoDB, скрипт завершается с ненулевым кодом;
+* ночной прогрев гороскопов в пуле процессов (`prewarm_horoscopes`): скорость, размер
+  сжатых записей и рассылку, которая берет прогретые гороскопы из кэша (прогретый текст
+  должен совпадать с `generate_many`, а рассылка — не генерировать ни одного гороскопа);
+* перезапуск рассылки после падения процесса посреди пачки: каждый пользователь должен
+  получить гороскоп (повторы допустимы, потери — нет);
+* пропускную способность рассылки (сообщений в секунду) на 10k и 100k пользователей
+  без лимитов Telegram, то есть собственные накладные расходы бота.
+
+Результаты можно сохранить в JSON и сравнить с прогоном на другом коммите:
+
+    python bench.py --output bench-before.json
+    python bench.py --baseline bench-before.json
+
+Запуск: python bench.py [--users 10000 100000] [--generate 5000]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+import zlib
+from collections import Counter
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+# Фейковые секреты, чтобы модуль astro можно было импортировать без окружения Render
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
+os.environ.setdefault("TON_WALLET_ADDRESS", "UQ-test-wallet")
+os.environ.pop("ADSGRAM_API_KEY", None)
+# Рассылка меряется без лимитов Telegram: интересны только накладные расходы самого бота
+os.environ["BROADCAST_RATE"] = "1000000"
+os.environ["BROADCAST_PER_CHAT_INTERVAL"] = "0"
+
+from aiogram import types
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetMe, SendMessage
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+
+import astro
+import horoscope
+import prng
+from horoscope import HoroscopeGenerator
+from texts import CATALOG, TEXTS, LocalizedProfile
+
+# Логи о каждом обработанном апдейте только мешают читать таблицу
+logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+logging.getLogger("astro").setLevel(logging.WARNING)
+# Ошибки о неверных датах рождения в проверочных профилях ожидаемы
+logging.getLogger("horoscope").setLevel(logging.CRITICAL)
+
+USER_ID = 1001
+REFERRER_ID = 2002
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    async def to_list(self, length=None):
+        return list(self._docs)
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for doc in self._docs:
+            yield doc
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    """Проверяет документ на соответствие фильтру (только операторы, которые использует бот)."""
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(_matches(doc, branch) for branch in condition):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(condition, dict) and condition and next(iter(condition)).startswith("$"):
+            for op, operand in condition.items():
+                if op == "$in" and value not in operand:
+                    return False
+                if op == "$gt" and (value is None or not value > operand):
+                    return False
+                if op == "$lt" and (value is None or not value < operand):
+                    return False
+                if op == "$exists" and (key in doc) != operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCollection:
+    """Замена коллекции motor в памяти, считающая вызовы по типам операций.
+
+    Поддерживает ровно то подмножество запросов, которым пользуются обработчики и рассылка.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.calls = Counter()
+
+    def _select(self, query: dict) -> list:
+        # Фильтр по _id (значение или $in) не требует полного прохода по коллекции
+        _id = query.get("_id")
+        if _id is None or (isinstance(_id, dict) and "$in" not in _id):
+            candidates = self.docs.values()
+        elif isinstance(_id, dict):
+            candidates = [self.docs[key] for key in _id["$in"] if key in self.docs]
+        else:
+            candidates = [self.docs[_id]] if _id in self.docs else []
+        return [doc for doc in candidates if _matches(doc, query)]
+
+    async def find_one(self, query, *args, **kwargs):
+        self.calls["find_one"] += 1
+        docs = self._select(query)
+        return dict(docs[0]) if docs else None
+
+    async def update_one(self, query, update, upsert=False):
+        self.calls["update_one"] += 1
+        docs = self._select(query)
+        if docs:
+            self._apply(docs[0], update)
+        elif upsert:
+            self._upsert(query, update)
+        return SimpleNamespace(matched_count=len(docs[:1]))
+
+    async def update_many(self, query, update, upsert=False):
+        self.calls["update_many"] += 1
+        docs = self._select(query)
+        for doc in docs:
+            self._apply(doc, update)
+        return SimpleNamespace(matched_count=len(docs))
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=ReturnDocument.BEFORE):
+        self.calls["find_one_and_update"] += 1
+        docs = self._select(query)
+        if not docs:
+            if not upsert:
+                return None
+            doc = self._upsert(query, update)
+            return dict(doc) if return_document == ReturnDocument.AFTER else None
+        before = dict(docs[0])
+        self._apply(docs[0], update)
+        return dict(docs[0]) if return_document == ReturnDocument.AFTER else before
+
+    def _upsert(self, query: dict, update: dict) -> dict:
+        doc = {key: value for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict)}
+        doc.update(update.get("$setOnInsert", {}))
+        self.docs[doc["_id"]] = doc
+        self._apply(doc, update)
+        return doc
+
+    @staticmethod
+    def _apply(doc: dict, update: dict):
+        doc.update(update.get("$set", {}))
+        for key, value in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + value
+        for key in update.get("$unset", {}):
+            doc.pop(key, None)
+        for key, value in update.get("$addToSet", {}).items():
+            values = doc.setdefault(key, [])
+            if value not in values:
+                values.append(value)
+
+    async def bulk_write(self, operations, ordered=True):
+        self.calls["bulk_write"] += 1
+        # UpdateOne (RegistrationBatcher, кэш гороскопов), ReplaceOne и DeleteOne (MongoStorage)
+        for op in operations:
+            docs = self._select(op._filter)
+            if isinstance(op, DeleteOne):
+                for doc in docs:
+                    del self.docs[doc["_id"]]
+            elif isinstance(op, ReplaceOne):
+                if docs or op._upsert:
+                    self.docs[op._filter["_id"]] = {"_id": op._filter["_id"], **op._doc}
+            elif docs:
+                self._apply(docs[0], op._doc)
+            elif op._upsert:
+                self._upsert(op._filter, op._doc)
+
+    async def insert_many(self, docs, ordered=True):
+        self.calls["insert_many"] += 1
+        errors = []
+        for index, doc in enumerate(docs):
+            if doc["_id"] in self.docs:
+                errors.append({"index": index, "code": 11000})
+            else:
+                self.docs[doc["_id"]] = dict(doc)
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+    def find(self, query=None, projection=None, batch_size=None, sort=None):
+        self.calls["find"] += 1
+        docs = self._select(query or {})
+        if sort:
+            docs.sort(key=lambda doc: doc["_id"])
+        if projection:
+            docs = [{key: doc[key] for key in ("_id", *projection) if key in doc} for doc in docs]
+        else:
+            docs = [dict(doc) for doc in docs]
+        return FakeCursor(docs)
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+class DeadCollection:
+    """Коллекция упавшего процесса: любой запрос к MongoDB завершается ошибкой."""
+
+    def __getattr__(self, name):
+        def dead(*args, **kwargs):
+            raise ConnectionError("процесс упал")
+        return dead
+
+
+class FakeSession(BaseSession):
+    """Сессия бота, которая ничего не отправляет, а только считает вызовы API.
+
+    Если задан kill_after, после стольких SendMessage вызывается on_kill, и дальше все
+    запросы падают — так имитируется падение процесса посреди рассылки.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+        self.recipients = Counter()
+        self.kill_after = None
+        self.on_kill = None
+        self.dead = False
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.dead:
+            raise ConnectionError("процесс упал")
+        if isinstance(method, SendMessage) and self.kill_after is not None and self.calls["SendMessage"] >= self.kill_after:
+            self.dead = True
+            self.on_kill()
+            raise ConnectionError("процесс упал")
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, SendMessage):
+            self.recipients[method.chat_id] += 1
+        if isinstance(method, GetMe):
+            return types.User(id=1, is_bot=True, first_name="Astro", username="astro_test_bot")
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def _user() -> types.User:
+    return types.User(id=USER_ID, is_bot=False, first_name="Bench", username="bench")
+
+
+def _chat() -> types.Chat:
+    return types.Chat(id=USER_ID, type="private")
+
+
+def message_update(text: str) -> types.Update:
+    message = types.Message(message_id=1, date=datetime.now(), chat=_chat(), from_user=_user(), text=text)
+    return types.Update(update_id=1, message=message)
+
+
+def callback_update(data: str) -> types.Update:
+    message = types.Message(message_id=1, date=datetime.now(), chat=_chat(), text="...")
+    callback = types.CallbackQuery(id="1", from_user=_user(), chat_instance="1", message=message, data=data)
+    return types.Update(update_id=1, callback_query=callback)
+
+
+# (название, апдейт, максимально допустимое число запросов к MongoDB, включая fsm_states)
+SCENARIOS = [
+    # Новый пользователь: кроме профиля читается его (пустое) состояние FSM — дальше оно в кэше —
+    # и записывается ожидание даты рождения
+    ("start", lambda: message_update("/start"), 4),
+    ("start_referral", lambda: message_update(f"/start {REFERRER_ID}"), 4),
+    ("process_birth_date", lambda: message_update("15.04.1990"), 2),
+    ("send_horoscope", lambda: message_update(TEXTS["ru"]["main_menu_horoscope"]), 1),
+    ("settings_menu", lambda: message_update(TEXTS["ru"]["main_menu_settings"]), 1),
+    ("request_sign_change", lambda: callback_update("change_sign"), 1),
+    ("set_user_sign", lambda: callback_update("set_sign_leo"), 2),
+    # Знак уже сохранен: запись пропускается
+    ("set_user_sign_unchanged", lambda: callback_update("set_sign_leo"), 0),
+    ("set_user_language", lambda: callback_update("set_lang_ru"), 2),
+    ("support_us_menu", lambda: message_update(TEXTS["ru"]["main_menu_support"]), 1),
+    ("entertainment_menu", lambda: message_update(TEXTS["ru"]["main_menu_entertainment"]), 1),
+    ("get_cookie_fortune", lambda: callback_update("get_cookie_fortune"), 1),
+]
+
+
+def _percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _sample_profiles(count: int) -> list:
+    """Профили с разными знаками и датами рождения (с датой и без нее считается по-разному).
+
+    birth_ymd заполнен, как после backfill_birth_dates; профили без него — в _edge_profiles.
+    """
+    signs = list(HoroscopeGenerator.SIGNS)
+    birth_dates = [None, "15.04.1990", "29.02.1996", "31.12.1975"]
+    profiles = []
+    for user_id in range(1, count + 1):
+        birth_date = birth_dates[user_id % len(birth_dates)]
+        profiles.append({
+            "_id": user_id, "sign": signs[user_id % len(signs)], "lang": "ru", "birth_date": birth_date,
+            "birth_ymd": HoroscopeGenerator.parse_birth_date(birth_date) if birth_date else None,
+        })
+    return profiles
+
+
+async def bench_generate(count: int) -> dict:
+    """Задержка и выделения памяти на один вызов HoroscopeGenerator.generate."""
+    profiles = [LocalizedProfile(doc["_id"], doc) for doc in _sample_profiles(count)]
+    await HoroscopeGenerator.generate(profiles[0])  # фразы аспектов загружаются при первом вызове
+
+    latencies = []
+    for profile in profiles:
+        started = time.perf_counter()
+        await HoroscopeGenerator.generate(profile)
+        latencies.append((time.perf_counter() - started) * 1e6)
+
+    # Отдельный проход под tracemalloc: он сам замедляет код и не должен влиять на задержку
+    peaks = []
+    tracemalloc.start()
+    for profile in profiles[:min(count, 1000)]:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        await HoroscopeGenerator.generate(profile)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    return {
+        "calls": count,
+        "mean_us": round(statistics.fmean(latencies), 2),
+        "p50_us": round(_percentile(latencies, 0.5), 2),
+        "p99_us": round(_percentile(latencies, 0.99), 2),
+        "peak_bytes_mean": round(statistics.fmean(peaks)),
+        "peak_bytes_max": max(peaks),
+    }
+
+
+def _edge_profiles() -> list:
+    """Профили, на которых легко разойтись с generate: без знака, с неизвестным знаком, без языка, с неверной датой."""
+    return [
+        {"_id": 1, "lang": "ru", "birth_date": "15.04.1990"},
+        {"_id": 2, "sign": "unknown", "lang": "ru", "birth_date": None},
+        {"_id": 3, "sign": "leo"},
+        {"_id": 4, "sign": "virgo", "lang": "ru", "birth_date": "31.02.1990"},
+        {"_id": 5, "lang": "ru", "birth_date": None},
+    ]
+
+
+async def bench_generate_many(count: int, counter: bool = False, batch_size: int = 1000) -> tuple[dict, list]:
+    """generate_many пачками по batch_size против generate по одному; результаты должны совпадать побайтно.
+
+    counter=True включает счетный ГСЧ (как HOROSCOPE_PRNG_SINCE в прошлом), иначе — md5.
+    """
+    docs = _sample_profiles(count) + _edge_profiles()
+    profiles = [LocalizedProfile(doc["_id"], doc) for doc in docs]
+    since = prng.COUNTER_PRNG_SINCE
+    prng.COUNTER_PRNG_SINCE = date.min if counter else None
+    try:
+        expected = [await HoroscopeGenerator.generate(profile) for profile in profiles]
+        started = time.perf_counter()
+        actual = []
+        for i in range(0, len(profiles), batch_size):
+            actual += await HoroscopeGenerator.generate_many(profiles[i:i + batch_size])
+        elapsed = time.perf_counter() - started
+    finally:
+        prng.COUNTER_PRNG_SINCE = since
+
+    mode = "counter" if counter else "md5"
+    mismatches = [profile.user_id for profile, a, b in zip(profiles, actual, expected) if a != b]
+    failures = [f"generate_many ({mode}) расходится с generate для пользователей {mismatches[:10]}"] if mismatches else []
+    return {
+        "calls": len(profiles),
+        "batch_size": batch_size,
+        "numpy": counter and prng.numpy is not None,
+        "mean_us": round(elapsed / len(profiles) * 1e6, 2),
+        "mismatches": len(mismatches),
+    }, failures
+
+
+def _render_concat(sign_key: str, lang: str, today: datetime, values: dict) -> str:
+    """Тот же гороскоп склейкой строк каталога — так generate собирал текст до шаблонов."""
+    sign_info = HoroscopeGenerator.SIGNS.get(sign_key, {})
+    text = CATALOG.render(lang, "horoscope_title", emoji=sign_info.get('emoji', '✨')) + "\n\n"
+    text += CATALOG.render(lang, "horoscope_sign", sign=CATALOG.get(lang, f"sign_{sign_key}"),
+                           element=CATALOG.get(lang, sign_info.get('element_key', ''))) + "\n"
+    text += CATALOG.render(lang, "horoscope_date", date=today.strftime('%d %b %Y')) + "\n"
+    text += values["age_line"] + "\n"
+    for aspect, (rating, score, description) in zip(horoscope.ASPECT_KEYS, horoscope.ASPECT_SLOTS):
+        text += (f"{CATALOG.get(lang, 'horoscope_' + aspect)}: {values[rating]} {values[score]}/10\n"
+                 f"<i>\" {values[description]} \"</i>\n\n")
+    text += (
+        CATALOG.render(lang, "horoscope_mood", mood=values["mood"]) + "\n"
+        f"{CATALOG.render(lang, 'horoscope_lucky_color', color=values['color'])}\n"
+        f"{CATALOG.render(lang, 'horoscope_lucky_number', number=values['number'])}\n"
+        f"{CATALOG.render(lang, 'horoscope_ruling_planet', planet=CATALOG.get(lang, sign_info.get('planet_key', 'planet_crystal')))}\n"
+        f"{CATALOG.render(lang, 'horoscope_lucky_stone', stone=CATALOG.get(lang, sign_info.get('lucky_stone_key', 'stone_crystal')))}\n"
+        f"{CATALOG.render(lang, 'horoscope_compatibility', compatible_signs=values['compatible_signs'])}\n\n"
+        f"{CATALOG.render(lang, 'horoscope_tip', tip=values['tip'])}\n\n"
+        f"<i>{CATALOG.get(lang, 'horoscope_closing_message')}</i>"
+    )
+    return text
+
+
+async def bench_render(count: int) -> tuple[dict, list]:
+    """Рендер гороскопа отдельно от выборов: шаблон знака против склейки строк каталога."""
+    await HoroscopeGenerator.generate_many([])  # фразы аспектов загружаются при первом вызове
+    today = datetime.now()
+    seeder = prng.DailySeeder(today, counter=False)
+    today_ymd = HoroscopeGenerator.to_ymd(today)
+    groups = {}
+    cases = []
+    for doc in _sample_profiles(count):
+        profile = LocalizedProfile(doc["_id"], doc)
+        sign_key = HoroscopeGenerator.resolve_sign(doc)
+        parts = groups.get(sign_key)
+        if parts is None:
+            parts = groups[sign_key] = horoscope.SharedHoroscopeParts(sign_key, profile.lang, today)
+        birth_ymd = HoroscopeGenerator.birth_ymd(doc)
+        age_line = HoroscopeGenerator._age_line(birth_ymd, today_ymd, profile.lang) if birth_ymd else ""
+        rng = seeder.rng(profile.user_id, sign_key, horoscope.sign_index(sign_key))
+        cases.append((sign_key, profile.lang, parts.skeleton, parts.draw(rng, age_line)))
+
+    started = time.perf_counter()
+    rendered = [skeleton.render(values) for _, _, skeleton, values in cases]
+    render_us = (time.perf_counter() - started) / len(cases) * 1e6
+    started = time.perf_counter()
+    concatenated = [_render_concat(sign_key, lang, today, values) for sign_key, lang, _, values in cases]
+    concat_us = (time.perf_counter() - started) / len(cases) * 1e6
+
+    # Компиляция раскладки языка и заготовки для каждого знака — то, что делается раз в день
+    started = time.perf_counter()
+    layout = horoscope.HoroscopeTemplate.compile(horoscope.HOROSCOPE_LAYOUT, "ru")
+    for sign_key in HoroscopeGenerator.SIGNS:
+        layout.bind(emoji="", sign=sign_key, element="", date="", planet="", stone="", closing="",
+                    **{f"{aspect}_title": aspect for aspect in horoscope.ASPECT_KEYS})
+    compile_us = (time.perf_counter() - started) * 1e6
+
+    mismatches = sum(a != b for a, b in zip(rendered, concatenated))
+    failures = [f"рендер по шаблону расходится со склейкой строк каталога в {mismatches} гороскопах"] if mismatches else []
+    return {
+        "calls": len(cases),
+        "render_us": round(render_us, 2),
+        "concat_us": round(concat_us, 2),
+        "compile_us": round(compile_us, 1),
+        "segments": len(cases[0][2].segments),
+        "mismatches": mismatches,
+    }, failures
+
+
+async def bench_keyboards(repeat: int = 2000) -> dict:
+    """Время выдачи клавиатур из кэша и время их сборки с нуля, в микросекундах на вызов."""
+    user_ctx = astro.UserContext(USER_ID, {"_id": USER_ID, "lang": "ru"})
+    await astro.get_bot_username()
+    astro.Keyboard.warm_up()
+    menus = ["main_menu", "settings_menu", "sign_selection_menu", "language_selection_menu",
+             "entertainment_menu", "donate_menu"]
+    results = {}
+    for menu in menus:
+        cached = getattr(astro.Keyboard, menu)
+        build = getattr(astro.Keyboard, f"_build_{menu}")
+        started = time.perf_counter()
+        for _ in range(repeat):
+            cached(user_ctx)
+        cached_us = (time.perf_counter() - started) / repeat * 1e6
+        started = time.perf_counter()
+        for _ in range(repeat // 10):
+            build("ru")
+        build_us = (time.perf_counter() - started) / (repeat // 10) * 1e6
+        results[menu] = {"cached_us": round(cached_us, 3), "build_us": round(build_us, 2)}
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        await astro.Keyboard.horoscope_actions(user_ctx)
+    results["horoscope_actions"] = {"cached_us": round((time.perf_counter() - started) / repeat * 1e6, 3)}
+    return results
+
+
+async def bench_handlers(bot, dp, session: FakeSession) -> tuple[dict, list]:
+    """Прогоняет SCENARIOS и считает запросы к MongoDB и Bot API на каждый обработчик."""
+    collection = FakeCollection()
+    referrals = FakeCollection()
+    fsm_states = FakeCollection()
+    astro.users_collection = collection
+    astro.referrals_collection = referrals
+    # Состояния FSM aiogram читает на каждом апдейте — эти чтения тоже входят в бюджет
+    astro.storage.bind(fsm_states)
+    collection.docs[REFERRER_ID] = {"_id": REFERRER_ID, "sign": "leo", "lang": "ru"}
+
+    results = {}
+    failures = []
+    for name, make_update, budget in SCENARIOS:
+        collections = (collection, referrals, fsm_states)
+        for counted in collections:
+            counted.calls.clear()
+        session.calls.clear()
+        started = time.perf_counter()
+        await dp.feed_update(bot, make_update())
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        # Отложенная запись состояний относится к этому апдейту, а не к следующему сценарию
+        await astro.storage.close()
+        db_calls = sum(counted.total for counted in collections)
+        results[name] = {
+            "db_calls": db_calls, "budget": budget,
+            "api_calls": sum(session.calls.values()), "ms": round(elapsed_ms, 2),
+        }
+        if db_calls > budget:
+            calls = collection.calls + referrals.calls + Counter({f"fsm.{op}": n for op, n in fsm_states.calls.items()})
+            failures.append(f"{name}: {db_calls} запросов к MongoDB при бюджете {budget} ({dict(calls)})")
+    astro.storage.bind(None)
+    return results, failures
+
+
+async def bench_broadcast(session: FakeSession, users: int) -> dict:
+    """Полный запуск рассылки на users пользователей: чтение курсора, чекпоинты и отправка."""
+    collections = {
+        "users_collection": FakeCollection(),
+        "broadcast_runs_collection": FakeCollection(),
+        "deliveries_collection": FakeCollection(),
+    }
+    for name, collection in collections.items():
+        setattr(astro, name, collection)
+    collections["users_collection"].docs = {doc["_id"]: doc for doc in _sample_profiles(users)}
+    # Свежий кэш, иначе гороскопы прошлого прогона попадут в кэш и исказят замер
+    astro.horoscope_cache = astro.HoroscopeCache(astro.HOROSCOPE_CACHE_MAX_SIZE)
+    session.calls.clear()
+
+    started = time.perf_counter()
+    await astro.start_broadcast_run(background=False)
+    elapsed = time.perf_counter() - started
+
+    sent = session.calls["SendMessage"]
+    return {
+        "users": users,
+        "sent": sent,
+        "elapsed_s": round(elapsed, 2),
+        "msgs_per_s": round(sent / elapsed, 1),
+        "db_calls": sum(collection.total for collection in collections.values()),
+    }
+
+
+async def bench_broadcast_resume(session: FakeSession, users: int = 1000) -> tuple[dict, list]:
+    """Процесс падает посреди пачки рассылки, другой процесс продолжает запуск после истечения аренды."""
+    collections = {
+        "users_collection": FakeCollection(),
+        "broadcast_runs_collection": FakeCollection(),
+        "deliveries_collection": FakeCollection(),
+    }
+    for name, collection in collections.items():
+        setattr(astro, name, collection)
+    collections["users_collection"].docs = {doc["_id"]: doc for doc in _sample_profiles(users)}
+    astro.horoscope_cache = astro.HoroscopeCache(astro.HOROSCOPE_CACHE_MAX_SIZE)
+    session.calls.clear()
+    session.recipients.clear()
+
+    def kill():
+        # Упавший процесс больше ничего не пишет в MongoDB
+        for name in collections:
+            setattr(astro, name, DeadCollection())
+
+    # Середина пачки, причем пачки перед ней уже записали чекпоинты
+    every = astro.BROADCAST_CHECKPOINT_EVERY
+    killed_after = users // 2 // every * every + every // 2
+    session.kill_after, session.on_kill = killed_after, kill
+    instance_id = astro.INSTANCE_ID
+    # Без рекламы: в recipients считаются только гороскопы, и повтор — это повторная доставка
+    build_ad, astro.build_ad = astro.build_ad, lambda user_ctx: None
+    try:
+        try:
+            run = await astro.start_broadcast_run(background=False)
+        except ConnectionError:
+            pass
+        session.kill_after, session.on_kill, session.dead = None, None, False
+        for name, collection in collections.items():
+            setattr(astro, name, collection)
+        run_id = f"daily-{datetime.now().strftime('%Y%m%d')}"
+        run = collections["broadcast_runs_collection"].docs[run_id]
+        # Новый процесс: другой INSTANCE_ID, аренда упавшего уже истекла
+        run["lease_until"] = datetime.now() - timedelta(seconds=1)
+        astro.INSTANCE_ID = uuid.uuid4().hex
+        await astro.execute_broadcast_run(run_id)
+    finally:
+        astro.INSTANCE_ID = instance_id
+        astro.build_ad = build_ad
+        session.kill_after, session.on_kill, session.dead = None, None, False
+
+    lost = [user_id for user_id in collections["users_collection"].docs if not session.recipients[user_id]]
+    not_sent = [doc["_id"] for doc in collections["deliveries_collection"].docs.values() if doc["status"] != "sent"]
+    failures = []
+    if lost or not_sent or run["status"] != "done":
+        failures.append(f"рассылка после падения: статус {run['status']}, не получили гороскоп {len(lost)} "
+                        f"(например {lost[:5]}), доставок не в статусе sent {len(not_sent)}")
+    return {
+        "users": users,
+        "killed_after": killed_after,
+        "lost": len(lost),
+        "resent": sum(count - 1 for count in session.recipients.values() if count > 1),
+    }, failures
+
+
+async def bench_prewarm(session: FakeSession, users: int) -> tuple[dict, list]:
+    """Прогрев гороскопов на сегодня в пуле процессов и рассылка, которая берет их из общего кэша."""
+    collections = {
+        "users_collection": FakeCollection(),
+        "horoscopes_collection": FakeCollection(),
+        "broadcast_runs_collection": FakeCollection(),
+        "deliveries_collection": FakeCollection(),
+    }
+    for name, collection in collections.items():
+        setattr(astro, name, collection)
+    docs = _sample_profiles(users)
+    collections["users_collection"].docs = {doc["_id"]: doc for doc in docs}
+    try:
+        started = time.perf_counter()
+        stats = await astro.prewarm_horoscopes(datetime.now())
+        prewarm_s = time.perf_counter() - started
+
+        stored = collections["horoscopes_collection"].docs
+        compressed = [doc["z"] for doc in stored.values()]
+        raw_bytes = sum(len(zlib.decompress(blob)) for blob in compressed)
+        day = datetime.now().strftime('%Y%m%d')
+        expected = await HoroscopeGenerator.generate_many([LocalizedProfile(doc["_id"], doc) for doc in docs])
+        mismatches = sum(
+            astro.HoroscopeCache._text(stored.get(astro.HoroscopeCache._doc_id(
+                doc["_id"], day, HoroscopeGenerator.resolve_sign(doc), doc.get("lang", "ru")), {"text": None})) != text
+            for doc, text in zip(docs, expected)
+        )
+
+        astro.horoscope_cache = astro.HoroscopeCache(astro.HOROSCOPE_CACHE_MAX_SIZE)
+        session.calls.clear()
+        started = time.perf_counter()
+        await astro.start_broadcast_run(background=False)
+        broadcast_s = time.perf_counter() - started
+        generated = astro.horoscope_cache.misses
+    finally:
+        astro.horoscopes_collection = None
+
+    failures = []
+    if mismatches or stats["stored"] != users:
+        failures.append(f"прогрев: сохранено {stats['stored']} из {users}, расходится с generate_many {mismatches}")
+    if generated:
+        failures.append(f"рассылка после прогрева сгенерировала {generated} гороскопов вместо чтения из кэша")
+    return {
+        "users": users,
+        "processes": astro.PREWARM_PROCESSES,
+        "prewarm_s": round(prewarm_s, 2),
+        "prewarm_per_s": round(users / prewarm_s, 1),
+        "compression_ratio": round(raw_bytes / sum(len(blob) for blob in compressed), 2),
+        "bytes_per_user": round(sum(len(blob) for blob in compressed) / users),
+        "msgs_per_s": round(session.calls["SendMessage"] / broadcast_s, 1),
+        "mismatches": mismatches,
+    }, failures
+
+
+def _git_commit() -> str | None:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def _flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+# Метрики, у которых больше — лучше; у остальных (время, память, запросы) лучше меньше
+HIGHER_IS_BETTER = ("msgs_per_s", "prewarm_per_s", "compression_ratio")
+# Изменения меньше порога считаются шумом
+REGRESSION_THRESHOLD = 0.10
+
+
+def compare(results: dict, baseline: dict):
+    """Печатает изменения относительно baseline и помечает регрессии больше REGRESSION_THRESHOLD."""
+    print(f"\nСравнение с {baseline.get('commit') or 'baseline'}:")
+    current, previous = _flatten(results), _flatten(baseline)
+    for path, value in current.items():
+        old = previous.get(path)
+        if old is None or path.endswith((".budget", ".users", ".calls", ".batch_size", ".segments", ".processes")):
+            continue
+        change = (value - old) / old if old else 0.0
+        worse = -change if path.endswith(HIGHER_IS_BETTER) else change
+        mark = "  <-- регрессия" if worse > REGRESSION_THRESHOLD else ""
+        print(f"  {path:<48}{old:>12}{value:>12}{change:>+9.1%}{mark}")
+
+
+def print_results(results: dict):
+    generate = results["generate"]
+    print(f"generate: {generate['mean_us']} мкс в среднем, p50 {generate['p50_us']}, p99 {generate['p99_us']}, "
+          f"пик памяти {generate['peak_bytes_mean']} Б (макс. {generate['peak_bytes_max']} Б)")
+    for key, label in (("generate_many", "md5"), ("generate_many_counter", "splitmix64")):
+        many = results[key]
+        print(f"generate_many ({label}{', numpy' if many['numpy'] else ''}): {many['mean_us']} мкс на гороскоп "
+              f"(пачки по {many['batch_size']}), расхождений с generate: {many['mismatches']}")
+    render = results["render"]
+    print(f"render: {render['render_us']} мкс по шаблону знака ({render['segments']} сегментов), "
+          f"{render['concat_us']} мкс склейкой строк; компиляция шаблонов {render['compile_us']} мкс, "
+          f"расхождений: {render['mismatches']}")
+
+    print(f"\n{'keyboard':<28}{'cached us':>11}{'build us':>10}")
+    for menu, timings in results["keyboards"].items():
+        print(f"{menu:<28}{timings['cached_us']:>11}{timings.get('build_us', '-'):>10}")
+
+    print(f"\n{'handler':<28}{'db calls':>10}{'budget':>8}{'api calls':>11}{'ms':>9}")
+    for name, row in results["handlers"].items():
+        print(f"{name:<28}{row['db_calls']:>10}{row['budget']:>8}{row['api_calls']:>11}{row['ms']:>9.2f}")
+
+    print(f"\n{'broadcast users':<28}{'sent':>10}{'seconds':>10}{'msgs/s':>11}{'db calls':>10}")
+    for row in results["broadcast"].values():
+        print(f"{row['users']:<28}{row['sent']:>10}{row['elapsed_s']:>10}{row['msgs_per_s']:>11}{row['db_calls']:>10}")
+
+    resume = results["broadcast_resume"]
+    print(f"broadcast resume: падение после {resume['killed_after']} из {resume['users']} сообщений, "
+          f"потеряно {resume['lost']}, отправлено повторно {resume['resent']}")
+
+    prewarm = results["prewarm"]
+    print(f"\nprewarm: {prewarm['users']} гороскопов за {prewarm['prewarm_s']} с в {prewarm['processes']} процессах "
+          f"({prewarm['prewarm_per_s']}/с), {prewarm['bytes_per_user']} Б на запись (сжатие x{prewarm['compression_ratio']}), "
+          f"рассылка из кэша {prewarm['msgs_per_s']} msgs/s, расхождений: {prewarm['mismatches']}")
+
+
+async def run(args) -> int:
+    session = FakeSession()
+    bot, dp = astro.create_app(astro.Config.from_env(), session=session)
+
+    results = {
+        "commit": _git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "generate": await bench_generate(args.generate),
+    }
+    results["generate_many"], failures = await bench_generate_many(args.generate)
+    results["generate_many_counter"], counter_failures = await bench_generate_many(args.generate, counter=True)
+    failures += counter_failures
+    results["render"], render_failures = await bench_render(args.generate)
+    failures += render_failures
+    results["keyboards"] = await bench_keyboards()
+    results["handlers"], handler_failures = await bench_handlers(bot, dp, session)
+    failures += handler_failures
+    results["broadcast"] = {str(users): await bench_broadcast(session, users) for users in args.users}
+    results["broadcast_resume"], resume_failures = await bench_broadcast_resume(session)
+    failures += resume_failures
+    results["prewarm"], prewarm_failures = await bench_prewarm(session, min(args.users))
+    failures += prewarm_failures
+    await bot.session.close()
+
+    print_results(results)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.output}")
+
+    if failures:
+        print("\nПроверки не пройдены:", *failures, sep="\n  ")
+        return 1
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки бота")
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000],
+                        help="размеры рассылки (число пользователей)")
+    parser.add_argument("--generate", type=int, default=5000, help="число гороскопов для замера generate")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
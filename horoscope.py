@@ -0,0 +1,541 @@
+"""Генератор гороскопов.
+
+Не зависит от aiogram, MongoDB и переменных окружения бота: модуль можно импортировать
+и гонять в бенчмарках отдельно от astro.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import string
+import zlib
+from datetime import datetime
+from typing import Dict, Sequence
+
+import prng
+from texts import CATALOG, DEFAULT_LANG, LocalizedProfile
+
+logger = logging.getLogger(__name__)
+
+# Файл с фразами для аспектов гороскопа (можно подменить без деплоя кода)
+ASPECT_PHRASES_PATH = os.getenv("ASPECT_PHRASES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "aspect_phrases.json"))
+
+
+# --- Фразы для аспектов гороскопа ---
+# Аспекты в порядке вывода; заголовок аспекта берется из каталога по ключу horoscope_<аспект>
+ASPECT_KEYS = ("love", "career", "finance", "health")
+# Эмодзи оценки по баллу 1..10 (индекс 0 не используется)
+RATING_EMOJI = ("", "🚨", "🚨", "⚠️", "⚠️", "✨", "✨", "✨", "🌟", "🌟", "🌟")
+
+
+# --- Знак зодиака по дате ---
+# Первый день каждого знака (месяц, день); до 20 января — козерог с прошлого декабря
+ZODIAC_STARTS = (
+    (1, 20, "aquarius"), (2, 19, "pisces"), (3, 21, "aries"), (4, 20, "taurus"),
+    (5, 21, "gemini"), (6, 21, "cancer"), (7, 23, "leo"), (8, 23, "virgo"),
+    (9, 23, "libra"), (10, 23, "scorpio"), (11, 22, "sagittarius"), (12, 22, "capricorn"),
+)
+
+
+def _build_sign_table() -> tuple:
+    """Знак по индексу месяц * 32 + день (для всех дней високосного года)."""
+    table = ["capricorn"] * (13 * 32)
+    sign = "capricorn"
+    starts = {(month, day): start_sign for month, day, start_sign in ZODIAC_STARTS}
+    for month in range(1, 13):
+        for day in range(1, 32):
+            sign = starts.get((month, day), sign)
+            table[month * 32 + day] = sign
+    return tuple(table)
+
+
+SIGN_BY_MONTH_DAY = _build_sign_table()
+
+
+def load_aspect_phrases(path: str) -> Dict[str, Dict[str, tuple]]:
+    """Загружает и проверяет файл фраз для аспектов.
+
+    Формат файла: {язык: {аспект: {"мин-макс": [фразы, ...]}}}. Диапазоны баллов внутри
+    аспекта не должны пересекаться. Результат — индекс {язык: {аспект: кортеж из 11 элементов}},
+    где элемент с индексом score — фразы для этого балла (пустой кортеж, если фраз нет).
+    """
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+
+    if DEFAULT_LANG not in raw:
+        raise ValueError(f"{path}: нет фраз для языка по умолчанию '{DEFAULT_LANG}'")
+
+    index = {}
+    for lang, aspects in raw.items():
+        missing = set(ASPECT_KEYS) - set(aspects)
+        if missing:
+            raise ValueError(f"{path}: для языка '{lang}' нет аспектов {sorted(missing)}")
+        index[lang] = {}
+        for aspect, bands in aspects.items():
+            by_score = [None] * 11
+            for band, phrases in bands.items():
+                try:
+                    low, high = (int(bound) for bound in band.split("-"))
+                except ValueError:
+                    raise ValueError(f"{path}: {lang}/{aspect}: неверный диапазон '{band}'") from None
+                if not 1 <= low <= high <= 10:
+                    raise ValueError(f"{path}: {lang}/{aspect}: диапазон '{band}' вне 1..10")
+                if not phrases or not all(isinstance(phrase, str) and phrase for phrase in phrases):
+                    raise ValueError(f"{path}: {lang}/{aspect}/{band}: нужен непустой список строк")
+                band_phrases = tuple(phrases)
+                for score in range(low, high + 1):
+                    if by_score[score] is not None:
+                        raise ValueError(f"{path}: {lang}/{aspect}: балл {score} попадает в несколько диапазонов")
+                    by_score[score] = band_phrases
+            uncovered = [score for score in range(1, 11) if by_score[score] is None]
+            if uncovered:
+                logger.warning(f"{path}: {lang}/{aspect}: нет фраз для баллов {uncovered}, описание будет пустым")
+            index[lang][aspect] = tuple(phrases or () for phrases in by_score)
+    logger.info(f"Загружены фразы аспектов из {path}: языки {sorted(index)}")
+    return index
+
+
+_aspect_phrases: Dict[str, Dict[str, tuple]] | None = None
+
+
+def aspect_phrases() -> Dict[str, Dict[str, tuple]]:
+    """Индекс фраз аспектов. Файл читается и проверяется при первом обращении."""
+    global _aspect_phrases
+    if _aspect_phrases is None:
+        _aspect_phrases = load_aspect_phrases(ASPECT_PHRASES_PATH)
+    return _aspect_phrases
+
+
+# Генератор гороскопов
+class HoroscopeGenerator:
+    SIGNS = {
+        "aries": {"emoji": "♈️", "element_key": "element_fire", "character": ["энергичный", "смелый", "импульсивный"], "planet_key": "planet_mars", "lucky_number": [9], "lucky_stone_key": "stone_diamond"},
+        "taurus": {"emoji": "♉️", "element_key": "element_earth", "character": ["стабильный", "терпеливый", "упрямый"], "planet_key": "planet_venus", "lucky_number": [6], "lucky_stone_key": "stone_emerald"},
+        "gemini": {"emoji": "♊️", "element_key": "element_air", "character": ["адаптивный", "любопытный", "нерешительный"], "planet_key": "planet_mercury", "lucky_number": [5], "lucky_stone_key": "stone_agate"},
+        "cancer": {"emoji": "♋️", "element_key": "element_water", "character": ["заботливый", "эмоциональный", "защитник"], "planet_key": "planet_moon", "lucky_number": [2], "lucky_stone_key": "stone_pearl"},
+        "leo": {"emoji": "♌️", "element_key": "element_fire", "character": ["уверенный", "щедрый", "властный"], "planet_key": "planet_sun", "lucky_number": [1], "lucky_stone_key": "stone_ruby"},
+        "virgo": {"emoji": "♍️", "element_key": "element_earth", "character": ["аналитический", "практичный", "критичный"], "planet_key": "planet_mercury", "lucky_number": [5], "lucky_stone_key": "stone_sapphire"},
+        "libra": {"emoji": "♎️", "element_key": "element_air", "character": ["гармоничный", "дипломатичный", "нерешительный"], "planet_key": "planet_venus", "lucky_number": [6], "lucky_stone_key": "stone_opal"},
+        "scorpio": {"emoji": "♏️", "element_key": "element_water", "character": ["интенсивный", "страстный", "скрытный"], "planet_key": "planet_pluto", "lucky_number": [8], "lucky_stone_key": "stone_topaz"},
+        "sagittarius": {"emoji": "♐️", "element_key": "element_fire", "character": ["авантюрный", "оптимистичный", "беспокойный"], "planet_key": "planet_jupiter", "lucky_number": [3], "lucky_stone_key": "stone_turquoise"},
+        "capricorn": {"emoji": "♑️", "element_key": "element_earth", "character": ["дисциплинированный", "ответственный", "пессимистичный"], "planet_key": "planet_saturn", "lucky_number": [8], "lucky_stone_key": "stone_garnet"},
+        "aquarius": {"emoji": "♒️", "element_key": "element_air", "character": ["инновационный", "независимый", "безэмоциональный"], "planet_key": "planet_uranus", "lucky_number": [4], "lucky_stone_key": "stone_amethyst"},
+        "pisces": {"emoji": "♓️", "element_key": "element_water", "character": ["сострадательный", "артистичный", "склонный к эскапизму"], "planet_key": "planet_neptune", "lucky_number": [7], "lucky_stone_key": "stone_aquamarine"},
+    }
+
+    MOODS = {
+        "ru": ["Оптимистичное", "Задумчивое", "Энергичное", "Спокойное", "Осторожное", "Радостное", "Вдохновленное", "Гармоничное", "Надежное"],
+    }
+    LUCKY_COLORS = {
+        "ru": ["Синий", "Зеленый", "Золотой", "Серебряный", "Красный", "Фиолетовый", "Розовый", "Желтый", "Бирюзовый", "Лавандовый"],
+    }
+    COMPATIBILITY = {
+        "aries": ["leo", "sagittarius", "gemini", "aquarius"], "taurus": ["virgo", "capricorn", "cancer", "pisces"],
+        "gemini": ["libra", "aquarius", "aries", "leo"], "cancer": ["scorpio", "pisces", "taurus", "virgo"],
+        "leo": ["aries", "sagittarius", "gemini", "libra"], "virgo": ["taurus", "capricorn", "cancer", "scorpio"],
+        "libra": ["gemini", "aquarius", "leo", "sagittarius"], "scorpio": ["cancer", "pisces", "virgo", "capricorn"],
+        "sagittarius": ["aries", "leo", "libra", "aquarius"], "capricorn": ["taurus", "virgo", "scorpio", "pisces"],
+        "aquarius": ["gemini", "libra", "aries", "sagittarius"], "pisces": ["cancer", "scorpio", "taurus", "capricorn"],
+    }
+
+    # Предсказания для "Печенья с предсказаниями"
+    COOKIE_FORTUNES = [
+        "Вас ждет неожиданная удача.",
+        "Прислушайтесь к своему внутреннему голосу.",
+        "Сегодня идеальный день для новых начинаний.",
+        "Ваша доброта будет вознаграждена.",
+        "Не бойтесь перемен, они к лучшему.",
+        "Вас ждет приятная встреча.",
+        "Сосредоточьтесь на своих мечтах.",
+        "Ваше упорство принесет плоды.",
+        "Найдите радость в мелочах.",
+        "Впереди вас ждет увлекательное приключение.",
+        "День принесет новые возможности.",
+        "Будьте открыты для новых идей."
+    ]
+
+    # Ответы для "Шара с ответами"
+    MAGIC_BALL_ANSWERS = {
+        "positive": [
+            "Безусловно!", "Да.", "Весьма вероятно.", "Можете быть уверены в этом.", "Да, определенно.",
+            "Без сомнения.", "Как я вижу, да."
+        ],
+        "negative": [
+            "Мои источники говорят нет.", "Очень сомнительно.", "Не рассчитывайте на это.", "Нет.", "Перспективы не очень хорошие."
+        ],
+        "neutral": [
+            "Сконцентрируйся и спроси снова.", "Ответ неясен, попробуй еще раз.", "Лучше не говорить тебе сейчас.",
+            "Не могу предсказать сейчас."
+        ]
+    }
+
+
+    @staticmethod
+    def _generate_aspect_description(aspect: str, score: int, rng: random.Random, lang: str) -> str:
+        index = aspect_phrases()
+        phrases = index.get(lang) or index[DEFAULT_LANG]
+        band = phrases[aspect][score]
+        return rng.choice(band) if band else ""
+
+    @staticmethod
+    def to_ymd(value: datetime) -> int:
+        """Дата числом YYYYMMDD — в таком виде дата рождения хранится в профиле (birth_ymd)."""
+        return value.year * 10000 + value.month * 100 + value.day
+
+    @staticmethod
+    def parse_birth_date(birth_date_str: str) -> int:
+        """Строка ДД.ММ.ГГГГ в YYYYMMDD; 0, если строка в неверном формате."""
+        try:
+            return HoroscopeGenerator.to_ymd(datetime.strptime(birth_date_str, "%d.%m.%Y"))
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def birth_ymd(user_data: dict) -> int | None:
+        """Дата рождения профиля в виде YYYYMMDD: None — не указана, 0 — указана в неверном формате.
+
+        Берется из birth_ymd, который пишут process_birth_date и backfill_birth_dates; строка
+        birth_date разбирается только у профилей, до которых бэкфилл еще не дошел.
+        """
+        if not user_data.get("birth_date"):
+            return None
+        ymd = user_data.get("birth_ymd")
+        if ymd is None:
+            ymd = HoroscopeGenerator.parse_birth_date(user_data["birth_date"])
+        return ymd
+
+    @staticmethod
+    def age_from_ymd(birth_ymd: int, today_ymd: int) -> int:
+        # Разность YYYYMMDD, деленная на 10000, — число полных лет (день и месяц сравниваются сами)
+        return (today_ymd - birth_ymd) // 10000
+
+    @staticmethod
+    def calculate_age(birth_date: datetime) -> int:
+        return HoroscopeGenerator.age_from_ymd(HoroscopeGenerator.to_ymd(birth_date), HoroscopeGenerator.to_ymd(datetime.now()))
+
+    @staticmethod
+    def sign_from_ymd(ymd: int) -> str:
+        return SIGN_BY_MONTH_DAY[ymd // 100 % 100 * 32 + ymd % 100]
+
+    @staticmethod
+    def get_zodiac_sign(birth_date: datetime) -> str:
+        return SIGN_BY_MONTH_DAY[birth_date.month * 32 + birth_date.day]
+
+    @staticmethod
+    def get_year_ending(age: int, lang: str) -> str:
+        if age % 10 == 1 and age % 100 != 11:
+            return CATALOG.get(lang, "years_singular")
+        elif age % 10 >= 2 and age % 10 <= 4 and (age % 100 < 10 or age % 100 >= 20):
+            return CATALOG.get(lang, "years_plural_2_4")
+        else:
+            return CATALOG.get(lang, "years_plural_5_plus")
+
+    @staticmethod
+    def resolve_sign(user_data: dict) -> str:
+        return user_data.get('sign', HoroscopeGenerator.get_zodiac_sign(datetime.now()) if user_data.get('birth_date') else "aries")
+
+    @staticmethod
+    async def generate(user_ctx: LocalizedProfile) -> str:
+        user_id = user_ctx.user_id
+        user_data = user_ctx.data
+        lang = user_ctx.lang
+        
+        sign_key = HoroscopeGenerator.resolve_sign(user_data)
+        today = datetime.now()
+
+        rng = prng.DailySeeder(today).rng(user_id, sign_key, sign_index(sign_key))
+
+        # Генерация аспектов
+        aspects = {aspect: rng.randint(1, 10) for aspect in ASPECT_KEYS}
+
+        # Дополнительные элементы прогноза
+        sign_info = HoroscopeGenerator.SIGNS.get(sign_key, {})
+        mood = rng.choice(HoroscopeGenerator.MOODS[lang])
+        lucky_color = rng.choice(HoroscopeGenerator.LUCKY_COLORS[lang])
+        lucky_number = rng.choice(sign_info.get("lucky_number", [rng.randint(1, 9)]))
+        
+        available_compatible_signs = HoroscopeGenerator.COMPATIBILITY.get(sign_key, [])
+        compatible_signs_keys = rng.sample(available_compatible_signs, k=min(2, len(available_compatible_signs)))
+        # Переводим названия знаков для совместимости
+        compatible_signs = [user_ctx.text(f"sign_{s}") for s in compatible_signs_keys]
+
+        if not compatible_signs:
+            compatible_signs.append(user_ctx.text("compatibility_not_defined"))
+
+        tips = CATALOG.list(lang, "horoscope_tips")
+        if not tips:
+            tips = ["Сегодня отличный день!", "Будьте внимательны к деталям!"]
+
+        # Слоты пользователя; знак, дата, планета и камень уже подставлены в шаблон знака на день
+        values = {"age_line": "", "mood": mood, "color": lucky_color, "number": lucky_number,
+                  "compatible_signs": ', '.join(compatible_signs)}
+
+        birth_ymd = HoroscopeGenerator.birth_ymd(user_data)
+        if birth_ymd:
+            values["age_line"] = HoroscopeGenerator._age_line(birth_ymd, HoroscopeGenerator.to_ymd(today), lang)
+        elif birth_ymd == 0:
+            logger.error(f"Неверный формат даты рождения для пользователя {user_id}: {user_data['birth_date']}")
+
+        for aspect, (rating, score_slot, description), score in zip(ASPECT_KEYS, ASPECT_SLOTS, aspects.values()):
+            values[rating] = RATING_EMOJI[score]
+            values[score_slot] = score
+            values[description] = HoroscopeGenerator._generate_aspect_description(aspect, score, rng, lang)
+        values["tip"] = rng.choice(tips)
+        return horoscope_skeleton(sign_key, lang, today).render(values)
+
+    @staticmethod
+    async def generate_many(profiles: Sequence[LocalizedProfile], today: datetime | None = None) -> list[str]:
+        """Гороскопы для пачки пользователей, в том же порядке; каждый побайтно совпадает с generate.
+
+        Данные для выборов собираются один раз на группу (знак, язык), шаблон знака —
+        один раз на день (horoscope_skeleton), строка возраста — один раз на дату рождения. На каждого
+        пользователя остаются только seed и случайные выборы в том же порядке, что и в generate.
+        Со счетным ГСЧ и numpy числа для всех пользователей знака считаются одним draw_matrix.
+        today задает день гороскопа (по умолчанию сегодня) — так prewarm_shard готовит завтрашние.
+        """
+        today = today or datetime.now()
+        seeder = prng.DailySeeder(today)
+        sign_keys = [HoroscopeGenerator.resolve_sign(profile.data) for profile in profiles]
+        rngs = HoroscopeGenerator._counter_rngs(profiles, sign_keys, seeder) if seeder.counter and prng.numpy is not None else None
+        today_ymd = HoroscopeGenerator.to_ymd(today)
+        groups: Dict[tuple, SharedHoroscopeParts] = {}
+        age_lines: Dict[tuple, str] = {}
+        horoscopes = []
+        for i, (profile, sign_key) in enumerate(zip(profiles, sign_keys)):
+            user_data = profile.data
+            lang = profile.lang
+            parts = groups.get((sign_key, lang))
+            if parts is None:
+                parts = groups[(sign_key, lang)] = SharedHoroscopeParts(sign_key, lang, today)
+
+            age_line = ""
+            birth_ymd = HoroscopeGenerator.birth_ymd(user_data)
+            if birth_ymd:
+                key = (birth_ymd, lang)
+                age_line = age_lines.get(key)
+                if age_line is None:
+                    age_line = age_lines[key] = HoroscopeGenerator._age_line(birth_ymd, today_ymd, lang)
+            elif birth_ymd == 0:
+                logger.error(f"Неверный формат даты рождения для пользователя {profile.user_id}: {user_data['birth_date']}")
+
+            rng = rngs[i] if rngs is not None else seeder.rng(profile.user_id, sign_key, sign_index(sign_key))
+            horoscopes.append(parts.render(rng, age_line))
+        return horoscopes
+
+    @staticmethod
+    def _counter_rngs(profiles: Sequence[LocalizedProfile], sign_keys: list, seeder: prng.DailySeeder) -> list:
+        """CounterRng для каждого профиля; ключи и первые слова считаются numpy по группам знака."""
+        by_sign: Dict[str, list] = {}
+        for i, sign_key in enumerate(sign_keys):
+            by_sign.setdefault(sign_key, []).append(i)
+        rngs = [None] * len(profiles)
+        for sign_key, indices in by_sign.items():
+            keys, words = prng.draw_matrix([profiles[i].user_id for i in indices], seeder.ordinal,
+                                           sign_index(sign_key), DRAW_WORDS)
+            for i, key, row in zip(indices, keys.tolist(), words.tolist()):
+                rngs[i] = prng.CounterRng(key, row)
+        return rngs
+
+    @staticmethod
+    def _age_line(birth_ymd: int, today_ymd: int, lang: str) -> str:
+        """Строка возраста с переводом строки."""
+        age = HoroscopeGenerator.age_from_ymd(birth_ymd, today_ymd)
+        years_ending = HoroscopeGenerator.get_year_ending(age, lang)
+        return CATALOG.render(lang, "horoscope_age", age=age, years=years_ending) + "\n"
+
+
+# Номер знака в ключе счетного ГСЧ; неизвестные знаки получают общий номер после известных
+SIGN_INDEX = {sign: i for i, sign in enumerate(HoroscopeGenerator.SIGNS)}
+# Слов CounterRng, которых хватает на один гороскоп: до 15 выборов по 4 на слово
+DRAW_WORDS = 4
+
+
+def sign_index(sign_key: str) -> int:
+    return SIGN_INDEX.get(sign_key, len(SIGN_INDEX))
+
+
+def prewarm_shard(docs: list, today: datetime) -> list[tuple]:
+    """Гороскопы на день today для пачки профилей MongoDB — выполняется в процессе пула ProcessPoolExecutor.
+
+    Возвращает (user_id, знак, язык, текст в zlib): сжатие тоже делается здесь, а не в цикле событий бота.
+    Если пачка целиком не генерируется (например, профиль с неизвестным языком), гороскопы
+    генерируются по одному и пропускаются только сломанные профили.
+    """
+    profiles = [LocalizedProfile(doc["_id"], doc) for doc in docs]
+    try:
+        texts = asyncio.run(HoroscopeGenerator.generate_many(profiles, today))
+    except Exception as e:
+        logger.error(f"Ошибка пакетной генерации гороскопов, генерирую по одному: {e}")
+        texts = []
+        for profile in profiles:
+            try:
+                texts.append(asyncio.run(HoroscopeGenerator.generate_many([profile], today))[0])
+            except Exception as e:
+                logger.error(f"Не удалось подготовить гороскоп пользователю {profile.user_id}: {e}")
+                texts.append(None)
+    return [
+        (profile.user_id, HoroscopeGenerator.resolve_sign(profile.data), profile.lang, zlib.compress(text.encode()))
+        for profile, text in zip(profiles, texts) if text is not None
+    ]
+
+
+# --- Шаблон гороскопа ---
+# Раскладка сообщения. Поля horoscope_* — строки каталога: они разворачиваются в свои литералы и поля;
+# остальные поля — слоты, которые заполняет генератор (строки каталога, взятые как есть, тоже слоты).
+HOROSCOPE_LAYOUT = (
+    "{horoscope_title}\n\n{horoscope_sign}\n{horoscope_date}\n{age_line}\n"
+    + "".join(f"{{{aspect}_title}}: {{{aspect}_rating}} {{{aspect}_score}}/10\n<i>\" {{{aspect}_description}} \"</i>\n\n"
+              for aspect in ASPECT_KEYS)
+    + "{horoscope_mood}\n{horoscope_lucky_color}\n{horoscope_lucky_number}\n{horoscope_ruling_planet}\n"
+      "{horoscope_lucky_stone}\n{horoscope_compatibility}\n\n{horoscope_tip}\n\n<i>{closing}</i>"
+)
+CATALOG_FIELD_PREFIX = "horoscope_"
+# Слоты балла аспекта: эмодзи оценки, балл, описание
+ASPECT_SLOTS = tuple((f"{aspect}_rating", f"{aspect}_score", f"{aspect}_description") for aspect in ASPECT_KEYS)
+
+
+class HoroscopeTemplate:
+    """Скомпилированный шаблон: список сегментов, часть которых — слоты.
+
+    segments — литералы, на месте слотов стоят пустые строки; slots — пары (позиция, имя, формат).
+    render копирует список, ставит значения слотов и склеивает все одним "".join.
+    """
+    __slots__ = ("segments", "slots")
+
+    def __init__(self, segments: list, slots: tuple):
+        self.segments = segments
+        self.slots = slots
+
+    @classmethod
+    def compile(cls, layout: str, lang: str) -> "HoroscopeTemplate":
+        """Разбирает раскладку для языка, разворачивая в нее строки каталога."""
+        segments, slots = [], []
+        for literal, field, spec, conversion in string.Formatter().parse(layout):
+            if literal:
+                segments.append(literal)
+            if field is None:
+                continue
+            if not field.startswith(CATALOG_FIELD_PREFIX):
+                slots.append((len(segments), field, spec))
+                segments.append("")
+                continue
+            template = CATALOG.template(lang, field)
+            if not template.fields:
+                # Как в Template.render: строка без подстановок берется как есть
+                segments.append(template.text)
+                continue
+            for literal, name, spec, conversion in string.Formatter().parse(template.text):
+                if literal:
+                    segments.append(literal)
+                if name is None:
+                    continue
+                if conversion or not name.isidentifier():
+                    raise ValueError(f"{lang}/{field}: поле '{name}' не поддерживается шаблоном гороскопа")
+                slots.append((len(segments), name, spec))
+                segments.append("")
+        return cls(segments, tuple(slots))
+
+    def bind(self, **values) -> "HoroscopeTemplate":
+        """Шаблон, в котором известные заранее слоты уже подставлены, а соседние литералы склеены."""
+        by_position = {position: (name, spec) for position, name, spec in self.slots}
+        segments, slots, literal = [], [], []
+        for position, segment in enumerate(self.segments):
+            slot = by_position.get(position)
+            if slot is None:
+                literal.append(segment)
+            elif slot[0] in values:
+                literal.append(format(values[slot[0]], slot[1]))
+            else:
+                if literal:
+                    segments.append("".join(literal))
+                    literal = []
+                slots.append((len(segments), *slot))
+                segments.append("")
+        if literal:
+            segments.append("".join(literal))
+        return HoroscopeTemplate(segments, tuple(slots))
+
+    def render(self, values: dict) -> str:
+        parts = self.segments.copy()
+        for position, name, spec in self.slots:
+            parts[position] = format(values[name], spec)
+        return "".join(parts)
+
+
+# Раскладки по языкам и заготовки по (знак, язык, дата); заготовки прошлых дней выбрасываются
+_layouts: Dict[str, HoroscopeTemplate] = {}
+_skeletons: Dict[tuple, HoroscopeTemplate] = {}
+_skeletons_date = ""
+
+
+def horoscope_skeleton(sign_key: str, lang: str, today: datetime) -> HoroscopeTemplate:
+    """Шаблон гороскопа знака на день: остаются только слоты пользователя (баллы, описания, возраст, выборы)."""
+    global _skeletons_date
+    date_text = today.strftime('%d %b %Y')
+    skeleton = _skeletons.get((sign_key, lang, date_text))
+    if skeleton is not None:
+        return skeleton
+    if date_text != _skeletons_date:
+        _skeletons.clear()
+        _skeletons_date = date_text
+    layout = _layouts.get(lang)
+    if layout is None:
+        layout = _layouts[lang] = HoroscopeTemplate.compile(HOROSCOPE_LAYOUT, lang)
+    sign_info = HoroscopeGenerator.SIGNS.get(sign_key, {})
+    skeleton = _skeletons[(sign_key, lang, date_text)] = layout.bind(
+        emoji=sign_info.get('emoji', '✨'),
+        sign=CATALOG.get(lang, f"sign_{sign_key}"),
+        element=CATALOG.get(lang, sign_info.get('element_key', '')),
+        date=date_text,
+        planet=CATALOG.get(lang, sign_info.get("planet_key", "planet_crystal")),
+        stone=CATALOG.get(lang, sign_info.get("lucky_stone_key", "stone_crystal")),
+        closing=CATALOG.get(lang, "horoscope_closing_message"),
+        **{f"{aspect}_title": CATALOG.get(lang, "horoscope_" + aspect) for aspect in ASPECT_KEYS},
+    )
+    return skeleton
+
+
+class SharedHoroscopeParts:
+    """Данные для выборов, общие для всех пользователей с одним знаком и языком, и шаблон знака на день."""
+    __slots__ = ("lang", "skeleton", "phrases", "moods", "colors", "lucky_numbers", "compatible", "tips", "_compatible_names")
+
+    def __init__(self, sign_key: str, lang: str, today: datetime):
+        sign_info = HoroscopeGenerator.SIGNS.get(sign_key, {})
+        self.lang = lang
+        self.skeleton = horoscope_skeleton(sign_key, lang, today)
+        index = aspect_phrases()
+        phrases = index.get(lang) or index[DEFAULT_LANG]
+        self.phrases = tuple(phrases[aspect] for aspect in ASPECT_KEYS)
+        self.moods = HoroscopeGenerator.MOODS[lang]
+        self.colors = HoroscopeGenerator.LUCKY_COLORS[lang]
+        self.lucky_numbers = sign_info.get("lucky_number")
+        self.compatible = HoroscopeGenerator.COMPATIBILITY.get(sign_key, [])
+        self.tips = CATALOG.list(lang, "horoscope_tips") or ["Сегодня отличный день!", "Будьте внимательны к деталям!"]
+        # Выбранные знаки совместимости -> их названия через запятую
+        self._compatible_names: Dict[tuple, str] = {}
+
+    def compatible_names(self, keys: tuple) -> str:
+        names = self._compatible_names.get(keys)
+        if names is None:
+            names = self._compatible_names[keys] = ', '.join(
+                [CATALOG.get(self.lang, f"sign_{s}") for s in keys] or [CATALOG.get(self.lang, "compatibility_not_defined")])
+        return names
+
+    def draw(self, rng: "random.Random | prng.CounterRng", age_line: str) -> dict:
+        """Значения слотов пользователя; порядок обращений к rng тот же, что в HoroscopeGenerator.generate."""
+        scores = [rng.randint(1, 10) for _ in ASPECT_KEYS]
+        values = {"age_line": age_line, "mood": rng.choice(self.moods), "color": rng.choice(self.colors)}
+        fallback_number = rng.randint(1, 9)
+        values["number"] = rng.choice(self.lucky_numbers if self.lucky_numbers is not None else [fallback_number])
+        values["compatible_signs"] = self.compatible_names(tuple(rng.sample(self.compatible, k=min(2, len(self.compatible)))))
+        for (rating, score_slot, description), phrases, score in zip(ASPECT_SLOTS, self.phrases, scores):
+            band = phrases[score]
+            values[rating] = RATING_EMOJI[score]
+            values[score_slot] = score
+            values[description] = rng.choice(band) if band else ""
+        values["tip"] = rng.choice(self.tips)
+        return values
+
+    def render(self, rng: "random.Random | prng.CounterRng", age_line: str) -> str:
+        return self.skeleton.render(self.draw(rng, age_line))
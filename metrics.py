@@ -0,0 +1,157 @@
+"""Метрики бота и их вывод в текстовом формате Prometheus.
+
+Не зависит от aiogram и MongoDB: здесь только счетчики, гистограммы задержек и сборка
+ответа для /metrics. Что именно измерять, решает astro.
+"""
+import threading
+from bisect import bisect_left
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+
+class LatencyHistogram:
+    """Гистограмма задержек в миллисекундах с фиксированными границами корзин.
+
+    Пишется из потоков motor, поэтому изменения защищены блокировкой.
+    """
+    BOUNDS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.buckets = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        # Первая граница, не меньшая ms; за последней границей — корзина inf
+        index = bisect_left(self.BOUNDS_MS, ms)
+        with self._lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+
+    def snapshot(self) -> tuple[list, int, float]:
+        """Согласованная копия корзин, числа наблюдений и суммы (для вывода в /metrics)."""
+        with self._lock:
+            return list(self.buckets), self.count, self.total_ms
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q (inf — за последней границей)."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS_MS + (float("inf"),), self.buckets):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return 0.0
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": self.total_ms / self.count if self.count else 0.0,
+            "max_ms": self.max_ms,
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+            "buckets": dict(zip([str(bound) for bound in self.BOUNDS_MS] + ["inf"], self.buckets)),
+        }
+
+
+class UpdateScope:
+    """Учет одного апдейта: какой обработчик его обработал и сколько запросов он сделал."""
+    __slots__ = ("handler", "db_calls", "api_calls")
+
+    def __init__(self):
+        self.handler = "unhandled"
+        self.db_calls = 0
+        self.api_calls = 0
+
+
+# Апдейт, который сейчас обрабатывается в этой задаче (None — рассылка, фоновые задачи)
+current_scope: ContextVar[Optional[UpdateScope]] = ContextVar("current_scope", default=None)
+
+
+class HandlerMetrics:
+    """Задержки, ошибки и число запросов к MongoDB и Bot API по обработчикам."""
+
+    def __init__(self):
+        self.latency: Dict[str, LatencyHistogram] = {}
+        self.errors = Counter()
+        self.db_calls = Counter()
+        self.api_calls = Counter()
+
+    def observe(self, scope: UpdateScope, ms: float, failed: bool = False):
+        histogram = self.latency.get(scope.handler)
+        if histogram is None:
+            histogram = self.latency.setdefault(scope.handler, LatencyHistogram())
+        histogram.observe(ms)
+        self.db_calls[scope.handler] += scope.db_calls
+        self.api_calls[scope.handler] += scope.api_calls
+        if failed:
+            self.errors[scope.handler] += 1
+
+    def write(self, out: "PrometheusText"):
+        for handler, histogram in self.latency.items():
+            out.histogram("astrox_handler_duration_seconds", "Время обработки апдейта по обработчикам",
+                          histogram, handler=handler)
+            out.counter("astrox_handler_errors_total", "Апдейты, завершившиеся исключением",
+                        self.errors[handler], handler=handler)
+            out.counter("astrox_handler_db_calls_total", "Запросы к MongoDB при обработке апдейтов",
+                        self.db_calls[handler], handler=handler)
+            out.counter("astrox_handler_api_calls_total", "Вызовы Bot API при обработке апдейтов",
+                        self.api_calls[handler], handler=handler)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class PrometheusText:
+    """Собирает ответ /metrics в текстовом формате Prometheus 0.0.4.
+
+    Сэмплы одной метрики группируются под одним HELP/TYPE, в каком бы порядке их ни добавляли.
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._families: Dict[str, tuple[str, str, list]] = {}
+
+    def _family(self, name: str, kind: str, help_text: str) -> list:
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, help_text, [])
+        return family[2]
+
+    def counter(self, name: str, help_text: str, value: float, **labels):
+        self._family(name, "counter", help_text).append(f"{name}{_format_labels(labels)} {value}")
+
+    def gauge(self, name: str, help_text: str, value: float, **labels):
+        self._family(name, "gauge", help_text).append(f"{name}{_format_labels(labels)} {float(value)}")
+
+    def histogram(self, name: str, help_text: str, histogram: LatencyHistogram, **labels):
+        """Гистограмма в секундах: корзины LatencyHistogram становятся накопительными le."""
+        samples = self._family(name, "histogram", help_text)
+        buckets, count, total_ms = histogram.snapshot()
+        cumulative = 0
+        for bound, bucket in zip(LatencyHistogram.BOUNDS_MS, buckets):
+            cumulative += bucket
+            samples.append(f"{name}_bucket{_format_labels({**labels, 'le': bound / 1000})} {cumulative}")
+        samples.append(f"{name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+        samples.append(f"{name}_sum{_format_labels(labels)} {total_ms / 1000}")
+        samples.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, samples) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,137 @@
+"""Детерминированные случайные выборы для гороскопов.
+
+Гороскоп пользователя на день должен быть одинаковым при каждом показе, поэтому все выборы
+выводятся из (id пользователя, день, знак). Исходная схема — md5 от строки с датой и новый
+random.Random на каждый гороскоп — дорогая: создание Random с seed занимает больше времени,
+чем сами выборы. CounterRng — счетный ГСЧ на splitmix64: j-е слово потока — это чистая
+функция ключа и j, поэтому создается он мгновенно, а слова можно считать пачкой для массива
+пользователей (draw_matrix, если установлен numpy).
+
+Смена схемы меняет гороскопы, поэтому она включается с даты HOROSCOPE_PRNG_SINCE: до нее
+(и если переменная не задана) используется md5 и уже показанный сегодня гороскоп не меняется.
+"""
+import hashlib
+import os
+import random
+from datetime import date, datetime
+from typing import Sequence
+
+try:
+    import numpy
+except ImportError:  # numpy необязателен: без него draw_matrix недоступна
+    numpy = None
+
+MASK64 = (1 << 64) - 1
+GAMMA = 0x9E3779B97F4A7C15
+
+# Первый день, с которого гороскопы считаются через CounterRng (YYYY-MM-DD). Ставьте не раньше
+# завтрашнего дня, иначе у пользователей, уже получивших гороскоп, он изменится посреди дня.
+PRNG_SINCE = os.getenv("HOROSCOPE_PRNG_SINCE")
+COUNTER_PRNG_SINCE: date | None = date.fromisoformat(PRNG_SINCE) if PRNG_SINCE else None
+
+
+def mix64(z: int) -> int:
+    """Финализатор splitmix64: биективно перемешивает 64-битное число."""
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+def stream_key(user_id: int, day_ordinal: int, sign_index: int) -> int:
+    """Ключ потока пользователя на день: от него зависят все числа CounterRng.
+
+    До перемешивания поля не пересекаются (знак — биты 0..3, день — 4..23, id — с 24-го),
+    поэтому разные (user_id, день, знак) при id меньше 2**40 дают разные ключи.
+    """
+    return mix64(((user_id << 24) ^ (day_ordinal << 4) ^ sign_index) & MASK64)
+
+
+class CounterRng:
+    """Счетный ГСЧ: j-е 64-битное слово — mix64(key + (j + 1) * GAMMA), как j-й шаг splitmix64.
+
+    Каждое слово делится на четыре 16-битных числа, так что на гороскоп (около 15 выборов)
+    уходит четыре перемешивания. Число в диапазоне [0, n) берется умножением со сдвигом:
+    смещение не больше n / 2**16, для выбора из десятка фраз оно несущественно.
+    Повторяет ту часть интерфейса random.Random, которой пользуется генератор гороскопов.
+    Если переданы words (строка draw_matrix), сначала расходуются они.
+    """
+    __slots__ = ("key", "words", "index", "word", "lanes")
+
+    def __init__(self, key: int, words: Sequence[int] = ()):
+        self.key = key
+        self.words = words
+        self.index = 0
+        self.word = 0
+        self.lanes = 0
+
+    def below(self, n: int) -> int:
+        if not self.lanes:
+            index = self.index
+            self.index = index + 1
+            self.word = self.words[index] if index < len(self.words) else mix64((self.key + (index + 1) * GAMMA) & MASK64)
+            self.lanes = 4
+        self.lanes -= 1
+        lane = self.word & 0xFFFF
+        self.word >>= 16
+        return (lane * n) >> 16
+
+    def randint(self, a: int, b: int) -> int:
+        return a + self.below(b - a + 1)
+
+    def choice(self, seq: Sequence):
+        if not seq:
+            raise IndexError("Cannot choose from an empty sequence")
+        return seq[self.below(len(seq))]
+
+    def sample(self, population: Sequence, k: int) -> list:
+        n = len(population)
+        if not 0 <= k <= n:
+            raise ValueError("Sample larger than population or is negative")
+        # Частичная перетасовка Фишера — Йетса: k первых элементов и есть выборка
+        pool = list(population)
+        for i in range(k):
+            j = i + self.below(n - i)
+            pool[i], pool[j] = pool[j], pool[i]
+        return pool[:k]
+
+
+def draw_matrix(user_ids, day_ordinal: int, sign_index: int, words: int):
+    """Ключи и первые words слов CounterRng для массива пользователей одного знака за один проход numpy.
+
+    Возвращает пару массивов uint64: ключи формы (n,) и слова формы (n, words); строка i
+    совпадает со словами CounterRng(stream_key(user_ids[i], day_ordinal, sign_index)).
+    """
+    if numpy is None:
+        raise RuntimeError("draw_matrix требует numpy")
+
+    def mix(z):
+        z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+        return z ^ (z >> numpy.uint64(31))
+
+    ids = numpy.asarray(user_ids, dtype=numpy.uint64)
+    key = mix((ids << numpy.uint64(24)) ^ numpy.uint64((day_ordinal << 4) ^ sign_index))
+    steps = numpy.arange(1, words + 1, dtype=numpy.uint64) * numpy.uint64(GAMMA)
+    return key, mix(key[:, None] + steps[None, :])
+
+
+def uses_counter_prng(day: date) -> bool:
+    return COUNTER_PRNG_SINCE is not None and day >= COUNTER_PRNG_SINCE
+
+
+class DailySeeder:
+    """ГСЧ пользователей на один день; дата форматируется один раз на день, а не на каждый гороскоп."""
+    __slots__ = ("day", "ordinal", "counter")
+
+    def __init__(self, today: datetime, counter: bool | None = None):
+        self.day = today.strftime('%Y%m%d')
+        self.ordinal = today.toordinal()
+        self.counter = uses_counter_prng(today.date()) if counter is None else counter
+
+    def rng(self, user_id: int, sign_key: str, sign_index: int):
+        if self.counter:
+            return CounterRng(stream_key(user_id, self.ordinal, sign_index))
+        # Исходная схема: уникальный seed для дня, пользователя и знака
+        seed_str = f"{user_id}_{self.day}_{sign_key}".encode()
+        seed = int(hashlib.md5(seed_str).hexdigest()[:8], 16)
+        return random.Random(seed)
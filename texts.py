@@ -0,0 +1,224 @@
+"""Тексты бота и каталог локализации.
+
+Модуль не зависит от aiogram и MongoDB, поэтому его можно импортировать без окружения бота.
+"""
+import string
+import sys
+from typing import Any, Dict
+
+# --- Тексты для разных языков (теперь только русский) ---
+TEXTS = {
+    "ru": {
+        "welcome": "✨ Добро пожаловать в <b>Cosmic Insight</b> - ваш личный астрологический компаньон!\n\n"
+                   "Получайте свой ежедневный гороскоп и небесное руководство.",
+        "main_menu_horoscope": "🌟 Получить гороскоп",
+        "main_menu_settings": "⚙️ Настройки",
+        "main_menu_support": "❤️ Поддержать нас",
+        "main_menu_entertainment": "🎲 Развлечения",
+        "support_us_prompt": "💎 Поддержите наш проект!\n\n"
+                             "Пожалуйста, отправьте <b>любую сумму TON</b> на адрес:\n"
+                             "<code>{wallet}</code>\n\n"
+                             "Для этого:\n"
+                             "1. Нажмите кнопку 'Открыть @wallet'.\n"
+                             "2. В боте @wallet выберите 'Отправить'.\n"
+                             "3. Вставьте указанный выше адрес.\n"
+                             "4. Введите желаемую сумму.",
+        "settings_menu_choose": "Выберите, что хотите настроить:",
+        "settings_change_sign": "Изменить знак зодиака",
+        "settings_set_birth_date": "Указать дату рождения",
+        "settings_change_language": "Изменить язык",
+        "choose_sign": "Выберите ваш знак зодиака:",
+        "sign_set_success": "✅ Ваш знак зодиака установлен как <b>{sign}</b>.",
+        "sign_changed_answer": "Знак зодиака изменен!",
+        "donate_open_wallet": "Открыть @wallet",
+        "copy_ton_button": "📋 Копировать адрес TON",
+        "donate_closed": "Окно доната закрыто.",
+        "birth_date_prompt": "Пожалуйста, введите вашу дату рождения в формате ДД.ММ.ГГГГ:",
+        "birth_date_invalid_format": "Неверный формат даты. Пожалуйста, введите в формате ДД.ММ.ГГГГ (например, 01.01.2000).",
+        "birth_date_future_error": "Дата рождения не может быть в будущем. Пожалуйста, введите корректную дату.",
+        "birth_date_success": "✅ Ваша дата рождения <b>{birth_date}</b> успешно сохранена!",
+        "birth_date_changed_answer": "Дата рождения сохранена!",
+        "choose_language_prompt": "Выберите язык:",
+        "language_set_success": "✅ Язык успешно изменен на <b>{lang_name}</b>.",
+        "language_changed_answer": "Язык изменен!",
+        "ad_text": "✨ <b>Специальное предложение от нашего партнера</b> ✨\n\n"
+                   "Ознакомьтесь с этим удивительным продуктом!",
+        "ad_button": "Посетить спонсора",
+        "horoscope_title": "{emoji} <b>Ваш ежедневный гороскоп</b>",
+        "horoscope_sign": "🔮 Знак Зодиака: {sign} ({element})",
+        "horoscope_date": "📅 Дата: {date}",
+        "horoscope_age": "🎂 Вам {age} {years}!",
+        "horoscope_mood": "🌈 Настроение дня: <b>{mood}</b>",
+        "horoscope_lucky_color": "🍀 Счастливый цвет: <b>{color}</b>",
+        "horoscope_lucky_number": "🔢 Число удачи: <b>{number}</b>",
+        "horoscope_ruling_planet": "🪐 Планета-покровитель: <b>{planet}</b>",
+        "horoscope_lucky_stone": "💎 Камень удачи: <b>{stone}</b>",
+        "horoscope_compatibility": "💞 Совместимость: <b>{compatible_signs}</b>",
+        "horoscope_tip": "💡 <b>Совет дня:</b> {tip}",
+        "horoscope_love": "💖 Любовь",
+        "horoscope_career": "💼 Карьера",
+        "horoscope_finance": "💰 Финансы",
+        "horoscope_health": "🏥 Здоровье",
+        "horoscope_closing_message": "Помните, звезды лишь намекают, а выбор всегда за вами! Желаем вам волшебного дня! ✨",
+        "years_singular": "год",
+        "years_plural_2_4": "года",
+        "years_plural_5_plus": "лет",
+        "compatibility_not_defined": "Не определена",
+        "horoscope_tips": [
+            "Доверьтесь своей интуиции; она приведет вас к правильному решению.",
+            "Сегодня отличный день для новых начинаний и смелых идей.",
+            "Обратите внимание на детали — в них кроется ключ к успеху.",
+            "Постарайтесь провести время с близкими; это принесет вам радость.",
+            "Не бойтесь рисковать, но делайте это мудро и осознанно.",
+            "Сосредоточьтесь на своих целях, и вы достигнете желаемого.",
+            "Практикуйте благодарность – это привлечет больше позитива в вашу жизнь.",
+            "Найдите время для отдыха и восстановления, это важно для вашего благополучия."
+        ],
+        # Переводы для знаков зодиака, элементов, планет, камней
+        "sign_aries": "Овен", "sign_taurus": "Телец", "sign_gemini": "Близнецы", "sign_cancer": "Рак",
+        "sign_leo": "Лев", "sign_virgo": "Дева", "sign_libra": "Весы", "sign_scorpio": "Скорпион",
+        "sign_sagittarius": "Стрелец", "sign_capricorn": "Козерог", "sign_aquarius": "Водолей", "sign_pisces": "Рыбы",
+        
+        "element_fire": "Огонь", "element_earth": "Земля", "element_air": "Воздух", "element_water": "Вода",
+
+        "planet_mars": "Марс", "planet_venus": "Венера", "planet_mercury": "Меркурий", "planet_moon": "Луна",
+        "planet_sun": "Солнце", "planet_pluto": "Плутон", "planet_jupiter": "Юпитер", "planet_saturn": "Сатурн",
+        "planet_uranus": "Уран", "planet_neptune": "Нептун", "planet_crystal": "Кристалл (по умолчанию)", # для камня
+        
+        "stone_diamond": "Алмаз", "stone_emerald": "Изумруд", "stone_agate": "Агат", "stone_pearl": "Жемчуг",
+        "stone_ruby": "Рубин", "stone_sapphire": "Сапфир", "stone_opal": "Опал", "stone_topaz": "Топаз",
+        "stone_turquoise": "Бирюза", "stone_garnet": "Гранат", "stone_amethyst": "Аметист", "stone_aquamarine": "Аквамарин",
+
+        # Развлекательные функции
+        "entertainment_menu_choose": "Выберите развлечение:",
+        "cookie_button": "🍪 Печенье с предсказанием",
+        "magic_ball_button": "🔮 Шар с ответами",
+        "cookie_fortune_message": "🍪 Ваше предсказание: <b>{fortune}</b>",
+        "magic_ball_question_prompt": "🔮 Задайте свой вопрос Шару (он ответит 'да' или 'нет'):",
+        "magic_ball_answer_message": "🔮 Ответ Шара: <b>{answer}</b>",
+        "magic_ball_not_a_question": "Пожалуйста, задайте вопрос.",
+
+        # Название языка для меню выбора языка
+        "language_button": "🇷🇺 Русский",
+        "language_name": "Русский",
+
+        # Кнопка "Поделиться ботом" под гороскопом
+        "share_bot_button": "💌 Поделиться ботом",
+        "share_message": "🔮 Хочешь узнать, что ждет тебя сегодня по звездам? Получай свой личный гороскоп каждый день с Cosmic Insight! Это не просто общие фразы, а глубокий взгляд в твою судьбу. Присоединяйся и исследуй свой космический путь! ✨\n\n[Ссылка на бота]"
+    }
+}
+
+
+# --- Каталог локализации ---
+DEFAULT_LANG = "ru"
+# Цепочки фолбэков: строка, которой нет в языке, берется из следующего языка цепочки.
+# Язык без явной цепочки откатывается на DEFAULT_LANG.
+LANG_FALLBACKS = {
+    "ru": ("ru",),
+}
+
+
+class Template:
+    """Строка каталога, разобранная один раз при сборке.
+
+    Строки без подстановок отдаются как есть. Остальные хранятся как segments — литералы,
+    на месте полей пустые строки — и slots, пары (позиция, имя, формат), как в HoroscopeTemplate:
+    render ставит значения полей и склеивает сегменты одним "".join. Поля с преобразованием
+    (!r), индексом или вложенным форматом не разбираются, такие строки форматируются format_map.
+    """
+    __slots__ = ("text", "fields", "segments", "slots")
+
+    def __init__(self, text: str):
+        self.text = text
+        parsed = list(string.Formatter().parse(text))
+        self.fields = tuple(field for _, field, _, _ in parsed if field is not None)
+        self.segments, slots = [], []
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                self.segments.append(literal)
+            if field is None:
+                continue
+            if conversion or not field.isidentifier() or "{" in spec:
+                self.segments, slots = None, None
+                break
+            slots.append((len(self.segments), field, spec))
+            self.segments.append("")
+        self.slots = tuple(slots) if slots is not None else None
+
+    def render(self, kwargs: dict) -> str:
+        if not self.fields:
+            return self.text
+        if self.slots is None:
+            return self.text.format_map(kwargs)
+        parts = self.segments.copy()
+        for position, name, spec in self.slots:
+            parts[position] = format(kwargs[name], spec)
+        return "".join(parts)
+
+
+class Catalog:
+    """Локализованные строки и списки, собранные один раз при импорте с учетом фолбэков."""
+
+    def __init__(self, texts: dict, fallbacks: dict, default_lang: str):
+        self.default_lang = default_lang
+        self._langs: Dict[str, Dict[str, Any]] = {}
+        for lang in set(texts) | set(fallbacks):
+            chain = fallbacks.get(lang, (lang, default_lang))
+            merged = {}
+            for chain_lang in reversed(chain):
+                merged.update(texts.get(chain_lang, {}))
+            self._langs[lang] = {
+                sys.intern(key): Template(value) if isinstance(value, str) else tuple(value)
+                for key, value in merged.items()
+            }
+        self._default = self._langs[default_lang]
+
+    @property
+    def languages(self) -> tuple:
+        return tuple(self._langs)
+
+    def _entries(self, lang: str) -> Dict[str, Any]:
+        return self._langs.get(lang) or self._default
+
+    def template(self, lang: str, key: str) -> Template:
+        entry = self._entries(lang).get(key)
+        if entry is None:
+            return Template(f"_{key}_")
+        return entry
+
+    def get(self, lang: str, key: str) -> str:
+        entry = self._entries(lang).get(key)
+        return entry.text if entry is not None else f"_{key}_"
+
+    def render(self, lang: str, key: str, **kwargs) -> str:
+        entry = self._entries(lang).get(key)
+        return entry.render(kwargs) if entry is not None else f"_{key}_"
+
+    def list(self, lang: str, key: str) -> tuple:
+        return self._entries(lang).get(key, ())
+
+    def variants(self, key: str) -> set:
+        """Все переводы строки — для фильтров по тексту кнопок."""
+        return {entries[key].text for entries in self._langs.values() if key in entries}
+
+
+CATALOG = Catalog(TEXTS, LANG_FALLBACKS, DEFAULT_LANG)
+
+
+class LocalizedProfile:
+    """Профиль пользователя с доступом к строкам каталога на его языке."""
+    __slots__ = ("user_id", "data")
+
+    def __init__(self, user_id: int, data: dict):
+        self.user_id = user_id
+        self.data = data
+
+    @property
+    def lang(self) -> str:
+        return self.data.get("lang", DEFAULT_LANG)
+
+    def text(self, key: str) -> str:
+        return CATALOG.get(self.lang, key)
+
+    def render(self, key: str, **kwargs) -> str:
+        return CATALOG.render(self.lang, key, **kwargs)